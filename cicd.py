@@ -3,14 +3,13 @@ from functions.my_logger import logger
 import subprocess
 from datetime import datetime
 import requests
-from mc import GameUtils
+from functions.map_sampler import map_sampler
 n = 1  # 登陆次数
 
 
 
 def check_online():
-    t = int(time.time()*1000)
-    players, success = GameUtils.fetch_online_player_by_map_api()
+    players, success = map_sampler.get_players()
     if not success:
         return True
     names = [obj['account'] for obj in players]
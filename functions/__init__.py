@@ -28,6 +28,9 @@ from .communicate_by_ai import main_ai
 # Keyword processing
 from .keyword_in_communication import keys, keys_set
 
+# Knowledge base
+from .knowledge_base import knowledge_base
+
 # KOOK API integration
 from .kook_api import get_kook_api_instance, send_kook_message, send_kook_notification
 
@@ -35,7 +38,13 @@ from .kook_api import get_kook_api_instance, send_kook_message, send_kook_notifi
 from .my_logger import logger, logger_com, logger_ai, logger_send
 
 # Tools and Flask app
-from .tools import app, socketio, avatar_downloader
+from .tools import app, socketio, avatar_downloader, log_publisher
+
+# Recent log cache
+from .log_cache import recent_log_cache
+
+# Log archive
+from .log_archive import log_archiver
 
 # Timetable information
 from .timetable_info import place_timetable, activity_timetable, config as timetable_config
@@ -71,6 +80,9 @@ __all__ = [
     'keys',
     'keys_set',
     
+    # Knowledge base
+    'knowledge_base',
+    
     # KOOK API
     'get_kook_api_instance',
     'send_kook_message',
@@ -86,6 +98,13 @@ __all__ = [
     'app',
     'socketio',
     'avatar_downloader',
+    'log_publisher',
+    
+    # Log cache
+    'recent_log_cache',
+    
+    # Log archive
+    'log_archiver',
     
     # Timetable
     'place_timetable',
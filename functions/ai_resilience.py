@@ -0,0 +1,279 @@
+"""AI接口容错模块
+
+为智谱AI请求提供截止时间、对冲请求、熔断和延迟直方图：
+- 截止时间：超过 AI_REQUEST_DEADLINE 秒没有结果即放弃等待，返回兜底回复；
+- 对冲请求：开启 AI_HEDGE 后，第一个请求超过近期p95延迟仍未返回时再发一个，先到先用；
+- 熔断：连续失败 AI_BREAKER_FAILURES 次后熔断，期间直接返回兜底回复，
+  AI_BREAKER_RESET_SECONDS 秒后放行一个探测请求，成功则恢复；
+  只有超时、连接错误、5xx和429计为失败，其余4xx（如内容审核拒绝）是请求本身的问题，
+  直接抛出，不触发熔断也不对冲；
+- 延迟直方图：按操作统计延迟分布和各类结果的次数。
+"""
+
+import bisect
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional
+from .config import config
+from .my_logger import logger
+
+
+class AIUnavailableError(Exception):
+    """AI接口熔断中，请求未发出"""
+    pass
+
+
+class AITimeoutError(Exception):
+    """AI请求超过截止时间"""
+    pass
+
+
+class LatencyHistogram:
+    """延迟直方图（固定桶，单位毫秒）"""
+
+    BUCKETS_MS = (100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000)
+
+    def __init__(self, window: int = 200):
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)  # 最后一个桶为 +Inf
+        self._outcomes: Dict[str, int] = {}
+        self._recent: Deque[float] = deque(maxlen=window)  # 最近成功请求的延迟（秒），用于对冲
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, outcome: str = 'ok') -> None:
+        """记录一次请求
+
+        Args:
+            seconds: 耗时（秒）
+            outcome: 结果（ok / error / client_error / timeout / rejected / aborted），
+                     rejected（熔断拒绝）和aborted（流式中途失败）只计数不计延迟
+        """
+        with self._lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            if outcome in ('rejected', 'aborted'):
+                return
+            self._counts[bisect.bisect_left(self.BUCKETS_MS, seconds * 1000)] += 1
+            self._total += seconds
+            if outcome == 'ok':
+                self._recent.append(seconds)
+
+    def recent_quantile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        """最近成功请求延迟的分位数（秒），样本不足时返回None"""
+        with self._lock:
+            if len(self._recent) < min_samples:
+                return None
+            ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def _quantile_ms(self, q: float, count: int) -> Optional[int]:
+        """由桶计数估算分位数（取所在桶的上界）"""
+        if not count:
+            return None
+        target = q * count
+        running = 0
+        for index, bucket_count in enumerate(self._counts):
+            running += bucket_count
+            if running >= target:
+                return self.BUCKETS_MS[index] if index < len(self.BUCKETS_MS) else None
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出直方图"""
+        with self._lock:
+            count = sum(self._counts)
+            buckets = {f'le_{bound}': value for bound, value in zip(self.BUCKETS_MS, self._counts)}
+            buckets['le_inf'] = self._counts[-1]
+            return {
+                'count': count,
+                'avg_ms': round(self._total / count * 1000) if count else None,
+                'p50_ms': self._quantile_ms(0.5, count),
+                'p95_ms': self._quantile_ms(0.95, count),
+                'p99_ms': self._quantile_ms(0.99, count),
+                'outcomes': dict(self._outcomes),
+                'buckets': buckets,
+            }
+
+
+class CircuitBreaker:
+    """熔断器：closed（正常） -> open（熔断） -> half_open（放行一个探测请求）"""
+
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or config.AI_BREAKER_FAILURES
+        self.reset_timeout = reset_timeout or config.AI_BREAKER_RESET_SECONDS
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否放行请求"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """请求成功"""
+        with self._lock:
+            if self.state != 'closed':
+                logger.info('AI接口已恢复，熔断器关闭')
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        """请求失败"""
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or self._failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning(f'AI接口连续失败 {self._failures} 次，熔断 {self.reset_timeout} 秒')
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+def is_client_error(error: BaseException) -> bool:
+    """是否为请求本身导致的错误（除429外的4xx），重试也会以同样方式失败"""
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and 400 <= status_code < 500 and status_code != 429
+
+
+class AIResilience:
+    """AI请求容错层"""
+
+    def __init__(self, deadline: float = None, hedge: bool = None, hedge_min_delay: float = None,
+                 breaker: CircuitBreaker = None):
+        self.deadline = deadline or config.AI_REQUEST_DEADLINE
+        self.hedge = config.AI_HEDGE if hedge is None else hedge
+        self.hedge_min_delay = hedge_min_delay or config.AI_HEDGE_MIN_DELAY
+        self.breaker = breaker or CircuitBreaker()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._executor = ThreadPoolExecutor(max_workers=config.AI_WORKERS * 2 + 2, thread_name_prefix='ai-call')
+        self._lock = threading.Lock()
+
+    def histogram(self, operation: str) -> LatencyHistogram:
+        """获取指定操作的延迟直方图"""
+        with self._lock:
+            if operation not in self._histograms:
+                self._histograms[operation] = LatencyHistogram()
+            return self._histograms[operation]
+
+    def _hedge_delay(self, histogram: LatencyHistogram) -> Optional[float]:
+        """对冲请求的等待时间：近期p95延迟，样本不足或未开启时返回None"""
+        if not self.hedge:
+            return None
+        p95 = histogram.recent_quantile(0.95)
+        if p95 is None:
+            return None
+        delay = max(p95, self.hedge_min_delay)
+        return delay if delay < self.deadline else None
+
+    def call(self, fn: Callable[[], Any], operation: str = 'completion',
+             discard: Optional[Callable[[Any], None]] = None) -> Any:
+        """在截止时间内执行一次AI请求（必要时对冲）
+
+        Args:
+            fn: 发起请求并返回结果的函数，会在线程池中执行，可能被执行两次
+            operation: 统计用的操作名
+            discard: 处理未被采用的结果（如关闭多余的流式响应）
+
+        Returns:
+            fn的结果
+
+        Raises:
+            AIUnavailableError: 熔断中
+            AITimeoutError: 超过截止时间
+            Exception: 请求本身的异常（4xx客户端错误不计入熔断）
+        """
+        histogram = self.histogram(operation)
+        if not self.breaker.allow():
+            histogram.observe(0.0, 'rejected')
+            raise AIUnavailableError('AI接口熔断中')
+
+        start = time.monotonic()
+        deadline = start + self.deadline
+        hedge_delay = self._hedge_delay(histogram)
+        pending = {self._executor.submit(fn)}
+        hedged = hedge_delay is None
+        last_error: Optional[BaseException] = None
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_until = deadline if hedged else min(deadline, start + hedge_delay)
+            done, pending = wait(pending, timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    elapsed = time.monotonic() - start
+                    histogram.observe(elapsed, 'ok')
+                    self.breaker.record_success()
+                    self._discard_later(pending, discard)
+                    return future.result()
+                if is_client_error(error):
+                    # 请求本身有问题，重发也会失败，不对冲也不计入熔断
+                    histogram.observe(time.monotonic() - start, 'client_error')
+                    self._discard_later(pending, discard)
+                    raise error
+                last_error = error
+            if not hedged and (time.monotonic() >= start + hedge_delay or not pending):
+                # 第一个请求太慢或已失败，再发一个，先到先用
+                hedged = True
+                pending.add(self._executor.submit(fn))
+                logger.info(f'AI请求 {operation} 已等待 {time.monotonic() - start:.2f}s，发出对冲请求')
+
+        elapsed = time.monotonic() - start
+        self.breaker.record_failure()
+        self._discard_later(pending, discard)
+        if pending or last_error is None:
+            histogram.observe(elapsed, 'timeout')
+            raise AITimeoutError(f'AI请求超过 {self.deadline}s 未返回')
+        histogram.observe(elapsed, 'error')
+        raise last_error
+
+    @staticmethod
+    def _discard_later(futures, discard: Optional[Callable[[Any], None]]) -> None:
+        """被放弃的请求完成后交给discard处理"""
+        if discard is None:
+            return
+
+        def on_done(future) -> None:
+            if future.exception() is None:
+                try:
+                    discard(future.result())
+                except Exception as e:
+                    logger.warning(f'丢弃多余的AI响应失败: {e}')
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def report_failure(self, operation: str = 'stream') -> None:
+        """记录请求开始后才出现的失败（如流式响应中途断开）"""
+        self.histogram(operation).observe(0.0, 'aborted')
+        self.breaker.record_failure()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取熔断状态和各操作的延迟直方图"""
+        with self._lock:
+            operations = list(self._histograms.items())
+        return {
+            'breaker': self.breaker.state,
+            'deadline': self.deadline,
+            'hedge': self.hedge,
+            'latency': {operation: histogram.snapshot() for operation, histogram in operations},
+        }
+
+
+# 全局AI容错层实例
+ai_resilience = AIResilience()
@@ -0,0 +1,122 @@
+"""AI请求线程池模块
+
+私聊AI请求交给固定数量的工作线程处理，不再阻塞机器人的事件回调线程。
+同一玩家的请求按到达顺序逐个处理，不同玩家的请求并发处理；
+排队请求总数和单个玩家的排队数都有上限，超出时由调用方回复繁忙提示。
+"""
+
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Tuple
+from .config import config
+from .my_logger import logger
+
+
+class AIWorkerPool:
+    """按玩家保序的AI请求线程池
+
+    每个玩家一条待处理队列，就绪队列中只放有待处理请求且没有请求在执行的玩家；
+    工作线程每次从就绪玩家的队列头取一个请求，执行完再把该玩家放回就绪队列末尾，
+    因此同一玩家的请求严格串行，各玩家之间轮流获得线程。
+    """
+
+    def __init__(self, workers: int = None, max_pending: int = None, max_per_user: int = None):
+        self.workers = workers or config.AI_WORKERS
+        self.max_pending = max_pending or config.AI_QUEUE_LIMIT
+        self.max_per_user = max_per_user or config.AI_USER_QUEUE_LIMIT
+        self._user_queues: Dict[str, Deque[Tuple[Callable, tuple, dict]]] = {}
+        self._ready: Deque[str] = deque()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+
+    def start(self) -> None:
+        """启动工作线程"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'ai-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f'AI请求线程池已启动，线程数: {self.workers}')
+
+    def stop(self) -> None:
+        """停止工作线程（排队中的请求被丢弃，执行中的请求会完成）"""
+        with self._cond:
+            self._running = False
+            self._user_queues.clear()
+            self._ready.clear()
+            self._pending = 0
+            self._cond.notify_all()
+        self._threads = []
+
+    def submit(self, user: str, func: Callable, *args: Any, **kwargs: Any) -> bool:
+        """提交一个AI请求
+
+        Args:
+            user: 玩家名，同一玩家的请求按顺序执行
+            func: 在工作线程中执行的函数
+            *args, **kwargs: 函数参数
+
+        Returns:
+            是否已接受（排队已满时返回False）
+        """
+        with self._cond:
+            if not self._running:
+                return False
+            user_queue = self._user_queues.get(user)
+            if self._pending >= self.max_pending:
+                return False
+            if user_queue is not None and len(user_queue) >= self.max_per_user:
+                return False
+
+            if user_queue is None:
+                # 该玩家当前没有请求在排队或执行，直接进入就绪队列
+                user_queue = deque()
+                self._user_queues[user] = user_queue
+                self._ready.append(user)
+            user_queue.append((func, args, kwargs))
+            self._pending += 1
+            self._cond.notify()
+            return True
+
+    def _worker_loop(self) -> None:
+        """工作线程"""
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                user = self._ready.popleft()
+                func, args, kwargs = self._user_queues[user].popleft()
+                self._pending -= 1
+
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f'处理 {user} 的AI请求失败: {e}')
+
+            with self._cond:
+                user_queue = self._user_queues.get(user)
+                if user_queue:
+                    self._ready.append(user)
+                    self._cond.notify()
+                elif user_queue is not None:
+                    del self._user_queues[user]
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取线程池状态"""
+        with self._cond:
+            return {
+                'workers': len(self._threads),
+                'pending': self._pending,
+                'active_users': len(self._user_queues),
+            }
+
+
+# 全局AI请求线程池实例
+ai_worker_pool = AIWorkerPool()
@@ -6,12 +6,17 @@ AI聊天模块 - 基于智谱AI API
 支持多用户会话管理和上下文记忆。
 """
 
+import itertools
 import os
 import time
-from typing import Dict, List, Tuple, Any
+from typing import Callable, Dict, List, Optional, Tuple, Any
 from zhipuai import ZhipuAI
 from dotenv import load_dotenv
 from .my_logger import logger
+from .utils import StreamingLineSplitter
+from .config import config
+from .conversation import trim_history, answer_cache
+from .ai_resilience import ai_resilience, is_client_error, AIUnavailableError, AITimeoutError
 
 # 加载环境变量
 load_dotenv()
@@ -33,7 +38,8 @@ class ZhipuAIChat:
             return
         
         try:
-            self.client = ZhipuAI(api_key=self.api_key)
+            # 重试和超时由容错层统一处理，客户端本身不再重试
+            self.client = ZhipuAI(api_key=self.api_key, timeout=config.AI_REQUEST_DEADLINE, max_retries=0)
             self.model = os.getenv('ZHIPU_AI_MODEL', 'glm-4-flash')  # 默认使用免费模型
             self.session_timeout = int(os.getenv('AI_SESSION_TIMEOUT', '180'))  # 会话超时时间
             self.system_prompt = os.getenv("SYSTEM_PROMPT",'') # 系统提示词
@@ -58,7 +64,11 @@ class ZhipuAIChat:
             更新后的缓存字典
         """
         try:
+            # 历史超过token预算时丢弃最早的几轮，并压缩为摘要
+            messages, summary = trim_history(messages, config.AI_HISTORY_TOKEN_BUDGET,
+                                             cache[username].get('summary', ''))
             cache[username]['messages'] = messages
+            cache[username]['summary'] = summary
             cache[username]['timestamps'] = int(time.time())
             return cache
         except Exception as e:
@@ -86,6 +96,7 @@ class ZhipuAIChat:
                     # 会话过期，重新刷新
                     logger.info(f'用户 {user_name} 的会话已过期，重新初始化')
                     cache[user_name]["messages"] = []
+                    cache[user_name]['summary'] = ''
                     cache[user_name]['timestamps'] = int(current_time)
                     return cache[user_name]["messages"], cache
             else:
@@ -102,7 +113,73 @@ class ZhipuAIChat:
 
 
 
-    def chat(self, username: str, ask_questions: str, caches: Dict[str, Any], reference: Dict[str, str] = None) -> Tuple[str, Dict[str, Any]]:
+    @staticmethod
+    def _reply(text: str, on_line: Optional[Callable[[str], None]]) -> str:
+        """流式模式下把非流式产生的回复（错误提示等）也按行交给回调"""
+        if on_line is not None:
+            splitter = StreamingLineSplitter()
+            for line in splitter.feed(text) + splitter.flush():
+                on_line(line)
+        return text
+
+    def _stream_completion(self, full_messages: List[Dict[str, str]],
+                           on_line: Callable[[str], None]) -> str:
+        """以流式方式调用智谱AI，边生成边按行回调
+
+        Returns:
+            完整回复
+        """
+        splitter = StreamingLineSplitter()
+        parts = []
+        first_line_time = None
+        start_time = time.time()
+
+        def open_stream():
+            # 截止时间和对冲针对首个分片：拿到首个分片后再交给调用方继续读取
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=full_messages,
+                temperature=0.7,
+                max_tokens=1000,
+                stream=True
+            )
+            iterator = iter(response)
+            return next(iterator, None), iterator, response
+
+        def close_stream(result) -> None:
+            close = getattr(result[2], 'close', None)
+            if close is not None:
+                close()
+
+        first_chunk, iterator, _ = ai_resilience.call(open_stream, 'stream_first_chunk', discard=close_stream)
+        chunks = iterator if first_chunk is None else itertools.chain([first_chunk], iterator)
+        try:
+            for chunk in chunks:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                for line in splitter.feed(delta):
+                    if first_line_time is None:
+                        first_line_time = time.time() - start_time
+                    on_line(line)
+        except Exception as e:
+            # 首个分片之后中断，同样计入熔断（客户端错误除外）
+            if not is_client_error(e):
+                ai_resilience.report_failure('stream_first_chunk')
+            raise
+        for line in splitter.flush():
+            if first_line_time is None:
+                first_line_time = time.time() - start_time
+            on_line(line)
+        if first_line_time is not None:
+            logger.info(f'AI首行耗时: {first_line_time:.2f}s')
+        return ''.join(parts)
+
+    def chat(self, username: str, ask_questions: str, caches: Dict[str, Any], reference: Dict[str, str] = None,
+             on_line: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict[str, Any]]:
         """进行AI对话
         
         Args:
@@ -110,6 +187,8 @@ class ZhipuAIChat:
             ask_questions: 用户问题
             caches: 会话缓存
             reference: 参考内容字典
+            on_line: 流式模式的回调，回复按句子/90字切行后逐行调用；
+                     提供时回复（包括错误提示）都会经由回调送出
             
         Returns:
             (AI回复, 更新后的缓存)
@@ -117,26 +196,42 @@ class ZhipuAIChat:
         # 检查AI客户端是否正确初始化
         if not self.client:
             logger.error('AI客户端未正确初始化，无法进行对话')
-            return '抱歉，AI服务暂时不可用，请检查配置。', caches
+            return self._reply('抱歉，AI服务暂时不可用，请检查配置。', on_line), caches
             
         # 验证必要参数
         if not username:
             logger.warning('用户名为空，无法进行AI对话')
-            return '抱歉，用户信息缺失，无法进行对话。', caches
+            return self._reply('抱歉，用户信息缺失，无法进行对话。', on_line), caches
             
         if not ask_questions:
             logger.warning('用户问题为空，无法进行AI对话')
-            return '请输入您的问题。', caches
+            return self._reply('请输入您的问题。', on_line), caches
             
         if caches is None:
             logger.warning('缓存对象为空，使用默认缓存')
             caches = {}
             
+        streamed_lines = []
+        messages = None
+        user_message = None
+
+        def deliver(line: str) -> None:
+            streamed_lines.append(line)
+            on_line(line)
+
         try:
             start_time = time.time()
             
             # 获取历史消息
             messages, cache_2 = self.get_messages_by_user(username, caches)
+
+            # 没有历史的首轮提问先查回答缓存
+            cache_key = None
+            if len(messages) == 0 and config.AI_ANSWER_CACHE_SIZE > 0:
+                cache_key = answer_cache.make_key(ask_questions, reference, self.system_prompt)
+                cached_answer = answer_cache.get(cache_key)
+            else:
+                cached_answer = None
             
             # 如果有参考内容且是首次对话，添加参考内容
             if reference and len(messages) == 0:
@@ -146,31 +241,42 @@ class ZhipuAIChat:
                 ask_questions = reference_text + ask_questions
             
             # 添加用户消息
-            messages.append({
+            user_message = {
                 "role": "user",
                 "content": ask_questions
-            })
+            }
+            messages.append(user_message)
             
-            # 构建完整的消息列表，包含系统提示
+            # 构建完整的消息列表，包含系统提示（以及被裁掉的早期对话摘要）
+            system_prompt = self.system_prompt
+            summary = cache_2.get(username, {}).get('summary')
+            if summary:
+                system_prompt = f'{system_prompt}\n此前与该玩家聊过：{summary}'.strip()
             full_messages = [
-                {"role": "system", "content": self.system_prompt}
+                {"role": "system", "content": system_prompt}
             ] + messages
             
             # 调用智谱AI API
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=full_messages,
-                temperature=0.7,
-                max_tokens=1000
-            )
+            if cached_answer is not None:
+                answer = self._reply(cached_answer, on_line)
+                logger.info(f'用户 {username} 的提问命中回答缓存')
+            elif on_line is not None:
+                answer = self._stream_completion(full_messages, deliver)
+            else:
+                response = ai_resilience.call(lambda: self.client.chat.completions.create(
+                    model=self.model,
+                    messages=full_messages,
+                    temperature=0.7,
+                    max_tokens=1000
+                ), 'completion')
+                answer = response.choices[0].message.content if response.choices else None
             
             # 计算响应时间
             elapsed_time = time.time() - start_time
             logger.info(f'AI响应耗时: {elapsed_time:.2f}s')
             
             # 提取回复内容
-            if response.choices and len(response.choices) > 0:
-                answer = response.choices[0].message.content
+            if answer:
                 
                 # 添加助手回复到消息历史
                 messages.append({
@@ -180,19 +286,31 @@ class ZhipuAIChat:
                 
                 # 更新缓存
                 cache_3 = self.update_cache(messages, username, cache_2)
+                if cache_key is not None and cached_answer is None:
+                    answer_cache.set(cache_key, answer)
                 
                 logger.info(f'用户 {username} 的AI对话成功')
                 return answer, cache_3
             else:
                 logger.error('智谱AI返回空响应')
-                return '抱歉，我无法回答您的问题。', cache_2
+                return self._reply('抱歉，我无法回答您的问题。', on_line), cache_2
                 
         except Exception as e:
+            # 撤回这次没有得到回答的提问，保留之前的对话历史
+            if messages and messages[-1] is user_message:
+                messages.pop()
+            if isinstance(e, AIUnavailableError):
+                logger.warning('AI接口熔断中，直接返回兜底回复')
+                return self._reply(config.AI_FALLBACK_REPLY, on_line), caches
             logger.error(f'AI对话失败: {e}')
-            # 清理出错用户的缓存
-            if username in caches:
-                del caches[username]
-            return '抱歉，我无法回答您的问题，请稍后再试。', caches
+            if isinstance(e, AITimeoutError):
+                error_text = config.AI_FALLBACK_REPLY
+            else:
+                error_text = '抱歉，我无法回答您的问题，请稍后再试。'
+            if streamed_lines:
+                # 回复已经发出一部分，补一句说明
+                error_text = '（回复中断）' + error_text
+            return self._reply(error_text, on_line), caches
 
 
 # 全局AI聊天实例
@@ -216,7 +334,8 @@ def get_ai_chat_instance() -> ZhipuAIChat:
     return _ai_chat_instance
 
 
-def main_ai(username: str, ask_questions: str, caches: Dict[str, Any], token: str = None, reference: Dict[str, str] = None) -> Tuple[str, Dict[str, Any]]:
+def main_ai(username: str, ask_questions: str, caches: Dict[str, Any], token: str = None, reference: Dict[str, str] = None,
+            on_line: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict[str, Any]]:
     """主要的AI对话函数（保持向后兼容）
     
     Args:
@@ -225,6 +344,7 @@ def main_ai(username: str, ask_questions: str, caches: Dict[str, Any], token: st
         caches: 会话缓存
         token: 已废弃，保持兼容性
         reference: 参考内容字典
+        on_line: 流式模式的回调，见 ZhipuAIChat.chat
         
     Returns:
         (AI回复, 更新后的缓存)
@@ -232,11 +352,11 @@ def main_ai(username: str, ask_questions: str, caches: Dict[str, Any], token: st
     # 验证必要参数
     if not username:
         logger.warning('main_ai: 用户名为空')
-        return '抱歉，用户信息缺失。', caches or {}
+        return ZhipuAIChat._reply('抱歉，用户信息缺失。', on_line), caches if caches is not None else {}
         
     if not ask_questions:
         logger.warning('main_ai: 用户问题为空')
-        return '请输入您的问题。', caches or {}
+        return ZhipuAIChat._reply('请输入您的问题。', on_line), caches if caches is not None else {}
         
     if caches is None:
         logger.warning('main_ai: 缓存对象为空，使用默认缓存')
@@ -244,9 +364,9 @@ def main_ai(username: str, ask_questions: str, caches: Dict[str, Any], token: st
         
     try:
         ai_chat = get_ai_chat_instance()
-        return ai_chat.chat(username, ask_questions, caches, reference)
+        return ai_chat.chat(username, ask_questions, caches, reference, on_line)
     except Exception as e:
         logger.error(f'AI对话主函数失败: {e}')
-        return '抱歉，AI服务暂时不可用。', caches
+        return ZhipuAIChat._reply('抱歉，AI服务暂时不可用。', on_line), caches
 
 
@@ -18,6 +18,42 @@ class Config:
     DATABASE_URI = 'sqlite:///ria.db'
     CREATIVE_DB_PATH = os.getcwd().replace('mc_bot_2', 'mc_bot/mc.db')
     
+    # 日志写入缓冲配置（聊天日志/通用日志批量落库）
+    LOG_BUFFER_MAX_BATCH = int(os.getenv('LOG_BUFFER_MAX_BATCH', 50))  # 达到该行数立即刷新
+    LOG_BUFFER_FLUSH_INTERVAL = float(os.getenv('LOG_BUFFER_FLUSH_INTERVAL', 1))  # 最长刷新间隔（秒）
+    LOG_BUFFER_MAX_PENDING = int(os.getenv('LOG_BUFFER_MAX_PENDING', 5000))  # 写入失败时最多保留的行数
+    
+    # 消息发送队列配置
+    MSG_DOORBELL_PORT = int(os.getenv('MSG_DOORBELL_PORT', 21100))  # Web进程唤醒机器人进程的本机UDP端口
+    MSG_QUEUE_BATCH_SIZE = int(os.getenv('MSG_QUEUE_BATCH_SIZE', 10))  # 每次认领的消息数量
+    MSG_QUEUE_LEASE_SECONDS = 60  # 认领超时后消息重新可被认领
+    MSG_QUEUE_MAX_ATTEMPTS = 3  # 单条消息最多尝试发送次数
+    MSG_QUEUE_RETRY_BASE_SECONDS = 5  # 发送失败后的重试退避基数（秒），每次失败翻倍
+    MSG_QUEUE_POLL_INTERVAL = float(os.getenv('MSG_QUEUE_POLL_INTERVAL', 30))  # 兜底轮询间隔（秒）
+    CHAT_SEND_INTERVAL = 1.1  # 游戏内相邻两条发言的最小间隔（秒）
+    CHAT_OUTBOX_MAX_PENDING = 200  # 游戏内发件箱最多积压的消息数
+
+    # AI私聊配置
+    AI_WORKERS = int(os.getenv('AI_WORKERS', 4))  # 同时处理AI请求的线程数
+    AI_QUEUE_LIMIT = int(os.getenv('AI_QUEUE_LIMIT', 32))  # 排队中的AI请求总数上限
+    AI_USER_QUEUE_LIMIT = 3  # 单个玩家排队中的AI请求数上限
+    AI_BUSY_REPLY = '提问的人有点多，请稍后再试。'
+    AI_STREAM = os.getenv('AI_STREAM', '1') not in ('0', 'false', 'False')  # 边生成边发送AI回复
+    AI_SESSION_TIMEOUT = int(os.getenv('AI_SESSION_TIMEOUT', '180'))  # AI会话超时时间（秒）
+    AI_CONVERSATION_MAX_USERS = 256  # 最多保留对话历史的玩家数
+    AI_HISTORY_TOKEN_BUDGET = int(os.getenv('AI_HISTORY_TOKEN_BUDGET', 1500))  # 每个会话历史的token预算
+    AI_SUMMARY_ITEM_CHARS = 30  # 早期提问写入摘要时保留的字数
+    AI_SUMMARY_MAX_CHARS = 300  # 早期对话摘要的最大字数
+    AI_ANSWER_CACHE_SIZE = int(os.getenv('AI_ANSWER_CACHE_SIZE', 512))  # 首轮提问回答缓存的条目数（0表示关闭）
+    AI_ANSWER_CACHE_TTL = int(os.getenv('AI_ANSWER_CACHE_TTL', 6 * 3600))  # 回答缓存的有效期（秒）
+    AI_REQUEST_DEADLINE = float(os.getenv('AI_REQUEST_DEADLINE', 15))  # AI请求截止时间（秒，流式请求为首个分片）
+    AI_HEDGE = os.getenv('AI_HEDGE', '0') not in ('0', 'false', 'False')  # 请求慢于近期p95时发出对冲请求
+    AI_HEDGE_MIN_DELAY = 1.0  # 对冲请求的最短等待时间（秒）
+    AI_BREAKER_FAILURES = 5  # 连续失败多少次后熔断
+    AI_BREAKER_RESET_SECONDS = 30  # 熔断多久后放行探测请求（秒）
+    AI_FALLBACK_REPLY = 'AI暂时不可用，请稍后再试。'
+    AI_ADMINS = [name.strip() for name in os.getenv('AI_ADMINS', '').split(',') if name.strip()]  # 可以私聊执行管理指令的玩家
+    
     # Flask配置
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret!')
     SQLALCHEMY_DATABASE_URI = 'sqlite:////ria.db'
@@ -25,6 +61,18 @@ class Config:
     # Socket.IO配置
     PING_TIMEOUT = 100
     PING_INTERVAL = 50
+    LOG_PUBLISH_INTERVAL = float(os.getenv('LOG_PUBLISH_INTERVAL', 1))  # 新日志推送检查间隔（秒）
+    LOG_CACHE_SIZE = int(os.getenv('LOG_CACHE_SIZE', 500))  # 内存中保留的最近日志条数（每张表）
+    CHAT_LOG_RETENTION_DAYS = int(os.getenv('CHAT_LOG_RETENTION_DAYS', 180))  # 聊天日志在数据库中保留的天数，0表示不归档
+    COMMON_LOG_RETENTION_DAYS = int(os.getenv('COMMON_LOG_RETENTION_DAYS', 30))  # 通用日志在数据库中保留的天数，0表示不归档
+    LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', 'archive')  # 日志归档目录
+    LOG_ARCHIVE_BATCH_SIZE = 5000  # 每批归档并删除的行数
+    ONLINE_SAMPLE_INTERVAL = int(os.getenv('ONLINE_SAMPLE_INTERVAL', 60))  # 在线玩家采样间隔（秒）
+    USER_CACHE_SIZE = 1024  # 登录用户缓存的最大条数
+    USER_CACHE_TTL = 300  # 登录用户缓存有效期（秒）
+    DASHBOARD_RANGE_CACHE_SIZE = 64  # 仪表板日期范围查询缓存条数
+    DASHBOARD_RANGE_CACHE_TTL = 600  # 仪表板日期范围查询缓存有效期（秒）
+    DASHBOARD_RANGE_MAX_DAYS = 366  # 仪表板单次查询的最大天数
     
     # Minecraft服务器配置
     MINECRAFT_HOST = os.getenv('HOST')
@@ -33,6 +81,8 @@ class Config:
     MINECRAFT_AUTH = os.getenv("AUTH") == 'True'
     SERVER_PASSWORD = os.getenv('SERVER_PASSWORD')
     MAP_API = os.getenv('MAP_API')
+    MAP_SAMPLER_FRESHNESS = float(os.getenv('MAP_SAMPLER_FRESHNESS', 30))  # 地图API结果的缓存新鲜度（秒）
+    MAP_SAMPLER_TIMEOUT = 10  # 地图API请求超时（秒）
     
     # KOOK配置
     KOOK_TOKEN = os.getenv('KOOK')
@@ -52,7 +102,20 @@ class Config:
     
     # 文件路径配置
     STATIC_IMG_PATH = './static/img'
+    AVATAR_INDEX_REFRESH_INTERVAL = 60  # 头像目录变化检查间隔（秒）
+    AVATAR_WORKERS = int(os.getenv('AVATAR_WORKERS', 4))  # 头像下载并发数
+    AVATAR_REQUEST_TIMEOUT = 10  # 头像相关HTTP请求超时（秒）
+    AVATAR_HOST_RATE = 2.0  # 每个域名每秒允许的请求数
+    AVATAR_HOST_BURST = 10  # 每个域名允许的突发请求数
+    AVATAR_UUID_TTL_DAYS = 30  # 玩家UUID缓存有效期（天）
+    AVATAR_NEGATIVE_TTL_HOURS = 24  # 查无此人的缓存有效期（小时）
+    AVATAR_RETRY_BASE_SECONDS = 30  # 暂时性失败（429/5xx/网络错误）后的重试退避基数（秒），每次失败翻倍
+    AVATAR_RETRY_MAX_SECONDS = 3600  # 重试退避上限（秒）
     EGGS_FILE_PATH = 'eggs.txt'
+    KNOWLEDGE_BASE_PATH = os.getenv('KNOWLEDGE_BASE_PATH', 'knowledge.json')  # AI知识库数据文件
+    KNOWLEDGE_BASE_BUDGET = 1200  # 每次提供给AI的参考内容总字数上限
+    KNOWLEDGE_BASE_MAX_ENTRIES = 5  # 每次提供给AI的参考条目数上限
+    KNOWLEDGE_BASE_RELOAD_INTERVAL = 30  # 知识库数据变化检查间隔（秒）
     LOGS_DIR = './logs'
 
     # 开发环境
@@ -0,0 +1,206 @@
+"""AI对话记忆模块
+
+按玩家保存AI对话历史：玩家数量有上限（最久未对话的先淘汰），
+过期会话由定时任务主动清理，每个会话的历史按token预算裁剪，
+被裁掉的早期对话压缩为一行摘要放进系统提示，保证每次请求的内容大小有上界。
+另有首轮提问的回答缓存，常见问题直接返回缓存的回答。
+"""
+
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from .config import config
+from .utils import TTLCache
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数（中文约每字1个，其他字符约每4个1个）"""
+    if not text:
+        return 0
+    wide = sum(1 for char in text if ord(char) > 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def trim_history(messages: List[Dict[str, str]], budget: int,
+                 summary: str = '') -> Tuple[List[Dict[str, str]], str]:
+    """按token预算裁剪对话历史
+
+    从最早的一轮（用户提问+AI回答）开始丢弃，直到历史总量不超过预算；
+    最后一轮总是保留。被丢弃的提问摘取开头追加到摘要中，摘要本身也有长度上限。
+
+    Args:
+        messages: 对话历史（user/assistant交替）
+        budget: token预算
+        summary: 已有的摘要
+
+    Returns:
+        (裁剪后的历史, 更新后的摘要)
+    """
+    total = sum(estimate_tokens(message.get('content', '')) for message in messages)
+    if total <= budget:
+        return messages, summary
+
+    start = 0
+    dropped_questions = []
+    while total > budget and len(messages) - start > 2:
+        # 一轮以用户提问开始，到下一条用户提问之前结束
+        end = start + 1
+        while end < len(messages) and messages[end].get('role') != 'user':
+            end += 1
+        if len(messages) - end < 1:
+            break
+        for message in messages[start:end]:
+            total -= estimate_tokens(message.get('content', ''))
+            if message.get('role') == 'user':
+                dropped_questions.append(message.get('content', '')[:config.AI_SUMMARY_ITEM_CHARS])
+        start = end
+
+    if dropped_questions:
+        summary = '；'.join(filter(None, [summary] + dropped_questions))
+        summary = summary[-config.AI_SUMMARY_MAX_CHARS:]
+    return messages[start:], summary
+
+
+class ConversationStore:
+    """AI对话缓存
+
+    兼容原来 caches 字典的用法（in / [] / del / get），
+    每个值为 {'messages': [...], 'timestamps': 最近对话时间, 'summary': 早期对话摘要}。
+    """
+
+    def __init__(self, maxsize: int = None, ttl: float = None):
+        self.maxsize = maxsize or config.AI_CONVERSATION_MAX_USERS
+        self.ttl = ttl or config.AI_SESSION_TIMEOUT
+        self._data: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, user: str) -> bool:
+        with self._lock:
+            return user in self._data
+
+    def __getitem__(self, user: str) -> Dict[str, Any]:
+        with self._lock:
+            value = self._data[user]
+            self._data.move_to_end(user)
+            return value
+
+    def __setitem__(self, user: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._data[user] = value
+            self._data.move_to_end(user)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __delitem__(self, user: str) -> None:
+        with self._lock:
+            del self._data[user]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, user: str, default: Any = None) -> Any:
+        with self._lock:
+            if user not in self._data:
+                return default
+            return self[user]
+
+    def sweep(self) -> int:
+        """清理过期的会话
+
+        Returns:
+            清理的会话数
+        """
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [user for user, value in self._data.items() if value.get('timestamps', 0) < deadline]
+            for user in expired:
+                del self._data[user]
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取缓存状态"""
+        with self._lock:
+            return {
+                'users': len(self._data),
+                'messages': sum(len(value.get('messages', [])) for value in self._data.values()),
+                'tokens': sum(estimate_tokens(message.get('content', ''))
+                              for value in self._data.values() for message in value.get('messages', [])),
+            }
+
+
+class AnswerCache:
+    """AI回答缓存
+
+    只用于没有对话历史的首轮提问：相同的问题（规范化后）、相同的知识库参考内容、
+    相同的系统提示会得到缓存的回答，不再调用AI接口。
+    """
+
+    TRAILING_PUNCTUATION = '?？!！。.~～…,，'
+
+    def __init__(self, maxsize: int = None, ttl: float = None):
+        self._cache = TTLCache(maxsize or config.AI_ANSWER_CACHE_SIZE,
+                               ttl or config.AI_ANSWER_CACHE_TTL)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def normalize(cls, question: str) -> str:
+        """规范化问题文本：全角转半角、转小写、去掉空白和句末标点"""
+        text = unicodedata.normalize('NFKC', question or '').lower()
+        text = ''.join(text.split())
+        return text.rstrip(cls.TRAILING_PUNCTUATION)
+
+    @classmethod
+    def make_key(cls, question: str, reference: Optional[Dict[str, str]], system_prompt: str) -> str:
+        """由规范化问题、参考内容和系统提示版本生成缓存键"""
+        prompt_version = hashlib.sha1((system_prompt or '').encode('utf-8')).hexdigest()[:12]
+        payload = json.dumps([cls.normalize(question), sorted((reference or {}).items()), prompt_version],
+                             ensure_ascii=False)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存的回答（统计命中率）"""
+        answer = self._cache.get(key)
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def set(self, key: str, answer: str) -> None:
+        """缓存回答"""
+        self._cache.set(key, answer)
+
+    def purge(self) -> int:
+        """清空缓存
+
+        Returns:
+            清空前的条目数
+        """
+        count = len(self._cache)
+        self._cache.clear()
+        return count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存状态"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+# 全局AI对话缓存实例
+conversation_store = ConversationStore()
+
+# 全局AI回答缓存实例
+answer_cache = AnswerCache()
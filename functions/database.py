@@ -3,14 +3,26 @@
 封装常用的数据库操作和模型定义
 """
 
+import atexit
 import datetime
+import json
+import math
+import os
+import struct
 import threading
-from typing import List, Optional
-from sqlalchemy import Column, DateTime, Text, Integer, JSON, create_engine, desc
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import (
+    Column, DateTime, Text, Integer, JSON, Index, LargeBinary, create_engine, desc, insert, update, delete, select, or_, and_,
+    func, inspect, text
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import declarative_base, Session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from .config import config
+from .utils import IPBanList, message_doorbell
 
 # 数据库基类和实例
 Base = declarative_base()
@@ -76,6 +88,45 @@ class DatabaseManager:
                     print(f"数据库操作失败: {e}")
                     raise
     
+    def bulk_insert(self, model, rows: List[Dict[str, Any]],
+                    hooks: Optional[List[Callable[[Session, List[Dict[str, Any]]], None]]] = None) -> int:
+        """在同一个事务中批量插入多行数据，包含重试机制
+
+        Args:
+            model: ORM模型类
+            rows: 待插入的行（列名到值的字典）
+            hooks: 提交前在同一会话中执行的回调，用于维护派生数据
+
+        Returns:
+            插入的行数
+        """
+        if not rows:
+            return 0
+
+        max_retries = 3
+        retry_delay = 0.1
+
+        for attempt in range(max_retries):
+            try:
+                new_session = Session(bind=engine)
+                try:
+                    new_session.execute(insert(model), rows)
+                    for hook in hooks or []:
+                        hook(new_session, rows)
+                    new_session.commit()
+                    return len(rows)
+                finally:
+                    new_session.close()
+
+            except Exception as e:
+                if "database is locked" in str(e) and attempt < max_retries - 1:
+                    print(f"数据库锁定，第 {attempt + 1} 次重试...")
+                    time.sleep(retry_delay * (2 ** attempt))  # 指数退避
+                    continue
+                else:
+                    print(f"批量写入失败: {e}")
+                    raise
+
     def close_sessions(self):
         """关闭所有数据库会话"""
         try:
@@ -92,6 +143,12 @@ class DatabaseManager:
 class RIALogInfo(Base):
     """RIA聊天日志模型"""
     __tablename__ = 'RIA_log_info'
+    __table_args__ = (
+        Index('idx_ria_log_info_t', 't'),
+        Index('idx_ria_log_info_who_t', 'who_string', 't'),
+        # 归档会清空旧行，ID必须单调递增不复用，否则新日志会被误判为已归档
+        {'sqlite_autoincrement': True},
+    )
     
     id = Column(Integer, primary_key=True, unique=True, nullable=False)
     who_string = Column(Text, comment='玩家名字')
@@ -111,6 +168,10 @@ class RIALogInfo(Base):
 class RIALogCommon(Base):
     """RIA通用日志模型"""
     __tablename__ = 'RIA_log_common'
+    __table_args__ = (
+        Index('idx_ria_log_common_t', 't'),
+        {'sqlite_autoincrement': True},
+    )
     
     id = Column(Integer, primary_key=True, unique=True, nullable=False)
     log_string = Column(Text, comment='日志内容')
@@ -131,12 +192,23 @@ class RIAMsgSend(Base):
     
     id = Column(Integer, primary_key=True, unique=True, nullable=False)
     text = Column(Text, comment='要发送的内容')
+    status = Column(Text, default='pending', comment='状态：pending/claimed/failed')
+    attempts = Column(Integer, default=0, comment='已尝试发送次数')
+    claim_token = Column(Text, comment='认领批次标识')
+    claimed_at = Column(DateTime, comment='认领时间')
+    created_at = Column(DateTime, default=datetime.datetime.now, comment='入队时间')
+    last_error = Column(Text, comment='最近一次发送失败原因')
+    next_attempt_at = Column(DateTime, comment='失败后最早的重试时间')
 
 
 
 class RIAOnline(Base):
     """RIA在线人员记录模型"""
     __tablename__ = 'RIA_online'
+    __table_args__ = (
+        Index('idx_ria_online_t', 't'),
+        Index('idx_ria_online_player_t', 'player_name', 't'),
+    )
     
     id = Column(Integer, primary_key=True, unique=True, nullable=False)
     player_name = Column(Text, comment='玩家名字')
@@ -145,6 +217,87 @@ class RIAOnline(Base):
 
 
 
+class PlayerDict(Base):
+    """玩家名字典模型，在线采样中用整数ID代替玩家名"""
+    __tablename__ = 'player_dict'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    player_name = Column(Text, unique=True, nullable=False, comment='玩家名字')
+
+
+class OnlineSample(Base):
+    """在线采样模型（每次采样一行，玩家ID和数值字段以紧凑数组存储）"""
+    __tablename__ = 'online_samples'
+    __table_args__ = (
+        Index('idx_online_samples_t', 't'),
+    )
+
+    # 每名玩家记录的数值字段，顺序即coords中的排列顺序
+    FIELDS = ('armor', 'x', 'y', 'z', 'health')
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    t = Column(DateTime, nullable=False, comment='采样时间')
+    player_count = Column(Integer, nullable=False, default=0, comment='在线人数')
+    player_ids = Column(LargeBinary, comment='玩家ID数组（小端uint32）')
+    coords = Column(LargeBinary, comment='每名玩家的数值字段数组（小端float32，缺失为NaN）')
+
+    # 固定为小端、4字节（与平台的本机字节序和数组项大小无关，数据可跨机器迁移）
+    ID_FORMAT = '<I'
+    COORD_FORMAT = '<f'
+
+    @classmethod
+    def pack_ids(cls, player_ids: List[int]) -> bytes:
+        """打包玩家ID数组"""
+        return struct.pack(f'<{len(player_ids)}I', *player_ids)
+
+    @classmethod
+    def unpack_ids(cls, data: Optional[bytes]) -> List[int]:
+        """解包玩家ID数组"""
+        if not data:
+            return []
+        return [value for (value,) in struct.iter_unpack(cls.ID_FORMAT, data)]
+
+    @classmethod
+    def pack_coords(cls, rows: List[List[Any]]) -> bytes:
+        """打包每名玩家的数值字段（无法转换为数字的值记为NaN）"""
+        values = []
+        for row in rows:
+            for value in row:
+                try:
+                    number = float(value)
+                    struct.pack(cls.COORD_FORMAT, number)  # 超出float32范围时抛出OverflowError
+                except (TypeError, ValueError, OverflowError):
+                    number = math.nan
+                values.append(number)
+        return struct.pack(f'<{len(values)}f', *values)
+
+    @classmethod
+    def unpack_coords(cls, data: Optional[bytes]) -> List[List[Optional[float]]]:
+        """解包每名玩家的数值字段（NaN还原为None）"""
+        values = [value for (value,) in struct.iter_unpack(cls.COORD_FORMAT, data)] if data else []
+        width = len(cls.FIELDS)
+        return [
+            [None if math.isnan(value) else value for value in values[i:i + width]]
+            for i in range(0, len(values), width)
+        ]
+
+
+class PlayerSession(Base):
+    """玩家在线时段模型（由玩家加入/离开事件维护，left_at为空表示仍在线）"""
+    __tablename__ = 'player_sessions'
+    __table_args__ = (
+        Index('idx_player_sessions_player_joined', 'player_name', 'joined_at'),
+        Index('idx_player_sessions_joined', 'joined_at'),
+        Index('idx_player_sessions_left', 'left_at'),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    player_name = Column(Text, nullable=False, comment='玩家名字')
+    joined_at = Column(DateTime, nullable=False, comment='加入时间')
+    left_at = Column(DateTime, comment='离开时间')
+    end_reason = Column(Text, comment='结束原因：left/reconcile/offline/restart')
+
+
 class RIAPlayers(Base, UserMixin):
     """RIA玩家模型"""
     __tablename__ = 'ria_players'
@@ -181,6 +334,7 @@ class WEBBannedIPs(Base):
     ip_address = Column(Text, unique=True, nullable=False, comment='被封禁的IP地址')
     banned_at = Column(DateTime, default=datetime.datetime.now, comment='封禁时间')
     reason = Column(Text, default='400 Bad Request', comment='封禁原因')
+    expires_at = Column(DateTime, comment='过期时间，为空表示永久封禁')
     
     def to_dict(self) -> dict:
         """转换为字典格式"""
@@ -188,7 +342,8 @@ class WEBBannedIPs(Base):
             'id': self.id,
             'ip_address': self.ip_address,
             'banned_at': self.banned_at.strftime("%Y-%m-%d %H:%M:%S") if self.banned_at else None,
-            'reason': self.reason
+            'reason': self.reason,
+            'expires_at': self.expires_at.strftime("%Y-%m-%d %H:%M:%S") if self.expires_at else None
         }
 
 
@@ -213,46 +368,425 @@ class DashboardDaily(Base):
         }
 
 
+class KnownPlayer(Base):
+    """已知玩家模型（在聊天或在线记录中出现过的玩家，发言次数大于0的才能登录网页）"""
+    __tablename__ = 'known_players'
+
+    player_name = Column(Text, primary_key=True, comment='玩家名字')
+    first_seen = Column(DateTime, comment='首次出现时间')
+    last_seen = Column(DateTime, comment='最近出现时间')
+    message_count = Column(Integer, default=0, nullable=False, comment='发言次数')
+
+
+class DashboardHourly(Base):
+    """按小时预聚合的仪表板数据模型（每小时每个玩家一行，写入日志和在线记录时增量维护）"""
+    __tablename__ = 'dashboard_hourly'
+
+    hour = Column(DateTime, primary_key=True, comment='整点时间')
+    player_name = Column(Text, primary_key=True, comment='玩家名字')
+    message_count = Column(Integer, default=0, nullable=False, comment='该小时发言次数')
+    first_message_at = Column(DateTime, comment='该小时首条发言时间')
+    online = Column(Integer, default=0, nullable=False, comment='该小时是否有在线记录（0/1）')
+
+
+class PlayerUUIDCache(Base):
+    """玩家名到UUID的解析缓存模型（UUID为空表示该玩家名不存在）"""
+    __tablename__ = 'player_uuid_cache'
+
+    player_name = Column(Text, primary_key=True, comment='玩家名字')
+    uuid = Column(Text, comment='Mojang UUID，为空表示查无此人')
+    resolved_at = Column(DateTime, nullable=False, comment='解析时间')
+
+
+
+class KnowledgeEntry(Base):
+    """AI知识库条目模型（与知识库数据文件合并加载）"""
+    __tablename__ = 'knowledge_entries'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    keywords = Column(Text, nullable=False, comment='触发关键词，多个用英文逗号分隔')
+    content = Column(Text, nullable=False, comment='提供给AI的参考内容')
+    priority = Column(Integer, nullable=False, default=0, comment='排序权重，越大越优先')
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now, comment='更新时间')
+
+
+def upsert_known_players(session: Session, stats: Dict[str, List[Any]]) -> None:
+    """在给定会话中累加已知玩家的出现时间和发言次数
+
+    Args:
+        session: 数据库会话
+        stats: 玩家名到 [首次出现时间, 最近出现时间, 发言次数] 的映射
+    """
+    if not stats:
+        return
+    stmt = sqlite_insert(KnownPlayer).values([
+        {'player_name': name, 'first_seen': first_seen, 'last_seen': last_seen, 'message_count': count}
+        for name, (first_seen, last_seen, count) in stats.items()
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[KnownPlayer.player_name],
+        set_={
+            'first_seen': func.min(func.coalesce(KnownPlayer.first_seen, stmt.excluded.first_seen),
+                                   stmt.excluded.first_seen),
+            'last_seen': func.max(func.coalesce(KnownPlayer.last_seen, stmt.excluded.last_seen),
+                                  stmt.excluded.last_seen),
+            'message_count': KnownPlayer.message_count + stmt.excluded.message_count,
+        }
+    ))
+
+
+def upsert_dashboard_hourly(session: Session, stats: Dict[Any, List[Any]]) -> None:
+    """在给定会话中累加小时汇总数据
+
+    Args:
+        session: 数据库会话
+        stats: (整点时间, 玩家名) 到 [发言次数, 首条发言时间, 是否在线] 的映射
+    """
+    if not stats:
+        return
+    stmt = sqlite_insert(DashboardHourly).values([
+        {'hour': hour, 'player_name': name, 'message_count': count,
+         'first_message_at': first_message_at, 'online': online}
+        for (hour, name), (count, first_message_at, online) in stats.items()
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[DashboardHourly.hour, DashboardHourly.player_name],
+        set_={
+            'message_count': DashboardHourly.message_count + stmt.excluded.message_count,
+            'first_message_at': func.coalesce(
+                func.min(DashboardHourly.first_message_at, stmt.excluded.first_message_at),
+                DashboardHourly.first_message_at,
+                stmt.excluded.first_message_at
+            ),
+            'online': func.max(DashboardHourly.online, stmt.excluded.online),
+        }
+    ))
+
+
+def _dashboard_hourly_chat_hook(session: Session, rows: List[Dict[str, Any]]) -> None:
+    """聊天日志批量写入时同步更新小时汇总表"""
+    stats: Dict[Any, List[Any]] = {}
+    for row in rows:
+        name = row.get('who_string')
+        if not name or not name.strip():
+            continue
+        key = (row['t'].replace(minute=0, second=0, microsecond=0), name)
+        entry = stats.get(key)
+        if entry is None:
+            stats[key] = [1, row['t'], 0]
+        else:
+            entry[0] += 1
+            entry[1] = min(entry[1], row['t'])
+    upsert_dashboard_hourly(session, stats)
+
+
+def iter_online_presence(session: Session, start_datetime: datetime.datetime,
+                         end_datetime: datetime.datetime) -> Iterator[Tuple[datetime.datetime, str]]:
+    """逐条产出时间范围内的 (采样时间, 玩家名)，包括旧的逐行在线记录和紧凑在线采样
+
+    Args:
+        session: 数据库会话
+        start_datetime: 开始时间（包含）
+        end_datetime: 结束时间（包含）
+    """
+    for player_name, t in session.query(RIAOnline.player_name, RIAOnline.t).filter(
+            and_(RIAOnline.t >= start_datetime, RIAOnline.t <= end_datetime)
+    ).yield_per(1000):
+        if player_name:
+            yield t, player_name
+
+    names = dict(session.execute(select(PlayerDict.id, PlayerDict.player_name)).all())
+    for t, player_ids in session.query(OnlineSample.t, OnlineSample.player_ids).filter(
+            and_(OnlineSample.t >= start_datetime, OnlineSample.t <= end_datetime)
+    ).yield_per(1000):
+        for player_id in OnlineSample.unpack_ids(player_ids):
+            player_name = names.get(player_id)
+            if player_name:
+                yield t, player_name
+
+
+def _known_players_chat_hook(session: Session, rows: List[Dict[str, Any]]) -> None:
+    """聊天日志批量写入时同步更新已知玩家表"""
+    stats: Dict[str, List[Any]] = {}
+    for row in rows:
+        name = row.get('who_string')
+        if not name or not name.strip():
+            continue
+        entry = stats.get(name)
+        if entry is None:
+            stats[name] = [row['t'], row['t'], 1]
+        else:
+            entry[0] = min(entry[0], row['t'])
+            entry[1] = max(entry[1], row['t'])
+            entry[2] += 1
+    upsert_known_players(session, stats)
+
+
+class WriteBehindBuffer:
+    """写后缓冲队列
+
+    在内存中收集待写入的行，达到数量阈值或时间阈值时由后台线程一次性批量写入，
+    避免每条日志都单独开启会话、提交和刷盘。
+    """
+
+    def __init__(self, db_manager: DatabaseManager, model, name: str,
+                 max_batch_size: int = None, flush_interval: float = None,
+                 max_pending: int = None):
+        self.db_manager = db_manager
+        self.model = model
+        self.name = name
+        self.max_batch_size = max_batch_size or config.LOG_BUFFER_MAX_BATCH
+        self.flush_interval = flush_interval or config.LOG_BUFFER_FLUSH_INTERVAL
+        self.max_pending = max_pending or config.LOG_BUFFER_MAX_PENDING
+
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self._closed = False
+        self._hooks: List[Callable[[Session, List[Dict[str, Any]]], None]] = []
+
+        # 统计计数器
+        self._max_queue_depth = 0
+        self._flush_count = 0
+        self._flushed_rows = 0
+        self._failed_flushes = 0
+        self._dropped_rows = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def add_hook(self, hook: Callable[[Session, List[Dict[str, Any]]], None]) -> None:
+        """注册批量写入时在同一事务中执行的回调
+
+        Args:
+            hook: 回调函数，参数为(会话, 本批次的行)
+        """
+        self._hooks.append(hook)
+
+    def append(self, row: Dict[str, Any]) -> None:
+        """追加一行待写入数据
+
+        Args:
+            row: 列名到值的字典
+        """
+        with self._lock:
+            self._pending.append(row)
+            depth = len(self._pending)
+            if depth > self._max_queue_depth:
+                self._max_queue_depth = depth
+
+        if self._closed:
+            # 已关闭时不再依赖后台线程，直接同步写入
+            self.flush()
+            return
+
+        self._ensure_started()
+        if depth >= self.max_batch_size:
+            self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        """按需启动后台刷新线程"""
+        if self._running:
+            return
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._flush_loop, name=f'write-behind-{self.name}', daemon=True
+            )
+            self._thread.start()
+
+    def _flush_loop(self) -> None:
+        """后台刷新线程"""
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """立即将缓冲区内的数据批量写入数据库
+
+        Returns:
+            本次写入的行数
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+
+            start = time.perf_counter()
+            written = 0
+            chunks = [rows]
+            while chunks:
+                chunk = chunks.pop()
+                try:
+                    self.db_manager.bulk_insert(self.model, chunk, self._hooks)
+                    written += len(chunk)
+                except OperationalError as e:
+                    if not self._is_transient(e):
+                        self._isolate(chunk, chunks, e)
+                        continue
+                    self._failed_flushes += 1
+                    # 数据库被锁等临时错误：未写入的行放回队列等待下次重试，超过上限的部分丢弃
+                    remaining = chunk + [row for pending in reversed(chunks) for row in pending]
+                    with self._lock:
+                        self._pending = remaining + self._pending
+                        overflow = len(self._pending) - self.max_pending
+                        if overflow > 0:
+                            del self._pending[:overflow]
+                            self._dropped_rows += overflow
+                    print(f"[{self.name}] 批量写入失败，{len(remaining)} 行已放回队列: {e}")
+                    break
+                except Exception as e:
+                    self._isolate(chunk, chunks, e)
+            if not written:
+                return 0
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._flush_count += 1
+            self._flushed_rows += written
+            self._last_flush_ms = elapsed_ms
+            self._total_flush_ms += elapsed_ms
+            if elapsed_ms > self._max_flush_ms:
+                self._max_flush_ms = elapsed_ms
+            return written
+
+    @staticmethod
+    def _is_transient(error: OperationalError) -> bool:
+        """是否为重试可能成功的临时错误（数据库被锁或繁忙）"""
+        message = str(error.orig if error.orig is not None else error).lower()
+        return 'locked' in message or 'busy' in message
+
+    def _isolate(self, chunk: List[Dict[str, Any]], chunks: List[List[Dict[str, Any]]], error: Exception) -> None:
+        """非临时错误：把批次对半拆分重试以找出坏行，单独一行仍失败时记录日志后丢弃"""
+        self._failed_flushes += 1
+        if len(chunk) == 1:
+            self._dropped_rows += 1
+            print(f"[{self.name}] 写入失败，已丢弃 1 行: {chunk[0]}（{error}）")
+            return
+        middle = len(chunk) // 2
+        chunks.append(chunk[middle:])
+        chunks.append(chunk[:middle])
+
+    def close(self) -> None:
+        """停止后台线程并刷新剩余数据"""
+        self._closed = True
+        self._running = False
+        self._wakeup.set()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    @property
+    def queue_depth(self) -> int:
+        """当前待写入的行数"""
+        return len(self._pending)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓冲队列统计信息
+
+        Returns:
+            统计信息字典
+        """
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self._max_queue_depth,
+            'flush_count': self._flush_count,
+            'flushed_rows': self._flushed_rows,
+            'failed_flushes': self._failed_flushes,
+            'dropped_rows': self._dropped_rows,
+            'last_flush_ms': round(self._last_flush_ms, 2),
+            'max_flush_ms': round(self._max_flush_ms, 2),
+            'avg_flush_ms': round(self._total_flush_ms / self._flush_count, 2) if self._flush_count else 0.0,
+        }
+
+
 class DatabaseService:
     """数据库服务类"""
     def __init__(self, db_manager: DatabaseManager):
         self.db_manager = db_manager
         self.online_player_set = set()
         self.lock = threading.Lock()
-    
+
+        # 聊天日志与通用日志的写后缓冲
+        self.chat_log_buffer = WriteBehindBuffer(db_manager, RIALogInfo, 'chat_log')
+        self.common_log_buffer = WriteBehindBuffer(db_manager, RIALogCommon, 'common_log')
+
+        self.chat_log_buffer.add_hook(_known_players_chat_hook)
+        self.chat_log_buffer.add_hook(_dashboard_hourly_chat_hook)
+
+        # 玩家名到字典ID的缓存（在线采样使用）
+        self.player_id_cache: Dict[str, int] = {}
+
+        # 已知玩家名集合（首次查询时从known_players加载，未命中时回查数据库）
+        self.known_player_set = set()
+        self._known_players_loaded = False
+
+        # IP封禁表的内存副本（首次检查时从数据库加载，之后由ban_ip/unban_ip同步更新）
+        self.ip_ban_list = IPBanList()
+        self._ip_bans_loaded = False
+
     def add_chat_log(self, username: str, message: str) -> None:
-        """添加聊天日志
-        
+        """添加聊天日志（写入缓冲队列，由后台线程批量落库）
+
         Args:
             username: 用户名
             message: 消息内容
         """
         try:
-            log = RIALogInfo(
-                who_string=username,
-                log_string=message,
-                t=datetime.datetime.now()
-            )
-            # 使用DatabaseManager的安全方法
-            self.db_manager.add_and_commit(log)
+            self.chat_log_buffer.append({
+                'who_string': username,
+                'log_string': message,
+                't': datetime.datetime.now()
+            })
         except Exception as e:
             print(f"添加聊天日志失败: {e}")
-    
+
     def add_common_log(self, message: str) -> None:
-        """添加通用日志
-        
+        """添加通用日志（写入缓冲队列，由后台线程批量落库）
+
         Args:
             message: 日志消息
         """
         try:
-            log = RIALogCommon(
-                log_string=message,
-                t=datetime.datetime.now()
-            )
-            # 使用DatabaseManager的安全方法
-            self.db_manager.add_and_commit(log)
+            self.common_log_buffer.append({
+                'log_string': message,
+                't': datetime.datetime.now()
+            })
         except Exception as e:
             print(f"添加通用日志失败: {e}")
+
+    def flush_log_buffers(self) -> int:
+        """立即刷新所有日志缓冲队列
+
+        Returns:
+            写入的总行数
+        """
+        return self.chat_log_buffer.flush() + self.common_log_buffer.flush()
+
+    def get_ingest_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取日志写入缓冲的统计信息（队列深度、刷新耗时等）
+
+        Returns:
+            各缓冲队列的统计信息
+        """
+        return {
+            'chat_log': self.chat_log_buffer.get_stats(),
+            'common_log': self.common_log_buffer.get_stats(),
+        }
+
+    def close(self) -> None:
+        """关闭服务，确保缓冲队列中的日志全部落库"""
+        for buffer in (self.chat_log_buffer, self.common_log_buffer):
+            try:
+                buffer.close()
+            except Exception as e:
+                print(f"关闭写入缓冲 {buffer.name} 失败: {e}")
     
     def get_recent_chat_logs(self, limit: int = 20) -> List[RIALogInfo]:
         """获取最近的聊天日志
@@ -306,17 +840,255 @@ class DatabaseService:
     
     def add_message_to_send_queue(self, text: str) -> None:
         """添加消息到发送队列
-        
+
+        Args:
+            text: 要发送的文本
+        """
+        self.enqueue_message(text)
+
+    def enqueue_message(self, text: str) -> Optional[int]:
+        """将消息写入发送队列并唤醒机器人进程的发送线程
+
         Args:
             text: 要发送的文本
+
+        Returns:
+            消息ID，失败时返回None
         """
         try:
-            msg = RIAMsgSend(text=text)
-            # 使用DatabaseManager的安全方法
-            self.db_manager.add_and_commit(msg)
+            temp_session = Session(bind=engine)
+            try:
+                result = temp_session.execute(insert(RIAMsgSend).values(
+                    text=text,
+                    status='pending',
+                    attempts=0,
+                    created_at=datetime.datetime.now()
+                ))
+                temp_session.commit()
+                message_id = result.inserted_primary_key[0]
+            finally:
+                temp_session.close()
+            message_doorbell.ring()
+            return message_id
         except Exception as e:
             print(f"添加发送消息失败: {e}")
-    
+            return None
+
+    def claim_messages(self, limit: int = None, lease_seconds: int = None) -> List[Dict[str, Any]]:
+        """原子地认领一批待发送消息
+
+        待发送、已过退避时间的失败消息以及认领超时的消息都可以被认领；
+        认领超时且已用完尝试次数的消息记录日志后删除。
+        认领通过单条UPDATE完成，多个发送者不会认领到同一条消息。
+
+        Args:
+            limit: 本次最多认领的数量
+            lease_seconds: 认领有效期（秒），超时未确认的消息会被重新认领
+
+        Returns:
+            认领到的消息列表，每项包含id、text、attempts
+        """
+        limit = limit or config.MSG_QUEUE_BATCH_SIZE
+        lease_seconds = lease_seconds or config.MSG_QUEUE_LEASE_SECONDS
+        now = datetime.datetime.now()
+        token = f'{threading.get_ident()}-{time.time_ns()}'
+
+        claimable = or_(
+            RIAMsgSend.status.is_(None),
+            RIAMsgSend.status == 'pending',
+            and_(RIAMsgSend.status == 'failed', RIAMsgSend.attempts < config.MSG_QUEUE_MAX_ATTEMPTS,
+                 or_(RIAMsgSend.next_attempt_at.is_(None), RIAMsgSend.next_attempt_at <= now)),
+            and_(RIAMsgSend.status == 'claimed', RIAMsgSend.attempts < config.MSG_QUEUE_MAX_ATTEMPTS,
+                 RIAMsgSend.claimed_at < now - datetime.timedelta(seconds=lease_seconds)),
+        )
+        # 认领超时且已用完尝试次数（发送时崩溃或卡住）的消息不再重试
+        exhausted = and_(
+            RIAMsgSend.status == 'claimed',
+            RIAMsgSend.attempts >= config.MSG_QUEUE_MAX_ATTEMPTS,
+            RIAMsgSend.claimed_at < now - datetime.timedelta(seconds=lease_seconds)
+        )
+        candidate_ids = (select(RIAMsgSend.id)
+                         .where(claimable)
+                         .order_by(RIAMsgSend.id)
+                         .limit(limit)
+                         .scalar_subquery())
+
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                dead = temp_session.execute(
+                    select(RIAMsgSend.id, RIAMsgSend.text, RIAMsgSend.attempts).where(exhausted)
+                ).all()
+                for row in dead:
+                    print(f"消息 {row.id} 已尝试发送 {row.attempts} 次仍未确认，放弃发送: {row.text}")
+                if dead:
+                    temp_session.execute(
+                        delete(RIAMsgSend)
+                        .where(RIAMsgSend.id.in_([row.id for row in dead]))
+                        .execution_options(synchronize_session=False)
+                    )
+
+                result = temp_session.execute(
+                    update(RIAMsgSend)
+                    .where(RIAMsgSend.id.in_(candidate_ids))
+                    .values(
+                        status='claimed',
+                        claim_token=token,
+                        claimed_at=now,
+                        attempts=func.coalesce(RIAMsgSend.attempts, 0) + 1
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                temp_session.commit()
+                if not result.rowcount:
+                    return []
+
+                rows = temp_session.execute(
+                    select(RIAMsgSend.id, RIAMsgSend.text, RIAMsgSend.attempts)
+                    .where(RIAMsgSend.claim_token == token)
+                    .order_by(RIAMsgSend.id)
+                ).all()
+                return [{'id': row.id, 'text': row.text, 'attempts': row.attempts} for row in rows]
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"认领待发送消息失败: {e}")
+            return []
+
+    def ack_messages(self, message_ids: List[int]) -> int:
+        """确认消息已发送，批量删除
+
+        Args:
+            message_ids: 已发送的消息ID列表
+
+        Returns:
+            删除的数量
+        """
+        if not message_ids:
+            return 0
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                result = temp_session.execute(
+                    delete(RIAMsgSend)
+                    .where(RIAMsgSend.id.in_(message_ids))
+                    .execution_options(synchronize_session=False)
+                )
+                temp_session.commit()
+                return result.rowcount
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"确认已发送消息失败: {e}")
+            return 0
+
+    def mark_messages_failed(self, message_ids: List[int], error: str = '') -> int:
+        """将消息标记为发送失败
+
+        未达到最大尝试次数的消息按指数退避等待后才能再次被认领，
+        已达到最大尝试次数的消息记录日志后删除，不再重试。
+
+        Args:
+            message_ids: 发送失败的消息ID列表
+            error: 失败原因
+
+        Returns:
+            更新或删除的数量
+        """
+        if not message_ids:
+            return 0
+        now = datetime.datetime.now()
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                rows = temp_session.execute(
+                    select(RIAMsgSend.id, RIAMsgSend.text, RIAMsgSend.attempts)
+                    .where(RIAMsgSend.id.in_(message_ids))
+                ).all()
+                exhausted = [row for row in rows if (row.attempts or 0) >= config.MSG_QUEUE_MAX_ATTEMPTS]
+                for row in exhausted:
+                    print(f"消息 {row.id} 已尝试发送 {row.attempts} 次仍失败，放弃发送: {row.text}（{error}）")
+                if exhausted:
+                    temp_session.execute(
+                        delete(RIAMsgSend)
+                        .where(RIAMsgSend.id.in_([row.id for row in exhausted]))
+                        .execution_options(synchronize_session=False)
+                    )
+                for row in rows:
+                    if (row.attempts or 0) >= config.MSG_QUEUE_MAX_ATTEMPTS:
+                        continue
+                    delay = config.MSG_QUEUE_RETRY_BASE_SECONDS * 2 ** max(0, (row.attempts or 1) - 1)
+                    temp_session.execute(
+                        update(RIAMsgSend)
+                        .where(RIAMsgSend.id == row.id)
+                        .values(status='failed', claim_token=None, last_error=str(error)[:500],
+                                next_attempt_at=now + datetime.timedelta(seconds=delay))
+                        .execution_options(synchronize_session=False)
+                    )
+                temp_session.commit()
+                return len(rows)
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"标记发送失败消息失败: {e}")
+            return 0
+
+
+    def _get_player_ids(self, session: Session, player_names: List[str]) -> Dict[str, int]:
+        """把玩家名转换为字典ID，不存在的玩家名自动登记
+
+        Args:
+            session: 数据库会话
+            player_names: 玩家名列表
+
+        Returns:
+            玩家名到ID的映射
+        """
+        missing = [name for name in set(player_names) if name not in self.player_id_cache]
+        if missing:
+            session.execute(
+                sqlite_insert(PlayerDict)
+                .values([{'player_name': name} for name in missing])
+                .on_conflict_do_nothing(index_elements=[PlayerDict.player_name])
+            )
+            rows = session.execute(
+                select(PlayerDict.player_name, PlayerDict.id).where(PlayerDict.player_name.in_(missing))
+            ).all()
+            with self.lock:
+                self.player_id_cache.update({row.player_name: row.id for row in rows})
+        return {name: self.player_id_cache[name] for name in player_names}
+
+    def record_online_sample(self, players: List[Dict[str, Any]]) -> None:
+        """在一个事务中记录一次在线采样
+
+        Args:
+            players: 地图API返回的玩家信息列表（包含account及OnlineSample.FIELDS中的字段）
+        """
+        try:
+            now = datetime.datetime.now()
+            players = [player for player in players if player.get('account')]
+            names = [player['account'] for player in players]
+            hour = now.replace(minute=0, second=0, microsecond=0)
+            temp_session = Session(bind=engine)
+            try:
+                player_ids = self._get_player_ids(temp_session, names)
+                temp_session.add(OnlineSample(
+                    t=now,
+                    player_count=len(players),
+                    player_ids=OnlineSample.pack_ids([player_ids[name] for name in names]),
+                    coords=OnlineSample.pack_coords(
+                        [[player.get(key, '') for key in OnlineSample.FIELDS] for player in players]
+                    )
+                ))
+                upsert_known_players(temp_session, {name: [now, now, 0] for name in names})
+                upsert_dashboard_hourly(temp_session, {(hour, name): [0, None, 1] for name in names})
+                temp_session.commit()
+            finally:
+                temp_session.close()
+        except Exception as e:
+            with self.lock:
+                self.player_id_cache.clear()
+            print(f"记录在线采样失败: {e}")
 
     def record_online_player(self, player_name: str, data_info: dict) -> None:
         """记录在线玩家信息
@@ -326,14 +1098,99 @@ class DatabaseService:
             data_info: 玩家数据信息
         """
         try:
-            online_record = RIAOnline(
-                player_name=player_name,
-                DataInfo=data_info,
-                t=datetime.datetime.now()
-            )
-            self.db_manager.add_and_commit(online_record)
+            now = datetime.datetime.now()
+            temp_session = Session(bind=engine)
+            try:
+                temp_session.add(RIAOnline(
+                    player_name=player_name,
+                    DataInfo=data_info,
+                    t=now
+                ))
+                if player_name:
+                    upsert_known_players(temp_session, {player_name: [now, now, 0]})
+                    upsert_dashboard_hourly(temp_session, {
+                        (now.replace(minute=0, second=0, microsecond=0), player_name): [0, None, 1]
+                    })
+                temp_session.commit()
+            finally:
+                temp_session.close()
         except Exception as e:
             print(f"记录在线玩家失败: {e}")
+
+    def is_known_player(self, player_name: str) -> bool:
+        """检查玩家是否在游戏内发过言（与原来按聊天日志判断的规则一致）
+
+        已知玩家表同时记录只在在线记录中出现过的玩家（用于统计新玩家），
+        这类玩家的发言次数为0，不算作可登录的玩家。
+
+        Args:
+            player_name: 玩家名字
+
+        Returns:
+            是否为已知玩家
+        """
+        if not player_name:
+            return False
+        try:
+            if not self._known_players_loaded:
+                temp_session = Session(bind=engine)
+                try:
+                    names = temp_session.execute(
+                        select(KnownPlayer.player_name).where(KnownPlayer.message_count > 0)
+                    ).scalars().all()
+                finally:
+                    temp_session.close()
+                with self.lock:
+                    self.known_player_set.update(names)
+                    self._known_players_loaded = True
+
+            if player_name in self.known_player_set:
+                return True
+
+            # 已知玩家表由机器人进程维护，内存集合未命中时回查一次主键
+            temp_session = Session(bind=engine)
+            try:
+                exists = temp_session.execute(
+                    select(KnownPlayer.player_name).where(and_(
+                        KnownPlayer.player_name == player_name,
+                        KnownPlayer.message_count > 0
+                    ))
+                ).first() is not None
+            finally:
+                temp_session.close()
+            if exists:
+                with self.lock:
+                    self.known_player_set.add(player_name)
+            return exists
+        except Exception as e:
+            print(f"检查已知玩家失败: {e}")
+            return False
+
+    def count_new_players(self, target_date: datetime.date) -> int:
+        """统计指定日期首次出现的玩家数量
+
+        Args:
+            target_date: 目标日期
+
+        Returns:
+            新玩家数量
+        """
+        start_datetime = datetime.datetime.combine(target_date, datetime.time.min)
+        end_datetime = start_datetime + datetime.timedelta(days=1)
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                return temp_session.execute(
+                    select(func.count()).select_from(KnownPlayer).where(and_(
+                        KnownPlayer.first_seen >= start_datetime,
+                        KnownPlayer.first_seen < end_datetime
+                    ))
+                ).scalar() or 0
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"统计新玩家失败: {e}")
+            return 0
     
     def get_pending_messages(self) -> List[RIAMsgSend]:
         """获取所有待发送的消息
@@ -379,35 +1236,188 @@ class DatabaseService:
             print(f"删除消息失败: {e}")
             return False
 
-    def ban_ip(self, ip_address: str, reason: str = '400 Bad Request') -> bool:
-        """封禁IP地址
+    def load_player_uuids(self) -> Dict[str, Tuple[Optional[str], datetime.datetime]]:
+        """加载所有未过期的玩家UUID解析结果（包括查无此人的负结果）
+
+        Returns:
+            玩家名到 (UUID, 解析时间) 的映射，UUID为None表示查无此人
+        """
+        now = datetime.datetime.now()
+        positive_cutoff = now - datetime.timedelta(days=config.AVATAR_UUID_TTL_DAYS)
+        negative_cutoff = now - datetime.timedelta(hours=config.AVATAR_NEGATIVE_TTL_HOURS)
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                rows = temp_session.execute(
+                    select(PlayerUUIDCache.player_name, PlayerUUIDCache.uuid, PlayerUUIDCache.resolved_at).where(or_(
+                        and_(PlayerUUIDCache.uuid.isnot(None), PlayerUUIDCache.resolved_at >= positive_cutoff),
+                        and_(PlayerUUIDCache.uuid.is_(None), PlayerUUIDCache.resolved_at >= negative_cutoff),
+                    ))
+                ).all()
+                return {row.player_name: (row.uuid, row.resolved_at) for row in rows}
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"加载玩家UUID缓存失败: {e}")
+            return {}
+
+    def save_player_uuid(self, player_name: str, uuid: Optional[str]) -> None:
+        """保存玩家UUID解析结果
+
+        Args:
+            player_name: 玩家名字
+            uuid: UUID，查无此人时为None
+        """
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                stmt = sqlite_insert(PlayerUUIDCache).values(
+                    player_name=player_name, uuid=uuid, resolved_at=datetime.datetime.now()
+                )
+                temp_session.execute(stmt.on_conflict_do_update(
+                    index_elements=[PlayerUUIDCache.player_name],
+                    set_={'uuid': stmt.excluded.uuid, 'resolved_at': stmt.excluded.resolved_at}
+                ))
+                temp_session.commit()
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"保存玩家UUID失败: {e}")
+
+    def get_player(self, user_id: int) -> Optional[RIAPlayers]:
+        """按ID获取网页用户（返回与会话分离的对象）
+
+        Args:
+            user_id: 用户ID
+
+        Returns:
+            用户对象或None
+        """
+        temp_session = Session(bind=engine)
+        try:
+            return temp_session.get(RIAPlayers, user_id)
+        finally:
+            temp_session.close()
+
+    def get_or_create_player(self, player_name: str, email: str) -> RIAPlayers:
+        """按玩家名和邮箱查找网页用户，不存在时创建
+
+        Args:
+            player_name: 玩家名字
+            email: 邮箱地址
+
+        Returns:
+            用户对象（与会话分离，属性已加载）
+        """
+        temp_session = Session(bind=engine)
+        try:
+            user = (temp_session.query(RIAPlayers)
+                    .filter_by(player_name=player_name, email=email)
+                    .first())
+            if user is None:
+                user = RIAPlayers(player_name=player_name, email=email)
+                temp_session.add(user)
+                temp_session.commit()
+                temp_session.refresh(user)
+            return user
+        finally:
+            temp_session.close()
+
+    def load_ip_bans(self) -> int:
+        """从数据库加载未过期的IP封禁到内存
+
+        Returns:
+            加载的封禁条数
+        """
+        now = datetime.datetime.now()
+        temp_session = Session(bind=engine)
+        try:
+            rows = temp_session.execute(
+                select(WEBBannedIPs.ip_address, WEBBannedIPs.expires_at).where(or_(
+                    WEBBannedIPs.expires_at.is_(None),
+                    WEBBannedIPs.expires_at > now
+                ))
+            ).all()
+        finally:
+            temp_session.close()
+
+        with self.lock:
+            self.ip_ban_list.clear()
+            for row in rows:
+                try:
+                    self.ip_ban_list.add(row.ip_address, row.expires_at)
+                except ValueError:
+                    print(f"忽略格式不正确的封禁记录: {row.ip_address}")
+            self._ip_bans_loaded = True
+        return len(rows)
+
+    def _ensure_ip_bans_loaded(self) -> None:
+        """确保内存封禁表已加载"""
+        if not self._ip_bans_loaded:
+            self.load_ip_bans()
+
+    def ban_ip(self, ip_address: str, reason: str = '400 Bad Request',
+               duration: Optional[datetime.timedelta] = None) -> bool:
+        """封禁IP地址或CIDR网段
         
         Args:
-            ip_address: 要封禁的IP地址
+            ip_address: 要封禁的IP地址或网段（如 203.0.113.0/24）
             reason: 封禁原因
+            duration: 封禁时长，None表示永久封禁
             
         Returns:
             是否封禁成功
         """
         try:
-            # 检查IP是否已经被封禁
-            if self.is_ip_banned(ip_address):
-                return True  # 已经被封禁，返回成功
-            
-            banned_ip = WEBBannedIPs(
-                ip_address=ip_address,
-                banned_at=datetime.datetime.now(),
-                reason=reason
-            )
-            self.db_manager.add_and_commit(banned_ip)
-            print(f"IP地址 {ip_address} 已被封禁，原因: {reason}")
+            entry = IPBanList.normalize(ip_address)
+            now = datetime.datetime.now()
+            expires_at = now + duration if duration else None
+            temp_session = Session(bind=engine)
+            try:
+                # 旧记录可能使用了非规范写法，两种写法都要查
+                existing = temp_session.execute(
+                    select(WEBBannedIPs.ip_address, WEBBannedIPs.expires_at)
+                    .where(WEBBannedIPs.ip_address.in_({entry, ip_address}))
+                ).all()
+                if any(row.expires_at is None for row in existing):
+                    return True  # 已经被永久封禁，不会被临时封禁覆盖
+
+                # 临时封禁取较晚的过期时间；已过期的旧记录直接覆盖
+                if expires_at is not None:
+                    expires_at = max([expires_at] + [row.expires_at for row in existing if row.expires_at > now])
+                stale = [row.ip_address for row in existing if row.ip_address != entry]
+                if stale:
+                    temp_session.execute(delete(WEBBannedIPs).where(WEBBannedIPs.ip_address.in_(stale)))
+
+                stmt = sqlite_insert(WEBBannedIPs).values(
+                    ip_address=entry,
+                    banned_at=now,
+                    reason=reason,
+                    expires_at=expires_at
+                )
+                temp_session.execute(stmt.on_conflict_do_update(
+                    index_elements=[WEBBannedIPs.ip_address],
+                    set_={
+                        'banned_at': stmt.excluded.banned_at,
+                        'reason': stmt.excluded.reason,
+                        'expires_at': stmt.excluded.expires_at,
+                    }
+                ))
+                temp_session.commit()
+            finally:
+                temp_session.close()
+
+            self._ensure_ip_bans_loaded()
+            with self.lock:
+                self.ip_ban_list.add(entry, expires_at)
+            print(f"IP地址 {entry} 已被封禁，原因: {reason}")
             return True
         except Exception as e:
             print(f"封禁IP地址失败: {e}")
             return False
     
     def is_ip_banned(self, ip_address: str) -> bool:
-        """检查IP地址是否被封禁
+        """检查IP地址是否被封禁（查询内存封禁表，不访问数据库）
         
         Args:
             ip_address: 要检查的IP地址
@@ -416,16 +1426,8 @@ class DatabaseService:
             是否被封禁
         """
         try:
-            from sqlalchemy.orm import Session
-            
-            temp_session = Session(bind=engine)
-            try:
-                banned_ip = temp_session.query(WEBBannedIPs).filter(
-                    WEBBannedIPs.ip_address == ip_address
-                ).first()
-                return banned_ip is not None
-            finally:
-                temp_session.close()
+            self._ensure_ip_bans_loaded()
+            return self.ip_ban_list.contains(ip_address)
         except Exception as e:
             print(f"检查IP封禁状态失败: {e}")
             return False
@@ -466,15 +1468,19 @@ class DatabaseService:
         try:
             from sqlalchemy.orm import Session
             
+            entry = IPBanList.normalize(ip_address)
             temp_session = Session(bind=engine)
             try:
-                banned_ip = temp_session.query(WEBBannedIPs).filter(
-                    WEBBannedIPs.ip_address == ip_address
-                ).first()
-                if banned_ip:
-                    temp_session.delete(banned_ip)
-                    temp_session.commit()
-                    print(f"IP地址 {ip_address} 已解封")
+                # 规范写法和原始写法都匹配（旧记录可能未规范化）
+                result = temp_session.execute(
+                    delete(WEBBannedIPs).where(WEBBannedIPs.ip_address.in_({entry, ip_address}))
+                )
+                temp_session.commit()
+                if result.rowcount:
+                    if self._ip_bans_loaded:
+                        with self.lock:
+                            self.ip_ban_list.remove(entry)
+                    print(f"IP地址 {entry} 已解封")
                     return True
                 return False
             finally:
@@ -484,13 +1490,269 @@ class DatabaseService:
             return False
 
 
+def _ensure_columns(table_name: str, columns: Dict[str, str]) -> None:
+    """为已存在的旧表补充缺失的列（create_all不会修改已有的表）
+
+    Args:
+        table_name: 表名
+        columns: 列名到列定义DDL的映射
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(table_name):
+        return
+    existing = {column['name'] for column in inspector.get_columns(table_name)}
+    with engine.begin() as conn:
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN {name} {ddl}'))
+                print(f"已为表 {table_name} 添加列 {name}")
+
+
+def _migration_add_queue_and_ban_columns() -> None:
+    """迁移1：发送队列的认领/确认字段，临时封禁的过期时间"""
+    _ensure_columns('RIA_msg_send', {
+        'status': "TEXT DEFAULT 'pending'",
+        'attempts': 'INTEGER DEFAULT 0',
+        'claim_token': 'TEXT',
+        'claimed_at': 'DATETIME',
+        'created_at': 'DATETIME',
+        'last_error': 'TEXT',
+    })
+    _ensure_columns('web_banned_ips', {
+        'expires_at': 'DATETIME',
+    })
+
+
+# 索引迁移前后用于对比耗时的典型查询
+_INDEX_REPORT_QUERIES = {
+    '最新聊天日志(按t排序)': 'SELECT id FROM RIA_log_info ORDER BY t DESC LIMIT 20',
+    '玩家是否发过言(who_string)': 'SELECT 1 FROM RIA_log_info WHERE who_string = :name LIMIT 1',
+    '单日聊天统计(t范围)': 'SELECT who_string, COUNT(*) FROM RIA_log_info WHERE t >= :start AND t < :end GROUP BY who_string',
+    '单日在线记录(t范围)': 'SELECT player_name, t FROM RIA_online WHERE t >= :start AND t < :end',
+}
+
+
+def _time_report_queries() -> Dict[str, float]:
+    """执行典型查询并返回各自耗时（毫秒）"""
+    end = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    params = {'name': '', 'start': end - datetime.timedelta(days=1), 'end': end}
+    timings = {}
+    with engine.connect() as conn:
+        for label, sql in _INDEX_REPORT_QUERIES.items():
+            started = time.perf_counter()
+            conn.execute(text(sql), params).fetchall()
+            timings[label] = (time.perf_counter() - started) * 1000
+    return timings
+
+
+def _migration_add_indexes() -> None:
+    """迁移2：为日志表、在线表添加时间和玩家索引，仪表板日期改为唯一索引"""
+    before = _time_report_queries()
+
+    with engine.begin() as conn:
+        for table in (RIALogInfo.__table__, RIALogCommon.__table__, RIAOnline.__table__):
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        # 旧库的dashboard_daily可能没有唯一约束，先去重（保留最早的记录）再建唯一索引
+        unique_indexes = [
+            row for row in conn.execute(text('PRAGMA index_list("dashboard_daily")')).mappings()
+            if row['unique']
+        ]
+        has_unique_date = any(
+            [col[2] for col in conn.execute(text(f'PRAGMA index_info("{row["name"]}")'))] == ['date']
+            for row in unique_indexes
+        )
+        if not has_unique_date:
+            removed = conn.execute(text(
+                'DELETE FROM dashboard_daily WHERE id NOT IN '
+                '(SELECT MIN(id) FROM dashboard_daily GROUP BY date)'
+            )).rowcount
+            if removed:
+                print(f"已删除 {removed} 条重复日期的仪表板记录")
+            conn.execute(text(
+                'CREATE UNIQUE INDEX IF NOT EXISTS idx_dashboard_daily_date ON dashboard_daily (date)'
+            ))
+        conn.execute(text('ANALYZE'))
+
+    after = _time_report_queries()
+    print("索引迁移前后查询耗时：")
+    for label in _INDEX_REPORT_QUERIES:
+        print(f"  {label}: {before[label]:.2f}ms -> {after[label]:.2f}ms")
+
+
+def _migration_backfill_known_players() -> None:
+    """迁移3：从聊天日志和在线记录回填已知玩家表"""
+    with engine.begin() as conn:
+        conn.execute(text(
+            'INSERT INTO known_players (player_name, first_seen, last_seen, message_count) '
+            'SELECT who_string, MIN(t), MAX(t), COUNT(*) FROM RIA_log_info '
+            "WHERE who_string IS NOT NULL AND TRIM(who_string) != '' GROUP BY who_string "
+            'ON CONFLICT(player_name) DO NOTHING'
+        ))
+        conn.execute(text(
+            'INSERT INTO known_players (player_name, first_seen, last_seen, message_count) '
+            "SELECT player_name, MIN(t), MAX(t), 0 FROM RIA_online WHERE player_name IS NOT NULL AND player_name != '' "
+            'GROUP BY player_name '
+            'ON CONFLICT(player_name) DO UPDATE SET '
+            'first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen), '
+            'last_seen = MAX(COALESCE(last_seen, excluded.last_seen), excluded.last_seen)'
+        ))
+        count = conn.execute(text('SELECT COUNT(*) FROM known_players')).scalar()
+    print(f"已知玩家表回填完成，共 {count} 名玩家")
+
+
+def _migration_backfill_dashboard_hourly() -> None:
+    """迁移4：从聊天日志和在线记录回填小时汇总表"""
+    hour_expr = "strftime('%Y-%m-%d %H:00:00.000000', t)"
+    with engine.begin() as conn:
+        conn.execute(text(
+            'INSERT INTO dashboard_hourly (hour, player_name, message_count, first_message_at, online) '
+            f'SELECT {hour_expr}, who_string, COUNT(*), MIN(t), 0 FROM RIA_log_info '
+            f"WHERE who_string IS NOT NULL AND TRIM(who_string) != '' AND t IS NOT NULL "
+            f'GROUP BY {hour_expr}, who_string '
+            'ON CONFLICT(hour, player_name) DO NOTHING'
+        ))
+        conn.execute(text(
+            'INSERT INTO dashboard_hourly (hour, player_name, message_count, first_message_at, online) '
+            f'SELECT DISTINCT {hour_expr}, player_name, 0, NULL, 1 FROM RIA_online '
+            "WHERE player_name IS NOT NULL AND player_name != '' AND t IS NOT NULL "
+            'ON CONFLICT(hour, player_name) DO UPDATE SET online = 1'
+        ))
+        count = conn.execute(text('SELECT COUNT(*) FROM dashboard_hourly')).scalar()
+    print(f"小时汇总表回填完成，共 {count} 行")
+
+
+def raise_sqlite_sequence(conn, table_name: str, value: int) -> None:
+    """把AUTOINCREMENT表的ID序列提高到不小于value（之后插入的行ID一定大于value）
+
+    Args:
+        conn: 数据库连接（在调用方的事务中执行）
+        table_name: 表名
+        value: 序列下限
+    """
+    if not value:
+        return
+    updated = conn.execute(
+        text('UPDATE sqlite_sequence SET seq = MAX(seq, :value) WHERE name = :name'),
+        {'value': value, 'name': table_name}
+    ).rowcount
+    if not updated:
+        conn.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :value)'),
+                     {'name': table_name, 'value': value})
+
+
+def _archived_max_ids() -> Dict[str, int]:
+    """读取日志归档清单中每张表已归档的最大ID"""
+    manifest_path = os.path.join(config.LOG_ARCHIVE_DIR, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    return {table_name: entry.get('max_id', 0) for table_name, entry in manifest.items()}
+
+
+def _migration_log_autoincrement() -> None:
+    """迁移5：日志表改为AUTOINCREMENT主键，ID序列从已归档的最大ID之后开始"""
+    archived = _archived_max_ids()
+    with engine.begin() as conn:
+        for table in (RIALogInfo.__table__, RIALogCommon.__table__):
+            table_sql = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': table.name}
+            ).scalar() or ''
+            if 'AUTOINCREMENT' not in table_sql.upper():
+                # SQLite不能修改主键定义，只能重建表（保留原有ID）
+                columns = ', '.join(f'"{column.name}"' for column in table.columns)
+                for index in table.indexes:
+                    conn.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+                conn.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "{table.name}_old"'))
+                table.create(conn)
+                conn.execute(text(
+                    f'INSERT INTO "{table.name}" ({columns}) SELECT {columns} FROM "{table.name}_old"'
+                ))
+                conn.execute(text(f'DROP TABLE "{table.name}_old"'))
+            max_id = conn.execute(text(f'SELECT MAX(id) FROM "{table.name}"')).scalar() or 0
+            raise_sqlite_sequence(conn, table.name, max(max_id, archived.get(table.name, 0)))
+
+
+def _migration_add_msg_retry_column() -> None:
+    """迁移6：发送队列的重试退避时间，清理已达最大尝试次数的失败消息"""
+    _ensure_columns('RIA_msg_send', {
+        'next_attempt_at': 'DATETIME',
+    })
+    with engine.begin() as conn:
+        removed = conn.execute(
+            text("DELETE FROM RIA_msg_send WHERE status = 'failed' AND attempts >= :max_attempts"),
+            {'max_attempts': config.MSG_QUEUE_MAX_ATTEMPTS}
+        ).rowcount
+    if removed:
+        print(f"已删除 {removed} 条多次发送失败的消息")
+
+
+def _migration_normalize_banned_ips() -> None:
+    """迁移7：封禁表中的IP统一为规范写法，重复条目只保留永久或最晚过期的一条"""
+    with engine.begin() as conn:
+        rows = conn.execute(text('SELECT id, ip_address, expires_at FROM web_banned_ips')).mappings().all()
+        groups: Dict[str, List[Any]] = {}
+        for row in rows:
+            try:
+                groups.setdefault(IPBanList.normalize(row['ip_address']), []).append(row)
+            except ValueError:
+                print(f"忽略格式不正确的封禁记录: {row['ip_address']}")
+        changed = 0
+        for entry, group in groups.items():
+            # 永久封禁优先，其次过期时间最晚
+            keep = max(group, key=lambda row: (row['expires_at'] is None, str(row['expires_at'] or '')))
+            for row in group:
+                if row is not keep:
+                    conn.execute(text('DELETE FROM web_banned_ips WHERE id = :id'), {'id': row['id']})
+                    changed += 1
+            if keep['ip_address'] != entry:
+                conn.execute(text('UPDATE web_banned_ips SET ip_address = :entry WHERE id = :id'),
+                             {'entry': entry, 'id': keep['id']})
+                changed += 1
+    if changed:
+        print(f"已规范化 {changed} 条封禁记录")
+
+
+# 版本化迁移（版本号记录在SQLite的 PRAGMA user_version 中，按顺序只执行一次）
+MIGRATIONS = [
+    (1, _migration_add_queue_and_ban_columns),
+    (2, _migration_add_indexes),
+    (3, _migration_backfill_known_players),
+    (4, _migration_backfill_dashboard_hourly),
+    (5, _migration_log_autoincrement),
+    (6, _migration_add_msg_retry_column),
+    (7, _migration_normalize_banned_ips),
+]
+
+
+def _run_migrations() -> None:
+    """把已存在的数据库升级到最新版本"""
+    with engine.connect() as conn:
+        current_version = conn.execute(text('PRAGMA user_version')).scalar() or 0
+
+    for version, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        print(f"执行数据库迁移 {version}: {migration.__doc__.split('：', 1)[-1]}")
+        migration()
+        with engine.begin() as conn:
+            conn.execute(text(f'PRAGMA user_version = {version}'))
+
+
 # 创建数据库表
 def create_tables():
-    """创建所有数据库表"""
+    """创建所有数据库表并执行未完成的迁移"""
     Base.metadata.create_all(engine)
+    _run_migrations()
     print("数据库表创建完成")
 
 
 # 全局数据库管理器实例
 db_manager = DatabaseManager()
-db_service = DatabaseService(db_manager)
\ No newline at end of file
+db_service = DatabaseService(db_manager)
+
+# 进程退出时兜底刷新日志缓冲
+atexit.register(db_service.close)
\ No newline at end of file
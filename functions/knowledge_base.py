@@ -0,0 +1,236 @@
+"""AI知识库模块
+
+从知识库数据文件（JSON）和数据库 knowledge_entries 表加载参考条目，
+旧的 keyword_in_communication.keys 也作为一个来源合并进来。
+所有关键词编译为一个Aho-Corasick自动机，并建立关键词到条目的倒排索引：
+每条私聊只扫描一遍，按命中条目排序后在字数预算内选出参考内容。
+数据文件或数据表变化后自动重新加载，无需重启机器人。
+
+数据文件格式（二选一）：
+    [{"keywords": ["关键词1", "关键词2"], "content": "参考内容", "priority": 0}, ...]
+    {"关键词": "参考内容", ...}
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from .config import config
+from .database import engine, KnowledgeEntry
+from .utils import AhoCorasick
+
+
+class KnowledgeItem:
+    """一条知识库条目"""
+    __slots__ = ('keywords', 'content', 'priority', 'source')
+
+    def __init__(self, keywords: List[str], content: str, priority: int = 0, source: str = ''):
+        self.keywords = keywords
+        self.content = content
+        self.priority = priority
+        self.source = source
+
+
+class KnowledgeIndex:
+    """知识库条目的只读索引（重新加载时整体替换）"""
+
+    def __init__(self, items: List[KnowledgeItem]):
+        self.items = items
+        # 小写关键词 -> 包含该关键词的条目序号（倒排索引）
+        self.postings: Dict[str, List[int]] = {}
+        for item_id, item in enumerate(items):
+            for keyword in item.keywords:
+                postings = self.postings.setdefault(keyword.lower(), [])
+                if item_id not in postings:
+                    postings.append(item_id)
+        self.matcher = AhoCorasick([(keyword, keyword) for keyword in self.postings]).build()
+
+    def search(self, text: str) -> List[Tuple[KnowledgeItem, str]]:
+        """查找文本命中的条目并排序
+
+        排序依据：优先级 > 命中关键词的总长度 > 首次命中位置。
+
+        Returns:
+            [(条目, 首个命中的关键词)]
+        """
+        # 条目序号 -> [命中关键词集合, 首次命中位置, 首个命中的关键词]
+        hits: Dict[int, List[Any]] = {}
+        for start, _, keyword in self.matcher.iter(text.lower()):
+            for item_id in self.postings[keyword]:
+                hit = hits.get(item_id)
+                if hit is None:
+                    hits[item_id] = [{keyword}, start, keyword]
+                else:
+                    hit[0].add(keyword)
+
+        def rank(item_id: int) -> Tuple[int, int, int]:
+            keywords, first_pos, _ = hits[item_id]
+            return -self.items[item_id].priority, -sum(len(k) for k in keywords), first_pos
+
+        results = []
+        for item_id in sorted(hits, key=rank):
+            item = self.items[item_id]
+            first_keyword = hits[item_id][2]
+            # 返回条目中原始大小写的关键词
+            display = next((k for k in item.keywords if k.lower() == first_keyword), first_keyword)
+            results.append((item, display))
+        return results
+
+
+class KnowledgeBase:
+    """AI知识库"""
+
+    def __init__(self, file_path: str = None, budget: int = None, max_entries: int = None,
+                 reload_interval: float = None):
+        self.file_path = file_path or config.KNOWLEDGE_BASE_PATH
+        self.budget = budget or config.KNOWLEDGE_BASE_BUDGET
+        self.max_entries = max_entries or config.KNOWLEDGE_BASE_MAX_ENTRIES
+        self.reload_interval = reload_interval if reload_interval is not None else config.KNOWLEDGE_BASE_RELOAD_INTERVAL
+        self._index: Optional[KnowledgeIndex] = None
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _file_signature(self) -> Optional[Tuple[float, int]]:
+        """数据文件的修改时间和大小"""
+        try:
+            stat = os.stat(self.file_path)
+            return stat.st_mtime, stat.st_size
+        except OSError:
+            return None
+
+    @staticmethod
+    def _table_signature() -> Optional[Tuple[int, Any]]:
+        """数据表的行数和最后更新时间"""
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                return tuple(temp_session.execute(
+                    select(func.count(KnowledgeEntry.id), func.max(KnowledgeEntry.updated_at))
+                ).one())
+            finally:
+                temp_session.close()
+        except Exception:
+            return None
+
+    def _load_file(self) -> List[KnowledgeItem]:
+        """从数据文件加载条目"""
+        if not os.path.exists(self.file_path):
+            return []
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [{'keywords': [keyword], 'content': content} for keyword, content in data.items()]
+        items = []
+        for record in data:
+            keywords = record.get('keywords') or record.get('keyword') or []
+            if isinstance(keywords, str):
+                keywords = [keywords]
+            keywords = [k.strip() for k in keywords if k and k.strip()]
+            content = record.get('content', '')
+            if keywords and content:
+                items.append(KnowledgeItem(keywords, content, int(record.get('priority', 0)), 'file'))
+        return items
+
+    @staticmethod
+    def _load_table() -> List[KnowledgeItem]:
+        """从数据表加载条目"""
+        temp_session = Session(bind=engine)
+        try:
+            rows = temp_session.execute(
+                select(KnowledgeEntry.keywords, KnowledgeEntry.content, KnowledgeEntry.priority)
+            ).all()
+        finally:
+            temp_session.close()
+        items = []
+        for keywords, content, priority in rows:
+            keyword_list = [k.strip() for k in (keywords or '').split(',') if k.strip()]
+            if keyword_list and content:
+                items.append(KnowledgeItem(keyword_list, content, priority or 0, 'table'))
+        return items
+
+    @staticmethod
+    def _load_legacy() -> List[KnowledgeItem]:
+        """从旧的 keyword_in_communication.keys 加载条目（内容相同的关键词合并为一条）"""
+        from .keyword_in_communication import keys
+        by_content: Dict[str, List[str]] = {}
+        for keyword, content in keys.items():
+            keywords = by_content.setdefault(content, [])
+            if keyword.lower() not in (k.lower() for k in keywords):
+                keywords.append(keyword)
+        return [KnowledgeItem(keywords, content, 0, 'legacy') for content, keywords in by_content.items()]
+
+    def reload(self) -> int:
+        """重新加载所有来源并重建索引
+
+        Returns:
+            条目数量
+        """
+        with self._lock:
+            signature = (self._file_signature(), self._table_signature())
+            items = []
+            for source, loader in (('数据文件', self._load_file), ('数据表', self._load_table),
+                                   ('关键词模块', self._load_legacy)):
+                try:
+                    items.extend(loader())
+                except Exception as e:
+                    print(f"加载知识库{source}失败: {e}")
+            self._index = KnowledgeIndex(items)
+            self._signature = signature
+            self._last_check = time.monotonic()
+            return len(items)
+
+    def _maybe_reload(self) -> None:
+        """数据文件或数据表变化时重新加载（按间隔节流）"""
+        if self._index is None:
+            self.reload()
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        if (self._file_signature(), self._table_signature()) != self._signature:
+            count = self.reload()
+            print(f"知识库已重新加载，共 {count} 条")
+
+    def search(self, text: str) -> List[Tuple[KnowledgeItem, str]]:
+        """查找文本命中的全部条目（已排序）"""
+        self._maybe_reload()
+        return self._index.search(text)
+
+    def lookup(self, text: str, budget: int = None, max_entries: int = None) -> Dict[str, str]:
+        """查找文本相关的参考内容
+
+        按排序依次选取条目，跳过放不进剩余字数预算的条目。
+
+        Args:
+            text: 玩家消息
+            budget: 参考内容总字数上限，默认取配置
+            max_entries: 条目数上限，默认取配置
+
+        Returns:
+            关键词到参考内容的映射（可直接作为main_ai的reference参数）
+        """
+        remaining = budget or self.budget
+        max_entries = max_entries or self.max_entries
+        reference = {}
+        for item, keyword in self.search(text):
+            if len(reference) >= max_entries:
+                break
+            if len(item.content) > remaining:
+                continue
+            # 不同条目命中同一个关键词时合并内容
+            reference[keyword] = f'{reference[keyword]}\n{item.content}' if keyword in reference else item.content
+            remaining -= len(item.content)
+        return reference
+
+    def __len__(self) -> int:
+        self._maybe_reload()
+        return len(self._index.items)
+
+
+# 全局知识库实例
+knowledge_base = KnowledgeBase()
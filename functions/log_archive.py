@@ -0,0 +1,256 @@
+"""日志归档模块
+
+把超过保留期限的聊天日志和通用日志按月写入gzip压缩的NDJSON归档文件，
+再从数据库中分批删除。历史日志查询在数据库查不到时透明地读取归档。
+"""
+
+import datetime
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+from .config import config
+from .database import engine, raise_sqlite_sequence, RIALogInfo, RIALogCommon
+from .log_cache import ChatLogEntry, CommonLogEntry
+
+
+class LogArchiver:
+    """日志归档器
+
+    归档目录结构：
+        <ARCHIVE_DIR>/<表名>/<YYYY-MM>.ndjson.gz  每行一条日志的JSON（每批追加一个gzip成员）
+        <ARCHIVE_DIR>/manifest.json               每张表已归档的最大ID，每个文件的ID范围和有效字节数
+
+    每批先追加写入归档文件，再更新清单，最后删除数据库中的行：
+    - 写文件后、更新清单前中断：文件尾部超出清单记录字节数的部分无效，下次追加前截掉，读取时也忽略；
+    - 更新清单后、删除前中断：ID不大于清单记录的行视为已归档，下次运行只删除不重复写入。
+    日志表使用AUTOINCREMENT主键，ID不会复用，上述判断才成立。
+    """
+
+    # 表名 -> (模型, 缓存记录类, 保留天数配置项, 序列化字段)
+    TABLES = {
+        RIALogInfo.__tablename__: (RIALogInfo, ChatLogEntry, 'CHAT_LOG_RETENTION_DAYS',
+                                   ('id', 'who_string', 'log_string', 't')),
+        RIALogCommon.__tablename__: (RIALogCommon, CommonLogEntry, 'COMMON_LOG_RETENTION_DAYS',
+                                     ('id', 'log_string', 't')),
+    }
+
+    def __init__(self, archive_dir: str = None, batch_size: int = None):
+        self.archive_dir = archive_dir or config.LOG_ARCHIVE_DIR
+        self.batch_size = batch_size or config.LOG_ARCHIVE_BATCH_SIZE
+        self.manifest_path = os.path.join(self.archive_dir, 'manifest.json')
+        self._archive_lock = threading.Lock()  # 同一时间只有一次归档在运行
+        self._lock = threading.Lock()  # 保护归档文件缓存
+        self._file_cache: "OrderedDict[Tuple[str, Optional[int]], List[Any]]" = OrderedDict()  # (文件, 有效字节数) -> 记录
+        self._file_cache_size = 4
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        """读取归档清单（清单总是被原子替换，读到的一定是完整的快照）"""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        """原子地写入归档清单"""
+        temp_path = f'{self.manifest_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.manifest_path)
+
+    @staticmethod
+    def _serialize(row: Any, fields) -> str:
+        """把一行日志序列化为JSON行"""
+        record = {}
+        for field in fields:
+            value = getattr(row, field)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat(' ')
+            record[field] = value
+        return json.dumps(record, ensure_ascii=False)
+
+    @staticmethod
+    def _append_member(path: str, committed_size: int, lines: List[str]) -> int:
+        """截掉文件中未记入清单的尾部，再追加一个gzip成员
+
+        Args:
+            path: 归档文件路径
+            committed_size: 清单记录的有效字节数
+            lines: 要写入的JSON行
+
+        Returns:
+            写入后的文件大小
+        """
+        data = gzip.compress(''.join(line + '\n' for line in lines).encode('utf-8'))
+        with open(path, 'ab') as f:
+            f.truncate(committed_size)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def archive_table(self, table_name: str, days_to_keep: Optional[int] = None) -> int:
+        """归档一张表中超过保留期限的日志
+
+        Args:
+            table_name: 表名
+            days_to_keep: 保留天数，默认取配置
+
+        Returns:
+            归档（并删除）的行数
+        """
+        model, _, retention_key, fields = self.TABLES[table_name]
+        if days_to_keep is None:
+            days_to_keep = getattr(config, retention_key)
+        if days_to_keep <= 0:
+            return 0
+        cutoff = datetime.datetime.combine(
+            datetime.date.today() - datetime.timedelta(days=days_to_keep), datetime.time.min
+        )
+        table_dir = os.path.join(self.archive_dir, table_name)
+        os.makedirs(table_dir, exist_ok=True)
+
+        archived = 0
+        with self._archive_lock:
+            manifest = self._load_manifest()
+            table_manifest = manifest.setdefault(table_name, {'max_id': 0, 'files': {}})
+            # 兜底：保证新日志的ID大于已归档的ID
+            with engine.begin() as conn:
+                raise_sqlite_sequence(conn, table_name, table_manifest['max_id'])
+
+            while True:
+                temp_session = Session(bind=engine)
+                try:
+                    rows = (temp_session.query(model)
+                            .filter(model.t < cutoff)
+                            .order_by(model.id)
+                            .limit(self.batch_size)
+                            .all())
+                    if not rows:
+                        break
+
+                    # 按月分组写入归档文件（已归档但未删除的行跳过写入）
+                    by_month: Dict[str, List[Any]] = {}
+                    for row in rows:
+                        if row.id <= table_manifest['max_id']:
+                            continue
+                        by_month.setdefault(row.t.strftime('%Y-%m'), []).append(row)
+                    for month, month_rows in by_month.items():
+                        file_name = f'{month}.ndjson.gz'
+                        file_path = os.path.join(table_dir, file_name)
+                        entry = table_manifest['files'].get(month)
+                        if entry is None:
+                            committed_size = 0
+                        else:
+                            # 旧版本清单没有记录字节数，按当前文件大小计
+                            committed_size = entry.get('size', os.path.getsize(file_path))
+                        size = self._append_member(file_path, committed_size,
+                                                   [self._serialize(row, fields) for row in month_rows])
+                        entry = table_manifest['files'].setdefault(
+                            month, {'path': f'{table_name}/{file_name}', 'min_id': month_rows[0].id,
+                                    'max_id': month_rows[0].id, 'rows': 0}
+                        )
+                        entry['min_id'] = min(entry['min_id'], month_rows[0].id)
+                        entry['max_id'] = max(entry['max_id'], month_rows[-1].id)
+                        entry['rows'] += len(month_rows)
+                        entry['size'] = size
+                    table_manifest['max_id'] = max(table_manifest['max_id'], rows[-1].id)
+                    self._save_manifest(manifest)
+
+                    ids = [row.id for row in rows]
+                    temp_session.execute(delete(model).where(model.id.in_(ids)))
+                    temp_session.commit()
+                    archived += len(ids)
+                finally:
+                    temp_session.close()
+
+        if archived:
+            print(f"已归档 {table_name} 中 {archived} 条 {cutoff:%Y-%m-%d} 之前的日志")
+        return archived
+
+    def run(self) -> Dict[str, int]:
+        """归档所有日志表
+
+        Returns:
+            表名到归档行数的映射
+        """
+        results = {}
+        for table_name in self.TABLES:
+            try:
+                results[table_name] = self.archive_table(table_name)
+            except Exception as e:
+                print(f"归档 {table_name} 失败: {e}")
+                results[table_name] = 0
+        return results
+
+    def _read_file(self, table_name: str, path: str, size: Optional[int]) -> List[Any]:
+        """读取归档文件中清单记录的有效部分（带最近使用缓存），返回按ID升序的缓存记录"""
+        key = (path, size)
+        with self._lock:
+            cached = self._file_cache.get(key)
+            if cached is not None:
+                self._file_cache.move_to_end(key)
+                return cached
+
+        _, entry_cls, _, fields = self.TABLES[table_name]
+        with open(os.path.join(self.archive_dir, path), 'rb') as f:
+            data = f.read() if size is None else f.read(size)
+        entries = []
+        for line in gzip.decompress(data).decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('t'):
+                record['t'] = datetime.datetime.fromisoformat(record['t'])
+            entries.append(entry_cls(*(record.get(field) for field in fields)))
+        entries.sort(key=lambda entry: entry.id)
+
+        with self._lock:
+            self._file_cache[key] = entries
+            while len(self._file_cache) > self._file_cache_size:
+                self._file_cache.popitem(last=False)
+        return entries
+
+    def before(self, model, min_id: int, limit: int) -> List[Any]:
+        """从归档中读取ID小于min_id的最新若干条日志（ID降序）
+
+        基于清单快照读取，不等待正在进行的归档。
+
+        Args:
+            model: 日志模型（RIALogInfo或RIALogCommon）
+            min_id: ID上界（不包含）
+            limit: 最大条数
+
+        Returns:
+            缓存记录列表（与ChatLogEntry/CommonLogEntry相同的接口）
+        """
+        table_name = model.__tablename__
+        if table_name not in self.TABLES or limit <= 0:
+            return []
+        try:
+            manifest = self._load_manifest()
+            files = sorted(manifest.get(table_name, {}).get('files', {}).values(),
+                           key=lambda entry: entry['max_id'], reverse=True)
+            results = []
+            for entry in files:
+                if entry['min_id'] >= min_id:
+                    continue
+                older = [log for log in self._read_file(table_name, entry['path'], entry.get('size'))
+                         if log.id < min_id]
+                results.extend(reversed(older[-(limit - len(results)):]))
+                if len(results) >= limit:
+                    break
+            return results
+        except Exception as e:
+            print(f"读取归档日志失败: {e}")
+            return []
+
+
+# 全局日志归档器实例
+log_archiver = LogArchiver()
@@ -0,0 +1,209 @@
+"""最近日志缓存模块
+
+在Web进程内用有界环形缓冲保存最近的聊天日志和通用日志，
+页面渲染和Socket.IO增量推送直接从内存读取，只有更早的历史才查询数据库。
+"""
+
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional
+from sqlalchemy.orm import Session
+from .config import config
+from .database import engine, RIALogInfo, RIALogCommon
+
+
+class ChatLogEntry:
+    """聊天日志缓存记录"""
+    __slots__ = ('id', 'who_string', 'log_string', 't')
+
+    def __init__(self, id: int, who_string: str, log_string: str, t):
+        self.id = id
+        self.who_string = who_string
+        self.log_string = log_string
+        self.t = t
+
+    @classmethod
+    def from_model(cls, log: RIALogInfo) -> 'ChatLogEntry':
+        return cls(log.id, log.who_string, log.log_string, log.t)
+
+    def to_dict(self) -> dict:
+        """转换为字典格式（与RIALogInfo.to_dict一致）"""
+        return {
+            'id': self.id,
+            'who_string': self.who_string,
+            'log_string': self.log_string,
+            't': self.t.strftime("%H:%M") if self.t else None
+        }
+
+
+class CommonLogEntry:
+    """通用日志缓存记录"""
+    __slots__ = ('id', 'log_string', 't')
+
+    def __init__(self, id: int, log_string: str, t):
+        self.id = id
+        self.log_string = log_string
+        self.t = t
+
+    @classmethod
+    def from_model(cls, log: RIALogCommon) -> 'CommonLogEntry':
+        return cls(log.id, log.log_string, log.t)
+
+    def to_dict(self) -> dict:
+        """转换为字典格式（与RIALogCommon.to_dict一致）"""
+        return {
+            'id': self.id,
+            'log_string': self.log_string,
+            't': self.t.strftime("%H:%M") if self.t else None
+        }
+
+
+class RecentLogBuffer:
+    """单张日志表的有界环形缓冲
+
+    缓冲按ID升序保存最近的记录，并记录“下界”floor：ID大于floor的记录全部在缓冲中。
+    查询能否由缓冲回答取决于这个下界，回答不了时返回None，由调用方查询数据库。
+    """
+
+    def __init__(self, model, entry_cls, capacity: int):
+        self.model = model
+        self.entry_cls = entry_cls
+        self.capacity = capacity
+        self._entries = deque(maxlen=capacity)
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def load(self, session: Session) -> int:
+        """从数据库加载最近的记录
+
+        Args:
+            session: 数据库会话
+
+        Returns:
+            加载的记录数
+        """
+        logs = (session.query(self.model)
+                .order_by(self.model.id.desc())
+                .limit(self.capacity)
+                .all())
+        entries = [self.entry_cls.from_model(log) for log in reversed(logs)]
+        with self._lock:
+            self._entries.clear()
+            self._entries.extend(entries)
+            # 未装满说明整张表都在缓冲中
+            self._floor = entries[0].id - 1 if len(entries) >= self.capacity else 0
+        return len(entries)
+
+    def extend(self, logs: List[Any]) -> List[Any]:
+        """追加新记录（需按ID升序），忽略已缓存的记录
+
+        Args:
+            logs: 新的日志对象
+
+        Returns:
+            实际追加的缓存记录
+        """
+        added = []
+        with self._lock:
+            last_id = self._entries[-1].id if self._entries else self._floor
+            for log in logs:
+                if log.id <= last_id:
+                    continue
+                if len(self._entries) == self.capacity:
+                    self._floor = self._entries[0].id
+                entry = self.entry_cls.from_model(log)
+                self._entries.append(entry)
+                added.append(entry)
+                last_id = log.id
+        return added
+
+    @property
+    def max_id(self) -> int:
+        """缓冲中最大的ID，空缓冲时为下界"""
+        with self._lock:
+            return self._entries[-1].id if self._entries else self._floor
+
+    def newest(self, limit: int) -> List[Any]:
+        """获取最新的若干条记录（ID升序）"""
+        with self._lock:
+            return list(self._entries)[-limit:] if limit > 0 else []
+
+    def after(self, max_id: int, limit: int) -> Optional[List[Any]]:
+        """获取ID大于max_id的最新若干条记录（ID升序）
+
+        Returns:
+            记录列表，缓冲无法完整回答时返回None
+        """
+        with self._lock:
+            newer = [entry for entry in self._entries if entry.id > max_id]
+            if len(newer) < limit and max_id < self._floor:
+                return None
+            return newer[-limit:]
+
+    def before(self, min_id: int, limit: int) -> Optional[List[Any]]:
+        """获取ID小于min_id的最新若干条记录（ID降序）
+
+        Returns:
+            记录列表，缓冲无法完整回答时返回None
+        """
+        with self._lock:
+            older = [entry for entry in self._entries if entry.id < min_id]
+            if len(older) < limit and self._floor > 0:
+                return None
+            return list(reversed(older[-limit:]))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RecentLogCache:
+    """进程级最近日志缓存，包含聊天日志和通用日志两个环形缓冲"""
+
+    def __init__(self, capacity: int = None):
+        capacity = capacity or config.LOG_CACHE_SIZE
+        self.chat = RecentLogBuffer(RIALogInfo, ChatLogEntry, capacity)
+        self.common = RecentLogBuffer(RIALogCommon, CommonLogEntry, capacity)
+        self.loaded = False
+
+    def buffers(self) -> Dict[str, RecentLogBuffer]:
+        """频道名到缓冲的映射"""
+        return {'chat': self.chat, 'common': self.common}
+
+    def load(self) -> None:
+        """启动时从数据库填充缓存"""
+        temp_session = Session(bind=engine)
+        try:
+            chat_count = self.chat.load(temp_session)
+            common_count = self.common.load(temp_session)
+            self.loaded = True
+            print(f"最近日志缓存已加载：聊天 {chat_count} 条，通用 {common_count} 条")
+        finally:
+            temp_session.close()
+
+    def follow(self, buffer: RecentLogBuffer, session: Session, batch_limit: int = 100) -> List[Any]:
+        """追踪表的最大ID，把新写入的记录追加到缓冲
+
+        Args:
+            buffer: 要更新的缓冲
+            session: 数据库会话
+            batch_limit: 单次查询的最大条数
+
+        Returns:
+            新追加的缓存记录
+        """
+        if not self.loaded:
+            return []
+        added = []
+        while True:
+            logs = (session.query(buffer.model)
+                    .filter(buffer.model.id > buffer.max_id)
+                    .order_by(buffer.model.id)
+                    .limit(batch_limit)
+                    .all())
+            added.extend(buffer.extend(logs))
+            if len(logs) < batch_limit:
+                return added
+
+
+# 全局最近日志缓存实例（由Web服务器加载）
+recent_log_cache = RecentLogCache()
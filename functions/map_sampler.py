@@ -0,0 +1,134 @@
+"""地图API采样模块
+
+封装卫星地图API的玩家列表查询：复用HTTP连接、设置超时，
+在新鲜度窗口内直接返回缓存结果。缓存只在同一进程内共享（机器人进程内的在线采样、
+在线检查等调用方）；cicd.py 以子进程方式启动 mc.py，两个进程各有自己的采样器实例。
+"""
+
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import requests
+from .config import config
+
+
+class MapSnapshot:
+    """一次地图API查询结果"""
+    __slots__ = ('players', 'version', 'fetched_at')
+
+    def __init__(self, players: List[Dict[str, Any]], version: int, fetched_at: float):
+        self.players = players
+        self.version = version  # 玩家集合或位置变化时递增
+        self.fetched_at = fetched_at
+
+
+class MapSampler:
+    """地图API采样器"""
+
+    HEADERS = {
+        'authority': 'satellite.ria.red',
+        'sec-ch-ua': '" Not A;Brand";v="99", "Chromium";v="99"',
+        'sec-ch-ua-mobile': '?0',
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.84 Safari/537.36 HBPC/12.1.3.310',
+        'sec-ch-ua-platform': '"Windows"',
+        'accept': '*/*',
+        'sec-fetch-site': 'same-origin',
+        'sec-fetch-mode': 'cors',
+        'sec-fetch-dest': 'empty',
+        'referer': 'https://satellite.ria.red/map/zth',
+        'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8',
+    }
+
+    def __init__(self, api_url: str = None, freshness: float = None, timeout: float = None):
+        self.api_url = api_url if api_url is not None else config.MAP_API
+        self.freshness = freshness if freshness is not None else config.MAP_SAMPLER_FRESHNESS
+        self.timeout = timeout or config.MAP_SAMPLER_TIMEOUT
+        self._http = None
+        self._lock = threading.Lock()
+        self._snapshot: Optional[MapSnapshot] = None
+        self._signature = None
+
+    def _session(self) -> requests.Session:
+        """获取复用的HTTP会话"""
+        if self._http is None:
+            self._http = requests.Session()
+            self._http.headers.update(self.HEADERS)
+        return self._http
+
+    @staticmethod
+    def _signature_of(players: List[Dict[str, Any]]) -> Tuple:
+        """玩家集合及位置的签名，用于判断是否有变化"""
+        return tuple(sorted(
+            (player.get('account', ''),
+             *(round(value, 1) if isinstance(value, (int, float)) else value
+               for value in (player.get(key) for key in ('x', 'y', 'z', 'armor', 'health'))))
+            for player in players
+        ))
+
+    def _request(self) -> Optional[List[Dict[str, Any]]]:
+        """向地图API发起一次请求
+
+        Returns:
+            玩家列表，失败时返回None
+        """
+        # 地图API的路径以毫秒时间戳结尾（防缓存），每次请求的URL都不同，无法使用条件请求
+        timestamp = int(time.time() * 1000)
+        response = self._session().get(f'{self.api_url}/{timestamp}', timeout=self.timeout)
+        if response.status_code != 200:
+            return None
+        return response.json().get('players', [])
+
+    def snapshot(self, max_age: Optional[float] = None) -> Optional[MapSnapshot]:
+        """获取玩家列表快照，缓存未过期时不发起请求
+
+        Args:
+            max_age: 可接受的最大缓存时间（秒），默认取新鲜度窗口
+
+        Returns:
+            快照，未配置地图API或请求失败时返回None
+        """
+        if not self.api_url:  # 如果没有配置地图API，则不进行操作
+            return None
+        max_age = self.freshness if max_age is None else max_age
+
+        with self._lock:
+            now = time.time()
+            if self._snapshot is not None and now - self._snapshot.fetched_at <= max_age:
+                return self._snapshot
+            try:
+                players = self._request()
+            except (requests.RequestException, ValueError) as e:
+                print(f"查询地图API失败: {e}")
+                return None
+            if players is None:
+                return None
+
+            version = self._snapshot.version if self._snapshot else 0
+            signature = self._signature_of(players)
+            if signature != self._signature:
+                self._signature = signature
+                version += 1
+            self._snapshot = MapSnapshot(players, version, now)
+            return self._snapshot
+
+    def get_players(self, max_age: Optional[float] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """获取当前在线玩家
+
+        Returns:
+            (玩家列表, 是否成功)
+        """
+        snapshot = self.snapshot(max_age)
+        if snapshot is None:
+            return [], False
+        return snapshot.players, True
+
+    def close(self) -> None:
+        """关闭HTTP会话"""
+        with self._lock:
+            if self._http is not None:
+                self._http.close()
+                self._http = None
+
+
+# 全局地图采样器实例（仅在本进程内共享）
+map_sampler = MapSampler()
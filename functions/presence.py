@@ -0,0 +1,246 @@
+"""玩家在线时段模块
+
+根据机器人收到的玩家加入/离开事件记录每个玩家的在线时段，
+登录和定期检查时与 bot.players 对账，补上漏掉的事件。
+在线时段可以直接算出精确到分钟的同时在线人数曲线和每个玩家的在线时长。
+"""
+
+import datetime
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.orm import Session
+from .database import engine, PlayerSession, RIALogCommon
+
+
+class PresenceTracker:
+    """玩家在线时段跟踪器"""
+
+    def __init__(self):
+        self._open_sessions: Dict[str, int] = {}  # 玩家名 -> 未结束的时段ID
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._recovered = False
+        self._started_at = datetime.datetime.now()
+
+    def _ensure_loaded(self) -> None:
+        """从数据库加载未结束的时段（调用方持有锁）
+
+        首次加载时，上次运行遗留的时段没有收到离开事件，
+        统一按本次启动前最后一条通用日志的时间结束，在线的玩家随后由对账重新开始时段。
+        """
+        if self._loaded:
+            return
+        temp_session = Session(bind=engine)
+        try:
+            if not self._recovered:
+                last_alive = temp_session.execute(
+                    select(func.max(RIALogCommon.t)).where(RIALogCommon.t < self._started_at)
+                ).scalar()
+                result = temp_session.execute(
+                    update(PlayerSession)
+                    .where(and_(PlayerSession.left_at.is_(None), PlayerSession.joined_at < self._started_at))
+                    .values(left_at=func.max(PlayerSession.joined_at, last_alive or self._started_at),
+                            end_reason='restart')
+                )
+                temp_session.commit()
+                self._recovered = True
+                if result.rowcount:
+                    print(f"已结束上次运行遗留的 {result.rowcount} 个玩家在线时段")
+            rows = temp_session.execute(
+                select(PlayerSession.id, PlayerSession.player_name).where(PlayerSession.left_at.is_(None))
+            ).all()
+        finally:
+            temp_session.close()
+        self._open_sessions = {row.player_name: row.id for row in rows}
+        self._loaded = True
+
+    def _close(self, session: Session, names: Iterable[str], left_at: datetime.datetime, reason: str) -> None:
+        """结束指定玩家的时段（调用方持有锁）"""
+        ids = [self._open_sessions.pop(name) for name in names if name in self._open_sessions]
+        if ids:
+            session.execute(
+                update(PlayerSession)
+                .where(PlayerSession.id.in_(ids))
+                .values(left_at=func.max(PlayerSession.joined_at, left_at), end_reason=reason)
+            )
+
+    def _open(self, session: Session, names: Iterable[str], joined_at: datetime.datetime) -> None:
+        """为指定玩家开始新时段（调用方持有锁）"""
+        for name in names:
+            if name in self._open_sessions:
+                continue
+            record = PlayerSession(player_name=name, joined_at=joined_at)
+            session.add(record)
+            session.flush()
+            self._open_sessions[name] = record.id
+
+    def player_joined(self, player_name: str, at: Optional[datetime.datetime] = None) -> None:
+        """记录玩家加入
+
+        Args:
+            player_name: 玩家名字
+            at: 加入时间，默认当前时间
+        """
+        if not player_name:
+            return
+        try:
+            with self._lock:
+                self._ensure_loaded()
+                if player_name in self._open_sessions:
+                    return
+                temp_session = Session(bind=engine)
+                try:
+                    self._open(temp_session, [player_name], at or datetime.datetime.now())
+                    temp_session.commit()
+                finally:
+                    temp_session.close()
+        except Exception as e:
+            self._loaded = False
+            print(f"记录玩家加入失败: {e}")
+
+    def player_left(self, player_name: str, at: Optional[datetime.datetime] = None,
+                    reason: str = 'left') -> None:
+        """记录玩家离开
+
+        Args:
+            player_name: 玩家名字
+            at: 离开时间，默认当前时间
+            reason: 结束原因
+        """
+        if not player_name:
+            return
+        try:
+            with self._lock:
+                self._ensure_loaded()
+                if player_name not in self._open_sessions:
+                    return
+                temp_session = Session(bind=engine)
+                try:
+                    self._close(temp_session, [player_name], at or datetime.datetime.now(), reason)
+                    temp_session.commit()
+                finally:
+                    temp_session.close()
+        except Exception as e:
+            self._loaded = False
+            print(f"记录玩家离开失败: {e}")
+
+    def reconcile(self, online_names: Iterable[str], at: Optional[datetime.datetime] = None) -> Tuple[int, int]:
+        """与当前在线玩家列表对账
+
+        不在列表中的未结束时段被结束，列表中没有时段的玩家开始新时段。
+
+        Args:
+            online_names: 当前在线的玩家名
+            at: 对账时间，默认当前时间
+
+        Returns:
+            (新开始的时段数, 被结束的时段数)
+        """
+        at = at or datetime.datetime.now()
+        online = {name for name in online_names if name}
+        try:
+            with self._lock:
+                self._ensure_loaded()
+                temp_session = Session(bind=engine)
+                try:
+                    stale = [name for name in self._open_sessions if name not in online]
+                    self._close(temp_session, stale, at, 'reconcile')
+                    joined = [name for name in online if name not in self._open_sessions]
+                    self._open(temp_session, joined, at)
+                    temp_session.commit()
+                finally:
+                    temp_session.close()
+            return len(joined), len(stale)
+        except Exception as e:
+            self._loaded = False
+            print(f"对账玩家在线时段失败: {e}")
+            return 0, 0
+
+    def close_all(self, reason: str = 'offline', at: Optional[datetime.datetime] = None) -> int:
+        """结束所有未结束的时段（机器人下线时调用，此后无法观察到玩家）
+
+        Returns:
+            结束的时段数
+        """
+        try:
+            with self._lock:
+                self._ensure_loaded()
+                names = list(self._open_sessions)
+                temp_session = Session(bind=engine)
+                try:
+                    self._close(temp_session, names, at or datetime.datetime.now(), reason)
+                    temp_session.commit()
+                finally:
+                    temp_session.close()
+            return len(names)
+        except Exception as e:
+            self._loaded = False
+            print(f"结束玩家在线时段失败: {e}")
+            return 0
+
+    @property
+    def online_count(self) -> int:
+        """当前有未结束时段的玩家数"""
+        return len(self._open_sessions)
+
+    @staticmethod
+    def _sessions_between(start: datetime.datetime,
+                          end: datetime.datetime) -> List[Tuple[str, datetime.datetime, datetime.datetime]]:
+        """读取与时间范围有交集的时段，并裁剪到范围内"""
+        now = datetime.datetime.now()
+        temp_session = Session(bind=engine)
+        try:
+            rows = temp_session.execute(
+                select(PlayerSession.player_name, PlayerSession.joined_at, PlayerSession.left_at)
+                .where(and_(
+                    PlayerSession.joined_at < end,
+                    or_(PlayerSession.left_at.is_(None), PlayerSession.left_at > start)
+                ))
+            ).all()
+        finally:
+            temp_session.close()
+        clipped = []
+        for name, joined_at, left_at in rows:
+            begin = max(joined_at, start)
+            finish = min(left_at or min(now, end), end)
+            if finish > begin:
+                clipped.append((name, begin, finish))
+        return clipped
+
+    def concurrency_curve(self, start: datetime.datetime, end: datetime.datetime,
+                          step_minutes: int = 1) -> List[int]:
+        """计算时间范围内每个时间片的同时在线人数（时间片内出现过的不同玩家数）
+
+        Args:
+            start: 开始时间
+            end: 结束时间
+            step_minutes: 时间片长度（分钟）
+
+        Returns:
+            每个时间片的在线人数
+        """
+        step = datetime.timedelta(minutes=step_minutes)
+        buckets = max(0, -(-int((end - start) / datetime.timedelta(seconds=1)) // int(step.total_seconds())))
+        players_per_bucket: List[set] = [set() for _ in range(buckets)]
+        for name, begin, finish in self._sessions_between(start, end):
+            first = int((begin - start) / step)
+            last = min(buckets - 1, int((finish - start - datetime.timedelta(microseconds=1)) / step))
+            for index in range(first, last + 1):
+                players_per_bucket[index].add(name)
+        return [len(players) for players in players_per_bucket]
+
+    def playtime(self, start: datetime.datetime, end: datetime.datetime) -> Dict[str, int]:
+        """计算时间范围内每个玩家的在线时长
+
+        Returns:
+            玩家名到在线秒数的映射，按时长降序
+        """
+        totals: Dict[str, float] = {}
+        for name, begin, finish in self._sessions_between(start, end):
+            totals[name] = totals.get(name, 0) + (finish - begin).total_seconds()
+        return {name: int(seconds) for name, seconds in sorted(totals.items(), key=lambda x: x[1], reverse=True)}
+
+
+# 全局玩家在线时段跟踪器实例（由机器人进程写入）
+presence_tracker = PresenceTracker()
@@ -3,13 +3,17 @@
 处理每日仪表板数据，包括在线人数变化曲线和玩家发言统计
 """
 
+import argparse
 import datetime
+import hashlib
+import json
 import sys
 import os
 from typing import Dict, List, Optional, Tuple
 from collections import defaultdict
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy import Integer, and_, cast, delete, distinct, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # 添加项目根目录到 Python 路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -17,15 +21,21 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
 try:
     # 尝试相对导入（当作为模块导入时）
     from ..database import (
-        engine, RIALogInfo, RIAOnline, DashboardDaily, 
-        DatabaseManager, DatabaseService
+        engine, RIALogInfo, RIAOnline, DashboardDaily, DashboardHourly, OnlineSample,
+        DatabaseManager, DatabaseService, iter_online_presence
     )
+    from ..config import config
+    from ..utils import TTLCache
+    from ..presence import presence_tracker
 except ImportError:
     # 如果相对导入失败，使用绝对导入（当直接运行时）
     from functions.database import (
-        engine, RIALogInfo, RIAOnline, DashboardDaily, 
-        DatabaseManager, DatabaseService
+        engine, RIALogInfo, RIAOnline, DashboardDaily, DashboardHourly, OnlineSample,
+        DatabaseManager, DatabaseService, iter_online_presence
     )
+    from functions.config import config
+    from functions.utils import TTLCache
+    from functions.presence import presence_tracker
 
 
 class DashboardHandler:
@@ -34,6 +44,8 @@ class DashboardHandler:
     def __init__(self):
         self.db_manager = DatabaseManager()
         self.db_service = DatabaseService(self.db_manager)
+        # 日期范围查询结果缓存：(开始日期, 结束日期) -> (ETag, 数据)
+        self.range_cache = TTLCache(config.DASHBOARD_RANGE_CACHE_SIZE, config.DASHBOARD_RANGE_CACHE_TTL)
     
     def process_yesterday_data(self, target_date: Optional[datetime.date] = None) -> bool:
         """处理昨日数据并存储到dashboard_daily表
@@ -68,6 +80,7 @@ class DashboardHandler:
             
             # 保存到数据库
             self.db_manager.add_and_commit(dashboard_record)
+            self.range_cache.clear()
             
             print(f"成功处理日期 {target_date} 的仪表板数据")
             return True
@@ -105,9 +118,152 @@ class DashboardHandler:
             print(f"检查日期处理状态失败: {e}")
             return False
     
+    @staticmethod
+    def _day_range(target_date: datetime.date) -> Tuple[datetime.datetime, datetime.datetime]:
+        """指定日期的起止时间（闭区间，与历史数据的统计口径一致）"""
+        return (datetime.datetime.combine(target_date, datetime.time.min),
+                datetime.datetime.combine(target_date, datetime.time.max))
+
+    def _has_hourly_rollup(self, session: Session, target_date: datetime.date) -> bool:
+        """指定日期在小时汇总表中是否有数据"""
+        start_datetime, end_datetime = self._day_range(target_date)
+        return session.execute(
+            select(DashboardHourly.hour).where(and_(
+                DashboardHourly.hour >= start_datetime,
+                DashboardHourly.hour <= end_datetime
+            )).limit(1)
+        ).first() is not None
+
+    def _aggregate_online_hourly(self, session: Session, target_date: datetime.date) -> Tuple[List[int], int]:
+        """从小时汇总表汇总在线人数
+
+        Returns:
+            (24小时的在线人数, 当日独特玩家数)
+        """
+        start_datetime, end_datetime = self._day_range(target_date)
+        day_filter = and_(
+            DashboardHourly.hour >= start_datetime,
+            DashboardHourly.hour <= end_datetime,
+            DashboardHourly.online == 1,
+            DashboardHourly.player_name != ''
+        )
+        hourly_counts = [0] * 24
+        rows = session.execute(
+            select(DashboardHourly.hour, func.count())
+            .where(day_filter)
+            .group_by(DashboardHourly.hour)
+        ).all()
+        for hour, count in rows:
+            hourly_counts[hour.hour] = count
+
+        total_unique_players = session.execute(
+            select(func.count(distinct(DashboardHourly.player_name))).where(day_filter)
+        ).scalar() or 0
+        return hourly_counts, total_unique_players
+
+    def _aggregate_chat_hourly(self, session: Session, target_date: datetime.date) -> Dict[str, int]:
+        """从小时汇总表汇总发言次数
+
+        Returns:
+            玩家名到发言次数的映射，按玩家当日首条发言的顺序排列
+        """
+        start_datetime, end_datetime = self._day_range(target_date)
+        rows = session.execute(
+            select(DashboardHourly.player_name, func.sum(DashboardHourly.message_count))
+            .where(and_(
+                DashboardHourly.hour >= start_datetime,
+                DashboardHourly.hour <= end_datetime,
+                DashboardHourly.message_count > 0
+            ))
+            .group_by(DashboardHourly.player_name)
+            .order_by(func.min(DashboardHourly.first_message_at))
+        ).all()
+        return {player_name: count for player_name, count in rows if player_name.strip()}
+
+    def _aggregate_online_sql(self, session: Session, target_date: datetime.date) -> Tuple[List[int], int]:
+        """在数据库中按小时聚合在线人数
+
+        Returns:
+            (24小时的在线人数, 当日独特玩家数)
+        """
+        start_datetime, end_datetime = self._day_range(target_date)
+        day_filter = and_(
+            RIAOnline.t >= start_datetime,
+            RIAOnline.t <= end_datetime,
+            RIAOnline.player_name.isnot(None),
+            RIAOnline.player_name != ''
+        )
+        hour = cast(func.strftime('%H', RIAOnline.t), Integer)
+
+        hourly_counts = [0] * 24
+        rows = session.execute(
+            select(hour, func.count(distinct(RIAOnline.player_name)))
+            .where(day_filter)
+            .group_by(hour)
+        ).all()
+        for hour_value, count in rows:
+            hourly_counts[hour_value] = count
+
+        total_unique_players = session.execute(
+            select(func.count(distinct(RIAOnline.player_name))).where(day_filter)
+        ).scalar() or 0
+        return hourly_counts, total_unique_players
+
+    def _aggregate_online_stream(self, session: Session, target_date: datetime.date) -> Tuple[List[int], int]:
+        """逐批读取在线记录和在线采样并在内存中聚合
+
+        Returns:
+            (24小时的在线人数, 当日独特玩家数)
+        """
+        start_datetime, end_datetime = self._day_range(target_date)
+        hourly_stats = defaultdict(set)
+        all_players = set()
+        for t, player_name in iter_online_presence(session, start_datetime, end_datetime):
+            hourly_stats[t.hour].add(player_name)
+            all_players.add(player_name)
+        return [len(hourly_stats[hour]) for hour in range(24)], len(all_players)
+
+    @staticmethod
+    def _has_online_samples(session: Session, start_datetime: datetime.datetime,
+                            end_datetime: datetime.datetime) -> bool:
+        """时间范围内是否有紧凑在线采样（有则无法只用SQL聚合）"""
+        return session.execute(
+            select(OnlineSample.id).where(and_(
+                OnlineSample.t >= start_datetime,
+                OnlineSample.t <= end_datetime
+            )).limit(1)
+        ).first() is not None
+
+    @staticmethod
+    def _build_online_curve(hourly_counts: List[int], total_unique_players: int) -> Dict:
+        """由每小时在线人数构建在线曲线数据"""
+        # 构建24小时的数据点
+        curve_data = {
+            'hours': list(range(24)),
+            'online_counts': hourly_counts,
+            'peak_hour': 0,
+            'peak_count': 0,
+            'total_unique_players': total_unique_players
+        }
+        
+        max_count = 0
+        peak_hour = 0
+        
+        for hour, count in enumerate(hourly_counts):
+            if count > max_count:
+                max_count = count
+                peak_hour = hour
+        
+        curve_data['peak_hour'] = peak_hour
+        curve_data['peak_count'] = max_count
+        
+        return curve_data
+
     def _get_online_curve_data(self, target_date: datetime.date) -> Dict:
         """获取指定日期的在线人数变化曲线数据
         
+        优先汇总小时汇总表，该日期没有汇总数据时再聚合原始在线记录。
+        
         Args:
             target_date: 目标日期
             
@@ -117,53 +273,18 @@ class DashboardHandler:
         try:
             temp_session = Session(bind=engine)
             try:
-                # 设置时间范围
-                start_datetime = datetime.datetime.combine(target_date, datetime.time.min)
-                end_datetime = datetime.datetime.combine(target_date, datetime.time.max)
-                
-                # 查询该日期的在线记录
-                online_records = temp_session.query(RIAOnline).filter(
-                    and_(
-                        RIAOnline.t >= start_datetime,
-                        RIAOnline.t <= end_datetime
-                    )
-                ).order_by(RIAOnline.t).all()
-                
-                # 按小时统计在线人数
-                hourly_stats = defaultdict(set)
-                
-                for record in online_records:
-                    hour = record.t.hour
-                    if record.player_name:
-                        hourly_stats[hour].add(record.player_name)
-                
-                # 构建24小时的数据点
-                curve_data = {
-                    'hours': list(range(24)),
-                    'online_counts': [],
-                    'peak_hour': 0,
-                    'peak_count': 0,
-                    'total_unique_players': len(set(
-                        record.player_name for record in online_records 
-                        if record.player_name
-                    ))
-                }
-                
-                max_count = 0
-                peak_hour = 0
-                
-                for hour in range(24):
-                    count = len(hourly_stats[hour])
-                    curve_data['online_counts'].append(count)
-                    
-                    if count > max_count:
-                        max_count = count
-                        peak_hour = hour
-                
-                curve_data['peak_hour'] = peak_hour
-                curve_data['peak_count'] = max_count
-                
-                return curve_data
+                if self._has_hourly_rollup(temp_session, target_date):
+                    return self._build_online_curve(*self._aggregate_online_hourly(temp_session, target_date))
+                try:
+                    if self._has_online_samples(temp_session, *self._day_range(target_date)):
+                        hourly_counts, total_unique_players = self._aggregate_online_stream(temp_session, target_date)
+                    else:
+                        hourly_counts, total_unique_players = self._aggregate_online_sql(temp_session, target_date)
+                except Exception as e:
+                    print(f"SQL聚合在线人数失败，改为逐批统计: {e}")
+                    temp_session.rollback()
+                    hourly_counts, total_unique_players = self._aggregate_online_stream(temp_session, target_date)
+                return self._build_online_curve(hourly_counts, total_unique_players)
                 
             finally:
                 temp_session.close()
@@ -177,10 +298,82 @@ class DashboardHandler:
                 'peak_count': 0,
                 'total_unique_players': 0
             }
-    
+
+    def _aggregate_chat_sql(self, session: Session, target_date: datetime.date) -> Dict[str, int]:
+        """在数据库中按玩家聚合发言次数
+
+        Returns:
+            玩家名到发言次数的映射，按玩家当日首条发言的顺序排列
+        """
+        start_datetime, end_datetime = self._day_range(target_date)
+        first_id = func.min(RIALogInfo.id)
+        rows = session.execute(
+            select(RIALogInfo.who_string, func.count())
+            .where(and_(
+                RIALogInfo.t >= start_datetime,
+                RIALogInfo.t <= end_datetime,
+                RIALogInfo.who_string.isnot(None)
+            ))
+            .group_by(RIALogInfo.who_string)
+            .order_by(first_id)
+        ).all()
+        # 空白名字的过滤留在Python中做，保证与str.strip的口径一致
+        return {who_string: count for who_string, count in rows if who_string.strip()}
+
+    def _aggregate_chat_stream(self, session: Session, target_date: datetime.date) -> Dict[str, int]:
+        """逐批读取聊天记录并在内存中聚合（SQL聚合失败时的后备路径）
+
+        Returns:
+            玩家名到发言次数的映射，按玩家当日首条发言的顺序排列
+        """
+        start_datetime, end_datetime = self._day_range(target_date)
+        player_stats = defaultdict(int)
+        records = session.query(RIALogInfo.who_string).filter(
+            and_(
+                RIALogInfo.t >= start_datetime,
+                RIALogInfo.t <= end_datetime,
+                RIALogInfo.who_string.isnot(None)
+            )
+        ).order_by(RIALogInfo.id).yield_per(1000)
+        for (who_string,) in records:
+            if who_string and who_string.strip():
+                player_stats[who_string] += 1
+        return dict(player_stats)
+
+    @staticmethod
+    def _build_chat_stats(player_stats: Dict[str, int]) -> Dict:
+        """由玩家发言次数构建发言统计数据"""
+        total_messages = sum(player_stats.values())
+        
+        # 排序并获取前10名最活跃的玩家（次数相同的按首条发言先后排列）
+        sorted_players = sorted(
+            player_stats.items(), 
+            key=lambda x: x[1], 
+            reverse=True
+        )
+        
+        top_players = sorted_players[:10]
+        
+        # 构建统计数据
+        return {
+            'total_messages': total_messages,
+            'total_players': len(player_stats),
+            'top_players': [
+                {'player_name': player, 'message_count': count}
+                for player, count in top_players
+            ],
+            'all_players': dict(player_stats),
+            'average_messages_per_player': (
+                total_messages / len(player_stats) 
+                if len(player_stats) > 0 else 0
+            )
+        }
+
     def _get_player_chat_stats(self, target_date: datetime.date) -> Dict:
         """获取指定日期的玩家发言统计
         
+        优先汇总小时汇总表，该日期没有汇总数据时再聚合原始聊天记录。
+        
         Args:
             target_date: 目标日期
             
@@ -190,53 +383,15 @@ class DashboardHandler:
         try:
             temp_session = Session(bind=engine)
             try:
-                # 设置时间范围
-                start_datetime = datetime.datetime.combine(target_date, datetime.time.min)
-                end_datetime = datetime.datetime.combine(target_date, datetime.time.max)
-                
-                # 查询该日期的聊天记录
-                chat_records = temp_session.query(RIALogInfo).filter(
-                    and_(
-                        RIALogInfo.t >= start_datetime,
-                        RIALogInfo.t <= end_datetime,
-                        RIALogInfo.who_string.isnot(None)
-                    )
-                ).all()
-                
-                # 统计每个玩家的发言次数
-                player_stats = defaultdict(int)
-                total_messages = 0
-                
-                for record in chat_records:
-                    if record.who_string and record.who_string.strip():
-                        player_stats[record.who_string] += 1
-                        total_messages += 1
-                
-                # 排序并获取前10名最活跃的玩家
-                sorted_players = sorted(
-                    player_stats.items(), 
-                    key=lambda x: x[1], 
-                    reverse=True
-                )
-                
-                top_players = sorted_players[:10]
-                
-                # 构建统计数据
-                chat_stats = {
-                    'total_messages': total_messages,
-                    'total_players': len(player_stats),
-                    'top_players': [
-                        {'player_name': player, 'message_count': count}
-                        for player, count in top_players
-                    ],
-                    'all_players': dict(player_stats),
-                    'average_messages_per_player': (
-                        total_messages / len(player_stats) 
-                        if len(player_stats) > 0 else 0
-                    )
-                }
-                
-                return chat_stats
+                if self._has_hourly_rollup(temp_session, target_date):
+                    return self._build_chat_stats(self._aggregate_chat_hourly(temp_session, target_date))
+                try:
+                    player_stats = self._aggregate_chat_sql(temp_session, target_date)
+                except Exception as e:
+                    print(f"SQL聚合发言统计失败，改为逐批统计: {e}")
+                    temp_session.rollback()
+                    player_stats = self._aggregate_chat_stream(temp_session, target_date)
+                return self._build_chat_stats(player_stats)
                 
             finally:
                 temp_session.close()
@@ -250,7 +405,52 @@ class DashboardHandler:
                 'all_players': {},
                 'average_messages_per_player': 0
             }
+
+    def get_today_so_far(self) -> Dict:
+        """获取今天截至目前的实时统计（只读取小时汇总表）
+        
+        Returns:
+            与每日仪表板数据格式相同的统计，另含今日新玩家数和按分钟的在线时段统计
+        """
+        today = datetime.date.today()
+        try:
+            temp_session = Session(bind=engine)
+            try:
+                online_curve_data = self._build_online_curve(*self._aggregate_online_hourly(temp_session, today))
+                player_chat_stats = self._build_chat_stats(self._aggregate_chat_hourly(temp_session, today))
+            finally:
+                temp_session.close()
+        except Exception as e:
+            print(f"获取今日实时统计失败: {e}")
+            online_curve_data = self._build_online_curve([0] * 24, 0)
+            player_chat_stats = self._build_chat_stats({})
+
+        return {
+            'date': today.strftime("%Y-%m-%d"),
+            'online_curve_data': online_curve_data,
+            'player_chat_stats': player_chat_stats,
+            'new_players': self.db_service.count_new_players(today),
+            'presence': self._get_presence(today),
+            'updated_at': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
     
+    @staticmethod
+    def _get_presence(target_date: datetime.date) -> Dict:
+        """根据玩家在线时段统计指定日期每分钟的在线人数和每个玩家的在线时长"""
+        start, end = DashboardHandler._day_range(target_date)
+        end = min(end, datetime.datetime.now())
+        try:
+            curve = presence_tracker.concurrency_curve(start, end, step_minutes=1)
+            playtime = presence_tracker.playtime(start, end)
+        except Exception as e:
+            print(f"获取在线时段统计失败: {e}")
+            curve, playtime = [], {}
+        return {
+            'minute_counts': curve,
+            'max_online': max(curve) if curve else 0,
+            'playtime_seconds': playtime
+        }
+
     def get_dashboard_data(self, target_date: Optional[datetime.date] = None) -> Optional[Dict]:
         """获取指定日期的仪表板数据
         
@@ -288,8 +488,100 @@ class DashboardHandler:
             print(f"获取仪表板数据失败: {e}")
             return None
     
+    def get_dashboard_range(self, start_date: datetime.date,
+                            end_date: datetime.date) -> Tuple[str, Dict]:
+        """获取日期范围内的仪表板数据及按周、按月的汇总
+
+        结果按日期范围缓存，新的一天写入后缓存失效。
+
+        Args:
+            start_date: 开始日期（包含）
+            end_date: 结束日期（包含）
+
+        Returns:
+            (ETag, 数据)
+        """
+        key = (start_date, end_date)
+        cached = self.range_cache.get(key)
+        if cached is not None:
+            return cached
+
+        temp_session = Session(bind=engine)
+        try:
+            records = temp_session.query(DashboardDaily).filter(
+                and_(
+                    DashboardDaily.date >= datetime.datetime.combine(start_date, datetime.time.min),
+                    DashboardDaily.date <= datetime.datetime.combine(end_date, datetime.time.max)
+                )
+            ).order_by(DashboardDaily.date).all()
+            days = [record.to_dict() for record in records]
+        finally:
+            temp_session.close()
+
+        weekly = defaultdict(list)
+        monthly = defaultdict(list)
+        for day in days:
+            day_date = datetime.datetime.strptime(day['date'], "%Y-%m-%d").date()
+            iso_year, iso_week, _ = day_date.isocalendar()
+            weekly[f'{iso_year}-W{iso_week:02d}'].append(day)
+            monthly[day_date.strftime("%Y-%m")].append(day)
+
+        data = {
+            'start': start_date.strftime("%Y-%m-%d"),
+            'end': end_date.strftime("%Y-%m-%d"),
+            'days': days,
+            'summary': self._summarize_days(days),
+            'weekly': [dict(self._summarize_days(items), period=period) for period, items in weekly.items()],
+            'monthly': [dict(self._summarize_days(items), period=period) for period, items in monthly.items()],
+        }
+        etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+        self.range_cache.set(key, (etag, data))
+        return etag, data
+
+    @staticmethod
+    def _summarize_days(days: List[Dict]) -> Dict:
+        """汇总多天的仪表板数据
+
+        Args:
+            days: 每日仪表板数据（DashboardDaily.to_dict的结果）
+
+        Returns:
+            汇总数据
+        """
+        player_totals = defaultdict(int)
+        total_messages = 0
+        peak_count = 0
+        peak_date = None
+        unique_players_sum = 0
+
+        for day in days:
+            curve = day.get('online_curve_data') or {}
+            chat = day.get('player_chat_stats') or {}
+            total_messages += chat.get('total_messages', 0)
+            unique_players_sum += curve.get('total_unique_players', 0)
+            for player, count in (chat.get('all_players') or {}).items():
+                player_totals[player] += count
+            if curve.get('peak_count', 0) > peak_count:
+                peak_count = curve['peak_count']
+                peak_date = day['date']
+
+        top_players = sorted(player_totals.items(), key=lambda x: x[1], reverse=True)[:10]
+        return {
+            'days': len(days),
+            'total_messages': total_messages,
+            'total_players': len(player_totals),
+            'top_players': [
+                {'player_name': player, 'message_count': count}
+                for player, count in top_players
+            ],
+            'peak_count': peak_count,
+            'peak_date': peak_date,
+            'average_daily_messages': total_messages / len(days) if days else 0,
+            'average_daily_unique_players': unique_players_sum / len(days) if days else 0,
+        }
+
     def process_multiple_days(self, start_date: datetime.date, end_date: datetime.date) -> int:
-        """批量处理多天的数据
+        """批量处理多天的数据（跳过已处理的日期）
         
         Args:
             start_date: 开始日期
@@ -298,16 +590,208 @@ class DashboardHandler:
         Returns:
             成功处理的天数
         """
-        success_count = 0
-        current_date = start_date
-        
-        while current_date <= end_date:
-            if self.process_yesterday_data(current_date):
-                success_count += 1
-            current_date += datetime.timedelta(days=1)
-        
+        success_count = self.backfill(start_date, end_date)
         print(f"批量处理完成，成功处理 {success_count} 天的数据")
         return success_count
+
+    def _backfill_online(self, session: Session, start_datetime: datetime.datetime,
+                         end_datetime: datetime.datetime) -> Dict[str, Tuple[List[int], int]]:
+        """一次扫描在线记录（及在线采样），按天按小时统计在线人数
+
+        Returns:
+            日期字符串到 (24小时的在线人数, 当日独特玩家数) 的映射
+        """
+        day = func.date(RIAOnline.t)
+        hour = cast(func.strftime('%H', RIAOnline.t), Integer)
+        range_filter = and_(
+            RIAOnline.t >= start_datetime,
+            RIAOnline.t <= end_datetime,
+            RIAOnline.player_name.isnot(None),
+            RIAOnline.player_name != ''
+        )
+        if self._has_online_samples(session, start_datetime, end_datetime):
+            # 有紧凑采样时逐条解包，按天按小时收集玩家集合
+            hourly_sets = defaultdict(lambda: defaultdict(set))
+            for t, player_name in iter_online_presence(session, start_datetime, end_datetime):
+                hourly_sets[t.strftime("%Y-%m-%d")][t.hour].add(player_name)
+            return {
+                day_value: ([len(hours[hour]) for hour in range(24)], len(set().union(*hours.values())))
+                for day_value, hours in hourly_sets.items()
+            }
+
+        results = defaultdict(lambda: ([0] * 24, 0))
+        for day_value, hour_value, count in session.execute(
+                select(day, hour, func.count(distinct(RIAOnline.player_name)))
+                .where(range_filter)
+                .group_by(day, hour)):
+            results[day_value][0][hour_value] = count
+        for day_value, total_unique_players in session.execute(
+                select(day, func.count(distinct(RIAOnline.player_name)))
+                .where(range_filter)
+                .group_by(day)):
+            results[day_value] = (results[day_value][0], total_unique_players)
+        return results
+
+    def _backfill_chat(self, session: Session, start_datetime: datetime.datetime,
+                       end_datetime: datetime.datetime) -> Dict[str, Dict[str, int]]:
+        """一次扫描聊天记录，按天按玩家统计发言次数
+
+        Returns:
+            日期字符串到玩家发言次数映射（按首条发言顺序）的映射
+        """
+        day = func.date(RIALogInfo.t)
+        results = defaultdict(dict)
+        for day_value, who_string, count in session.execute(
+                select(day, RIALogInfo.who_string, func.count())
+                .where(and_(
+                    RIALogInfo.t >= start_datetime,
+                    RIALogInfo.t <= end_datetime,
+                    RIALogInfo.who_string.isnot(None)
+                ))
+                .group_by(day, RIALogInfo.who_string)
+                .order_by(day, func.min(RIALogInfo.id))):
+            if who_string.strip():
+                results[day_value][who_string] = count
+        return results
+
+    @staticmethod
+    def _backfill_hourly(session: Session, start_datetime: datetime.datetime,
+                         end_datetime: datetime.datetime) -> Tuple[Dict[str, Tuple[List[int], int]],
+                                                                  Dict[str, Dict[str, int]], set]:
+        """对小时汇总表按天分组扫描一次，统计在线人数和发言次数
+
+        Returns:
+            (日期字符串到 (24小时的在线人数, 当日独特玩家数) 的映射,
+             日期字符串到玩家发言次数映射（按首条发言顺序）的映射,
+             有小时汇总的日期集合)
+        """
+        day = func.date(DashboardHourly.hour)
+        range_filter = and_(
+            DashboardHourly.hour >= start_datetime,
+            DashboardHourly.hour <= end_datetime
+        )
+        online_filter = and_(range_filter, DashboardHourly.online == 1, DashboardHourly.player_name != '')
+
+        rollup_days = {day_value for (day_value,) in session.execute(select(day).distinct().where(range_filter))}
+
+        online_stats = defaultdict(lambda: ([0] * 24, 0))
+        hour = cast(func.strftime('%H', DashboardHourly.hour), Integer)
+        for day_value, hour_value, count in session.execute(
+                select(day, hour, func.count())
+                .where(online_filter)
+                .group_by(day, hour)):
+            online_stats[day_value][0][hour_value] = count
+        for day_value, total_unique_players in session.execute(
+                select(day, func.count(distinct(DashboardHourly.player_name)))
+                .where(online_filter)
+                .group_by(day)):
+            online_stats[day_value] = (online_stats[day_value][0], total_unique_players)
+
+        chat_stats = defaultdict(dict)
+        for day_value, player_name, count in session.execute(
+                select(day, DashboardHourly.player_name, func.sum(DashboardHourly.message_count))
+                .where(and_(range_filter, DashboardHourly.message_count > 0))
+                .group_by(day, DashboardHourly.player_name)
+                .order_by(day, func.min(DashboardHourly.first_message_at))):
+            if player_name.strip():
+                chat_stats[day_value][player_name] = count
+        return online_stats, chat_stats, rollup_days
+
+    def backfill(self, start_date: datetime.date, end_date: datetime.date,
+                 force: bool = False, shard_days: int = 31) -> int:
+        """回填多天的仪表板数据
+        
+        有小时汇总的日期从dashboard_hourly汇总（原始聊天日志可能已被归档删除，整个范围只扫描一次），
+        其余日期按分片（默认每31天）对原始在线记录和聊天记录各做一次分组扫描，
+        在内存中拼出每天的数据后批量写入dashboard_daily。
+        
+        Args:
+            start_date: 开始日期
+            end_date: 结束日期
+            force: 是否覆盖已存在的日期
+            shard_days: 每个分片的天数
+            
+        Returns:
+            写入的天数
+        """
+        total_days = (end_date - start_date).days + 1
+        if total_days <= 0:
+            return 0
+
+        written = 0
+        processed = 0
+        shard_start = start_date
+        started = datetime.datetime.now()
+        temp_session = Session(bind=engine)
+        try:
+            hourly_online, hourly_chat, rollup_days = self._backfill_hourly(
+                temp_session,
+                datetime.datetime.combine(start_date, datetime.time.min),
+                datetime.datetime.combine(end_date, datetime.time.max)
+            )
+        finally:
+            temp_session.close()
+        while shard_start <= end_date:
+            shard_end = min(shard_start + datetime.timedelta(days=shard_days - 1), end_date)
+            start_datetime = datetime.datetime.combine(shard_start, datetime.time.min)
+            end_datetime = datetime.datetime.combine(shard_end, datetime.time.max)
+            try:
+                temp_session = Session(bind=engine)
+                try:
+                    shard_keys = {(shard_start + datetime.timedelta(days=offset)).strftime("%Y-%m-%d")
+                                  for offset in range((shard_end - shard_start).days + 1)}
+                    if not shard_keys <= rollup_days:
+                        online_stats = self._backfill_online(temp_session, start_datetime, end_datetime)
+                        chat_stats = self._backfill_chat(temp_session, start_datetime, end_datetime)
+                    else:
+                        online_stats, chat_stats = {}, {}
+
+                    now = datetime.datetime.now()
+                    rows = []
+                    current_date = shard_start
+                    while current_date <= shard_end:
+                        key = current_date.strftime("%Y-%m-%d")
+                        if key in rollup_days:
+                            hourly_counts, total_unique_players = hourly_online.get(key, ([0] * 24, 0))
+                            player_stats = hourly_chat.get(key, {})
+                        else:
+                            hourly_counts, total_unique_players = online_stats.get(key, ([0] * 24, 0))
+                            player_stats = chat_stats.get(key, {})
+                        rows.append({
+                            'date': datetime.datetime.combine(current_date, datetime.time.min),
+                            'online_curve_data': self._build_online_curve(hourly_counts, total_unique_players),
+                            'player_chat_stats': self._build_chat_stats(player_stats),
+                            'created_at': now,
+                        })
+                        current_date += datetime.timedelta(days=1)
+
+                    stmt = sqlite_insert(DashboardDaily)
+                    if force:
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[DashboardDaily.date],
+                            set_={
+                                'online_curve_data': stmt.excluded.online_curve_data,
+                                'player_chat_stats': stmt.excluded.player_chat_stats,
+                                'created_at': stmt.excluded.created_at,
+                            }
+                        )
+                    else:
+                        stmt = stmt.on_conflict_do_nothing(index_elements=[DashboardDaily.date])
+                    written += temp_session.connection().execute(stmt, rows).rowcount
+                    temp_session.commit()
+                finally:
+                    temp_session.close()
+            except Exception as e:
+                print(f"回填 {shard_start} ~ {shard_end} 失败: {e}")
+
+            processed += (shard_end - shard_start).days + 1
+            elapsed = (datetime.datetime.now() - started).total_seconds()
+            print(f"回填进度: {processed}/{total_days} 天 ({processed * 100 // total_days}%)，"
+                  f"已写入 {written} 天，耗时 {elapsed:.1f}s")
+            shard_start = shard_end + datetime.timedelta(days=1)
+
+        self.range_cache.clear()
+        return written
     
     def cleanup_old_data(self, days_to_keep: int = 30) -> int:
         """清理旧的仪表板数据
@@ -324,16 +808,11 @@ class DashboardHandler:
                 cutoff_date = datetime.date.today() - datetime.timedelta(days=days_to_keep)
                 cutoff_datetime = datetime.datetime.combine(cutoff_date, datetime.time.min)
                 
-                old_records = temp_session.query(DashboardDaily).filter(
-                    DashboardDaily.date < cutoff_datetime
-                ).all()
-                
-                count = len(old_records)
-                
-                for record in old_records:
-                    temp_session.delete(record)
-                
+                count = temp_session.execute(
+                    delete(DashboardDaily).where(DashboardDaily.date < cutoff_datetime)
+                ).rowcount
                 temp_session.commit()
+                self.range_cache.clear()
                 
                 print(f"清理了 {count} 条旧的仪表板数据")
                 return count
@@ -350,8 +829,35 @@ class DashboardHandler:
 dashboard_handler = DashboardHandler()
 
 
+def _parse_date(value: str) -> datetime.date:
+    """解析命令行日期参数（YYYY-MM-DD）"""
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式应为 YYYY-MM-DD: {value}")
+
+
 def main():
-    """主函数，用于测试和手动执行"""
+    """主函数，用于测试和手动执行
+    
+    不带参数时处理昨天的数据；带 --from/--to 时回填日期范围，--force 覆盖已有数据。
+    """
+    parser = argparse.ArgumentParser(description='仪表板数据处理')
+    parser.add_argument('--from', dest='start', type=_parse_date, help='回填开始日期 YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', type=_parse_date, help='回填结束日期 YYYY-MM-DD，默认为昨天')
+    parser.add_argument('--force', action='store_true', help='覆盖已存在的日期')
+    args = parser.parse_args()
+
+    if args.start or args.end:
+        end_date = args.end or datetime.date.today() - datetime.timedelta(days=1)
+        start_date = args.start or end_date
+        if start_date > end_date:
+            parser.error('--from 不能晚于 --to')
+        print(f"开始回填 {start_date} ~ {end_date} 的仪表板数据{'（覆盖已有数据）' if args.force else ''}...")
+        written = dashboard_handler.backfill(start_date, end_date, force=args.force)
+        print(f"回填完成，共写入 {written} 天的数据")
+        return
+
     print("开始处理昨日仪表板数据...")
     
     # 处理昨天的数据
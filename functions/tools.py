@@ -5,18 +5,24 @@
 
 import threading
 import time
+import queue
 import requests
 import json
 import os
-from flask import Flask
-from flask_socketio import SocketIO, emit
+from email.utils import formatdate
+from typing import Dict, Optional, Tuple
+from flask import Flask, request
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from sqlalchemy import text
+from sqlalchemy.orm import Session
 from .config import config
 from .database import (
-    db, db_manager, db_service, RIALogInfo, RIALogCommon,
+    db, db_service, RIALogInfo, RIALogCommon,
     RIAPlayers, engine
 )
-from .utils import FileUtils
+from .utils import FileUtils, HostRateLimiter, avatar_index
+from .log_cache import recent_log_cache
+from .log_archive import log_archiver
 
 # 初始化Flask应用
 import os
@@ -53,13 +59,26 @@ socketio = SocketIO(
 class AvatarDownloader:
     """Minecraft玩家头像下载器
     
-    负责从Mojang API获取玩家UUID，然后从Crafatar下载头像
+    负责从Mojang API获取玩家UUID，然后从Crafatar下载头像。
+    固定数量的工作线程从同一个队列取玩家名，共用连接池和按域名的限流器；
+    玩家名到UUID的解析结果（包括查无此人）持久化到数据库，重启后不必重新解析。
+    查无此人（204/404及429以外的4xx）按 AVATAR_NEGATIVE_TTL_HOURS 缓存，期间不再入队；
+    暂时性失败（429/5xx/网络错误）按指数退避，退避期间不再入队。
     """
-    
-    def __init__(self):
-        self.name_queue = []  # 待处理的玩家名队列
-        self.id_queue = []    # 待下载头像的ID队列
-        self.downloaded_names = []  # 已下载的玩家名列表
+
+    MOJANG_HOST = 'api.mojang.com'
+    CRAFATAR_HOST = 'crafatar.com'
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or config.AVATAR_WORKERS
+        self.name_queue = queue.Queue()  # 待处理的玩家名队列
+        self._queued = set()  # 已入队、尚未处理完的玩家名
+        self._uuid_cache: Dict[str, Tuple[Optional[str], float]] = {}  # 玩家名 -> (UUID（None表示查无此人）, 过期时间)
+        self._retry_at: Dict[str, Tuple[float, int]] = {}  # 玩家名 -> (最早重试时间, 连续失败次数)
+        self._lock = threading.Lock()
+        self._rate_limiter = HostRateLimiter()
+        self._http = None
+        self._threads = []
         self._running = False
     
     def add_player(self, player_name: str) -> None:
@@ -68,84 +87,172 @@ class AvatarDownloader:
         Args:
             player_name: 玩家名字
         """
-        if player_name not in self.downloaded_names and player_name not in self.name_queue:
-            self.name_queue.append(player_name)
-    
-    def _get_player_uuid(self) -> None:
-        """获取玩家UUID的工作线程"""
+        if not player_name:
+            return
+        now = time.time()
+        with self._lock:
+            if player_name in self._queued:
+                return
+            cached = self._uuid_cache.get(player_name)
+            if cached is not None and cached[0] is None and cached[1] > now:
+                return  # 查无此人，负缓存未过期
+            retry = self._retry_at.get(player_name)
+            if retry is not None and retry[0] > now:
+                return  # 暂时性失败后的退避期内
+            self._queued.add(player_name)
+        self.name_queue.put(player_name)
+
+    @staticmethod
+    def _expires_at(uuid: Optional[str], resolved_at: float) -> float:
+        """解析结果的过期时间（正结果和负结果的有效期不同）"""
+        if uuid is None:
+            return resolved_at + config.AVATAR_NEGATIVE_TTL_HOURS * 3600
+        return resolved_at + config.AVATAR_UUID_TTL_DAYS * 86400
+
+    def _create_http_session(self) -> requests.Session:
+        """创建带连接池的HTTP会话"""
+        http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=self.workers
+        )
+        http.mount('https://', adapter)
+        http.headers['User-Agent'] = 'minecraft_bot_for_because'
+        return http
+
+    def _resolve_uuid(self, player_name: str) -> Optional[str]:
+        """解析玩家UUID，优先使用缓存
+
+        Args:
+            player_name: 玩家名字
+
+        Returns:
+            UUID，查无此人时返回None
+
+        Raises:
+            requests.RequestException: 网络错误或服务端错误（可重试）
+        """
+        with self._lock:
+            cached = self._uuid_cache.get(player_name)
+            if cached is not None and cached[1] > time.time():
+                return cached[0]
+
+        self._rate_limiter.acquire(self.MOJANG_HOST)
+        response = self._http.get(
+            f'https://{self.MOJANG_HOST}/users/profiles/minecraft/{player_name}',
+            timeout=config.AVATAR_REQUEST_TIMEOUT
+        )
+        if response.status_code == 200:
+            uuid = response.json().get('id')
+        elif response.status_code in (204, 404) or (400 <= response.status_code < 500
+                                                      and response.status_code != 429):
+            # 查无此人或玩家名本身不合法（如400），重试也不会成功，作为负结果缓存
+            uuid = None
+        else:
+            # 429/5xx等属于暂时性错误，不缓存结果
+            response.raise_for_status()
+            raise requests.RequestException(f"意外的响应状态码 {response.status_code}")
+
+        with self._lock:
+            self._uuid_cache[player_name] = (uuid, self._expires_at(uuid, time.time()))
+        db_service.save_player_uuid(player_name, uuid)
+        return uuid
+
+    def _download_avatar(self, player_name: str, player_id: str) -> None:
+        """下载头像，本地已有文件时使用条件请求
+
+        Args:
+            player_name: 玩家名字
+            player_id: 玩家UUID
+
+        Raises:
+            requests.RequestException: 网络错误或服务端错误（可重试）
+        """
+        avatar_path = os.path.join(config.STATIC_IMG_PATH, f'{player_name}.png')
+        headers = {}
+        if os.path.exists(avatar_path):
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(avatar_path), usegmt=True)
+
+        self._rate_limiter.acquire(self.CRAFATAR_HOST)
+        response = self._http.get(
+            f'https://{self.CRAFATAR_HOST}/avatars/{player_id}',
+            headers=headers,
+            timeout=config.AVATAR_REQUEST_TIMEOUT
+        )
+        if response.status_code == 304:
+            avatar_index.add(player_name)
+            return
+        response.raise_for_status()
+
+        # 确保目录存在，先写临时文件再替换，避免页面读到半个文件
+        os.makedirs(config.STATIC_IMG_PATH, exist_ok=True)
+        temp_path = f'{avatar_path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(temp_path, avatar_path)
+        avatar_index.add(player_name)
+        print(f"成功下载玩家 {player_name} 的头像")
+
+    def _process_player(self, player_name: str) -> None:
+        """处理单个玩家：解析UUID并下载头像"""
+        try:
+            player_id = self._resolve_uuid(player_name)
+            if player_id is not None:
+                self._download_avatar(player_name, player_id)
+            with self._lock:
+                self._retry_at.pop(player_name, None)
+        except Exception as e:
+            # 暂时性失败，退避一段时间后再遇到该玩家时重试
+            with self._lock:
+                failures = self._retry_at.get(player_name, (0.0, 0))[1] + 1
+                delay = min(config.AVATAR_RETRY_MAX_SECONDS, config.AVATAR_RETRY_BASE_SECONDS * 2 ** (failures - 1))
+                self._retry_at[player_name] = (time.time() + delay, failures)
+            print(f"处理玩家 {player_name} 的头像失败，{delay} 秒后重试: {e}")
+        finally:
+            with self._lock:
+                self._queued.discard(player_name)
+
+    def _worker(self) -> None:
+        """头像下载工作线程"""
         while self._running:
-            if not self.name_queue:
-                time.sleep(1)
-                continue
-            
-            player_name = self.name_queue.pop(0)
-            if player_name in self.downloaded_names:
-                continue
-            
             try:
-                response = requests.get(
-                    f'https://api.mojang.com/users/profiles/minecraft/{player_name}',
-                    timeout=10
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    if 'id' in data:
-                        self.id_queue.append({
-                            'id': data['id'],
-                            'name': player_name
-                        })
-                        self.downloaded_names.append(player_name)
-            except Exception as e:
-                print(f"获取玩家 {player_name} 的UUID失败: {e}")
-            finally:
-                time.sleep(1)  # 避免请求过于频繁
-    
-    def _download_avatar(self) -> None:
-        """下载头像的工作线程"""
-        while self._running:
-            if not self.id_queue:
-                time.sleep(1)
+                player_name = self.name_queue.get(timeout=1)
+            except queue.Empty:
                 continue
-            
-            player_data = self.id_queue.pop(0)
-            player_id = player_data['id']
-            player_name = player_data['name']
-            
             try:
-                response = requests.get(
-                    f'https://crafatar.com/avatars/{player_id}',
-                    timeout=10
-                )
-                if response.status_code == 200:
-                    # 确保目录存在
-                    os.makedirs(config.STATIC_IMG_PATH, exist_ok=True)
-                    
-                    avatar_path = os.path.join(config.STATIC_IMG_PATH, f'{player_name}.png')
-                    with open(avatar_path, 'wb') as f:
-                        f.write(response.content)
-                    print(f"成功下载玩家 {player_name} 的头像")
-            except Exception as e:
-                print(f"下载玩家 {player_name} 的头像失败: {e}")
+                self._process_player(player_name)
             finally:
-                time.sleep(1)  # 避免请求过于频繁
+                self.name_queue.task_done()
     
     def start(self) -> None:
         """启动头像下载服务"""
         if self._running:
             return
-        
+
+        cached = db_service.load_player_uuids()
+        with self._lock:
+            for player_name, (uuid, resolved_at) in cached.items():
+                self._uuid_cache[player_name] = (uuid, self._expires_at(uuid, resolved_at.timestamp()))
+        self._http = self._create_http_session()
         self._running = True
-        uuid_thread = threading.Thread(target=self._get_player_uuid, daemon=True)
-        avatar_thread = threading.Thread(target=self._download_avatar, daemon=True)
+        self._threads = [
+            threading.Thread(target=self._worker, daemon=True, name=f'avatar-worker-{i}')
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
         
-        uuid_thread.start()
-        avatar_thread.start()
-        
-        print("头像下载服务已启动")
+        print(f"头像下载服务已启动（{self.workers} 个工作线程，已缓存 {len(cached)} 个UUID）")
     
     def stop(self) -> None:
         """停止头像下载服务"""
         self._running = False
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+        if self._http:
+            self._http.close()
+            self._http = None
         print("头像下载服务已停止")
 
 
@@ -155,9 +262,155 @@ avatar_downloader = AvatarDownloader()
 # 工具函数已移动到utils.py模块
 
 
+def _build_chat_log_result(log) -> dict:
+    """将聊天日志转换为前端所需的字典，并附带头像路径
+
+    Args:
+        log: 聊天日志对象（RIALogInfo或ChatLogEntry）
+
+    Returns:
+        日志字典，log对象无效时返回None
+    """
+    # 检查log对象是否有效
+    if not log or not hasattr(log, 'who_string') or log.who_string is None:
+        print(f"警告: 发现无效log对象，跳过处理")
+        return None
+
+    # 检查头像是否存在，如果不存在则添加到下载队列
+    if not FileUtils.check_player_avatar_exists(log.who_string):
+        avatar_downloader.add_player(log.who_string)
+        img_path = 'default.jpg'
+    else:
+        img_path = FileUtils.get_player_avatar_path(log.who_string)
+
+    result = log.to_dict()
+    result['img_path'] = img_path
+    return result
+
+
+class LogPublisher:
+    """日志推送器
+
+    在服务端后台任务中跟踪聊天日志和通用日志的最大ID，每个周期对每张表只查询一次，
+    新日志先写入最近日志缓存，再推送给订阅了对应频道的所有客户端。
+    客户端的 data_get / data_get_com 请求只用于断线重连后的补齐。
+    """
+
+    # 频道 -> 推送事件名
+    CHANNELS = {
+        'chat': 'message',
+        'common': 'message_com',
+    }
+
+    def __init__(self, interval: float = None, batch_limit: int = 100):
+        self.interval = interval or config.LOG_PUBLISH_INTERVAL
+        self.batch_limit = batch_limit
+        self.subscriptions = {}  # sid -> 订阅的频道集合
+        self._lock = threading.Lock()
+        self._running = False
+
+    def subscribe(self, sid: str, channel: str) -> bool:
+        """客户端订阅频道
+
+        Args:
+            sid: Socket.IO会话ID
+            channel: 频道名
+
+        Returns:
+            是否订阅成功
+        """
+        if channel not in self.CHANNELS:
+            return False
+        with self._lock:
+            self.subscriptions.setdefault(sid, set()).add(channel)
+        join_room(channel)
+        return True
+
+    def unsubscribe(self, sid: str, channel: str = None) -> None:
+        """客户端取消订阅，channel为空时取消全部订阅
+
+        Args:
+            sid: Socket.IO会话ID
+            channel: 频道名
+        """
+        with self._lock:
+            channels = self.subscriptions.get(sid, set())
+            if channel is None:
+                self.subscriptions.pop(sid, None)
+            else:
+                channels.discard(channel)
+                if channel in self.CHANNELS:
+                    leave_room(channel)
+
+    def subscriber_count(self, channel: str) -> int:
+        """获取频道订阅数"""
+        with self._lock:
+            return sum(1 for channels in self.subscriptions.values() if channel in channels)
+
+    def start(self) -> None:
+        """启动后台推送任务"""
+        if self._running:
+            return
+        self._running = True
+        if not recent_log_cache.loaded:
+            recent_log_cache.load()
+        socketio.start_background_task(self._run)
+        print("日志推送服务已启动")
+
+    def stop(self) -> None:
+        """停止后台推送任务"""
+        self._running = False
+
+    def _run(self) -> None:
+        """后台推送循环"""
+        while self._running:
+            try:
+                self.publish_once()
+            except Exception as e:
+                print(f"推送新日志失败: {e}")
+            socketio.sleep(self.interval)
+
+    def publish_once(self) -> None:
+        """查询一次新增日志，更新最近日志缓存并推送给订阅者"""
+        temp_session = Session(bind=engine)
+        try:
+            for channel, buffer in recent_log_cache.buffers().items():
+                entries = recent_log_cache.follow(buffer, temp_session, self.batch_limit)
+                if not entries or self.subscriber_count(channel) == 0:
+                    continue
+
+                if channel == 'chat':
+                    results = [r for r in (_build_chat_log_result(entry) for entry in entries) if r]
+                else:
+                    results = [entry.to_dict() for entry in entries]
+                if results:
+                    socketio.emit(
+                        self.CHANNELS[channel],
+                        {'data': json.dumps(results), 'new_id': entries[-1].id},
+                        to=channel
+                    )
+        finally:
+            temp_session.close()
+
+
+# 创建日志推送器实例（由Web服务器启动）
+log_publisher = LogPublisher()
+
+
+@socketio.on('subscribe')
+def handle_subscribe(channel):
+    """订阅日志频道，之后由服务端主动推送新日志
+
+    Args:
+        channel: 频道名（chat 或 common）
+    """
+    if not log_publisher.subscribe(request.sid, channel):
+        emit('error', {'message': 'channel error!'})
+
+
 @socketio.on('data_get')
 def handle_data_get(max_id):
-    """处理获取聊天数据的请求
+    """处理获取聊天数据的请求（用于连接/重连后补齐）
     
     Args:
         max_id: 最大ID，用于获取新数据
@@ -167,31 +420,25 @@ def handle_data_get(max_id):
         return
 
     try:
-        # 获取新的聊天日志
-        logs = (db_manager.session.query(RIALogInfo)
-                .filter(RIALogInfo.id > max_id)
-                .order_by(RIALogInfo.id.desc())
-                .limit(10)
-                .all())
+        # 获取新的聊天日志，优先从最近日志缓存读取
+        logs = recent_log_cache.chat.after(max_id, 10)
+        if logs is None:
+            temp_session = Session(bind=engine)
+            try:
+                logs = list(reversed(temp_session.query(RIALogInfo)
+                                     .filter(RIALogInfo.id > max_id)
+                                     .order_by(RIALogInfo.id.desc())
+                                     .limit(10)
+                                     .all()))
+            finally:
+                temp_session.close()
 
         results = []
-        for log in reversed(logs):
+        for log in logs:
             try:
-                # 检查log对象是否有效
-                if not log or not hasattr(log, 'who_string') or log.who_string is None:
-                    print(f"警告: 发现无效log对象，跳过处理")
-                    continue
-                
-                # 检查头像是否存在，如果不存在则添加到下载队列
-                if not FileUtils.check_player_avatar_exists(log.who_string):
-                    avatar_downloader.add_player(log.who_string)
-                    img_path = 'default.jpg'
-                else:
-                    img_path = FileUtils.get_player_avatar_path(log.who_string)
-                
-                result = log.to_dict()
-                result['img_path'] = img_path
-                results.append(result)
+                result = _build_chat_log_result(log)
+                if result:
+                    results.append(result)
             except Exception as e:
                 print(f"处理log对象失败: {e}, log信息: {getattr(log, 'id', 'unknown')}")
                 continue
@@ -199,7 +446,7 @@ def handle_data_get(max_id):
         if results:
             json_data = json.dumps(results)
             new_id = max(result['id'] for result in results)
-            emit('message', {'data': json_data, 'new_id': new_id}, broadcast=True)
+            emit('message', {'data': json_data, 'new_id': new_id})
         else:
             emit('no_new_data', {'message': 'No new data'})
             
@@ -210,7 +457,7 @@ def handle_data_get(max_id):
 
 @socketio.on('data_get_com')
 def handle_common_data_get(max_id):
-    """处理获取通用日志数据的请求
+    """处理获取通用日志数据的请求（用于连接/重连后补齐）
     
     Args:
         max_id: 最大ID，用于获取新数据
@@ -220,22 +467,28 @@ def handle_common_data_get(max_id):
         return
 
     try:
-        # 获取新的通用日志
-        logs = (db_manager.session.query(RIALogCommon)
-                .filter(RIALogCommon.id > max_id)
-                .order_by(RIALogCommon.id.desc())
-                .limit(10)
-                .all())
+        # 获取新的通用日志，优先从最近日志缓存读取
+        logs = recent_log_cache.common.after(max_id, 10)
+        if logs is None:
+            temp_session = Session(bind=engine)
+            try:
+                logs = list(reversed(temp_session.query(RIALogCommon)
+                                     .filter(RIALogCommon.id > max_id)
+                                     .order_by(RIALogCommon.id.desc())
+                                     .limit(10)
+                                     .all()))
+            finally:
+                temp_session.close()
 
         results = []
-        for log in reversed(logs):
+        for log in logs:
             result = log.to_dict()
             results.append(result)
 
         if results:
             json_data = json.dumps(results)
             new_id = max(result['id'] for result in results)
-            emit('message_com', {'data': json_data, 'new_id': new_id}, broadcast=True)
+            emit('message_com', {'data': json_data, 'new_id': new_id})
         else:
             emit('no_new_data', {'message': 'No new data'})
             
@@ -256,31 +509,29 @@ def handle_update_old_log(min_id):
         return
 
     try:
-        # 获取历史聊天日志
-        logs = (db_manager.session.query(RIALogInfo)
-                .filter(RIALogInfo.id < min_id)
-                .order_by(RIALogInfo.id.desc())
-                .limit(10)
-                .all())
+        # 获取历史聊天日志，缓存覆盖不到时查询数据库
+        logs = recent_log_cache.chat.before(min_id, 10)
+        if logs is None:
+            temp_session = Session(bind=engine)
+            try:
+                logs = (temp_session.query(RIALogInfo)
+                        .filter(RIALogInfo.id < min_id)
+                        .order_by(RIALogInfo.id.desc())
+                        .limit(10)
+                        .all())
+            finally:
+                temp_session.close()
+        if len(logs) < 10:
+            # 数据库中也不够时，继续读取已归档的日志
+            oldest_id = min([min_id] + [log.id for log in logs])
+            logs = list(logs) + log_archiver.before(RIALogInfo, oldest_id, 10 - len(logs))
 
         results = []
         for log in logs:
             try:
-                # 检查log对象是否有效
-                if not log or not hasattr(log, 'who_string') or log.who_string is None:
-                    print(f"警告: 发现无效log对象，跳过处理")
-                    continue
-                
-                # 检查头像是否存在
-                if not FileUtils.check_player_avatar_exists(log.who_string):
-                    avatar_downloader.add_player(log.who_string)
-                    img_path = 'default.jpg'
-                else:
-                    img_path = FileUtils.get_player_avatar_path(log.who_string)
-                
-                result = log.to_dict()
-                result['img_path'] = img_path
-                results.append(result)
+                result = _build_chat_log_result(log)
+                if result:
+                    results.append(result)
             except Exception as e:
                 print(f"处理历史log对象失败: {e}, log信息: {getattr(log, 'id', 'unknown')}")
                 continue
@@ -288,7 +539,7 @@ def handle_update_old_log(min_id):
         if results:
             new_id = min(result['id'] for result in results)
             json_data = json.dumps(results)
-            emit('update_old_log', {'data': json_data, 'new_id': new_id}, broadcast=True)
+            emit('update_old_log', {'data': json_data, 'new_id': new_id})
         else:
             emit('no_new_data', {'message': 'No new data'})
             
@@ -309,12 +560,22 @@ def handle_update_old_log_common(min_id):
         return
 
     try:
-        # 获取历史通用日志
-        logs = (db_manager.session.query(RIALogCommon)
-                .filter(RIALogCommon.id < min_id)
-                .order_by(RIALogCommon.id.desc())
-                .limit(10)
-                .all())
+        # 获取历史通用日志，缓存覆盖不到时查询数据库
+        logs = recent_log_cache.common.before(min_id, 10)
+        if logs is None:
+            temp_session = Session(bind=engine)
+            try:
+                logs = (temp_session.query(RIALogCommon)
+                        .filter(RIALogCommon.id < min_id)
+                        .order_by(RIALogCommon.id.desc())
+                        .limit(10)
+                        .all())
+            finally:
+                temp_session.close()
+        if len(logs) < 10:
+            # 数据库中也不够时，继续读取已归档的日志
+            oldest_id = min([min_id] + [log.id for log in logs])
+            logs = list(logs) + log_archiver.before(RIALogCommon, oldest_id, 10 - len(logs))
 
         results = []
         for log in logs:
@@ -324,7 +585,7 @@ def handle_update_old_log_common(min_id):
         if results:
             new_id = min(result['id'] for result in results)
             json_data = json.dumps(results)
-            emit('update_old_log_com', {'data': json_data, 'new_id': new_id}, broadcast=True)
+            emit('update_old_log_com', {'data': json_data, 'new_id': new_id})
         else:
             emit('no_new_data', {'message': 'No new data'})
             
@@ -342,4 +603,4 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     # print('Client disconnected')
-    pass
+    log_publisher.unsubscribe(request.sid)
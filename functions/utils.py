@@ -5,12 +5,18 @@
 
 import re
 import os
+import heapq
+import datetime
+import ipaddress
 import sys
 import time
 import json
 import math
 import smtplib
+import socket
+import threading
 import unicodedata
+from collections import OrderedDict, deque
 from typing import Dict, List, Optional, Tuple, Any
 from email.mime.text import MIMEText
 from email.header import Header
@@ -162,12 +168,98 @@ class GeometryUtils:
         return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2 + (z2 - z1) ** 2)
 
 
+class AvatarIndex:
+    """玩家头像索引
+
+    启动时扫描一次头像目录，在内存中维护已有头像的玩家名集合；
+    头像下载器写入文件后直接更新索引。为了感知手动放入的文件，
+    最多每隔 refresh_interval 秒检查一次目录的修改时间，变化时重新扫描。
+    """
+
+    def __init__(self, directory: str = None, refresh_interval: float = None):
+        self.directory = directory or config.STATIC_IMG_PATH
+        self.refresh_interval = refresh_interval if refresh_interval is not None else config.AVATAR_INDEX_REFRESH_INTERVAL
+        self._names = set()
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._last_check = 0.0
+        self._loaded = False
+
+    def scan(self) -> int:
+        """扫描头像目录，重建索引
+
+        Returns:
+            索引中的头像数量
+        """
+        names = set()
+        mtime = None
+        try:
+            mtime = os.stat(self.directory).st_mtime
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.png') and entry.is_file():
+                        names.add(entry.name[:-len('.png')])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"扫描头像目录失败: {e}")
+            return len(self._names)
+
+        with self._lock:
+            self._names = names
+            self._dir_mtime = mtime
+            self._last_check = time.monotonic()
+            self._loaded = True
+        return len(names)
+
+    def _maybe_refresh(self) -> None:
+        """目录修改时间变化时重新扫描（按间隔节流）"""
+        if not self._loaded:
+            self.scan()
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return
+        if mtime != self._dir_mtime:
+            self.scan()
+
+    def add(self, player_name: str) -> None:
+        """头像文件写入后登记到索引
+
+        Args:
+            player_name: 玩家名字
+        """
+        with self._lock:
+            self._names.add(player_name)
+
+    def discard(self, player_name: str) -> None:
+        """从索引中移除头像
+
+        Args:
+            player_name: 玩家名字
+        """
+        with self._lock:
+            self._names.discard(player_name)
+
+    def __contains__(self, player_name: str) -> bool:
+        self._maybe_refresh()
+        return player_name in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
 class FileUtils:
     """文件操作工具类"""
     
     @staticmethod
     def check_player_avatar_exists(player_name: str) -> bool:
-        """检查玩家头像文件是否存在
+        """检查玩家头像文件是否存在（查询内存中的头像索引）
         
         Args:
             player_name: 玩家名字
@@ -175,8 +267,7 @@ class FileUtils:
         Returns:
             头像文件是否存在
         """
-        avatar_path = os.path.join(config.STATIC_IMG_PATH, f'{player_name}.png')
-        return os.path.exists(avatar_path)
+        return player_name in avatar_index
     
     @staticmethod
     def get_player_avatar_path(player_name: str) -> str:
@@ -193,12 +284,102 @@ class FileUtils:
         return 'default.jpg'
 
 
+class AhoCorasick:
+    """Aho-Corasick多模式匹配自动机
+
+    一次扫描文本即可找出所有模式串的出现位置，耗时与文本长度和命中数有关，与模式串数量无关。
+    """
+
+    def __init__(self, patterns: Optional[List[Tuple[str, Any]]] = None):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, Any]]] = [[]]  # 状态 -> [(模式长度, 值)]
+        self._built = True
+        for pattern, value in patterns or []:
+            self.add(pattern, value)
+
+    def add(self, pattern: str, value: Any = None) -> None:
+        """添加模式串（添加后需重新build）
+
+        Args:
+            pattern: 模式串，空串会被忽略
+            value: 命中时返回的值，默认为模式串本身
+        """
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((len(pattern), pattern if value is None else value))
+        self._built = False
+
+    def build(self) -> 'AhoCorasick':
+        """按广度优先计算失败指针，并合并后缀状态的输出"""
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+                queue.append(next_state)
+        self._built = True
+        return self
+
+    def iter(self, text: str):
+        """扫描文本，按结束位置顺序产出所有命中
+
+        Yields:
+            (起始位置, 结束位置, 值)
+        """
+        if not self._built:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in output[state]:
+                yield index - length + 1, index + 1, value
+
+    def __len__(self) -> int:
+        return sum(1 for outputs in self._output for _ in outputs)
+
+
 class EasterEggManager:
-    """彩蛋管理器"""
+    """彩蛋管理器
+
+    有效彩蛋编译为Aho-Corasick自动机，每条消息只扫描一遍；过期时间放在最小堆中，
+    只有彩蛋增加、被触发或过期时才重建自动机并写入文件。
+    """
     
     def __init__(self, eggs_file_path: str = None):
         self.eggs_file_path = eggs_file_path or config.EGGS_FILE_PATH
-        self.eggs = self._load_eggs()
+        self._lock = threading.Lock()
+        self._eggs: Dict[int, Dict[str, Any]] = {}  # 序号 -> 彩蛋，序号越小越先触发
+        self._expiry_heap: List[Tuple[int, int]] = []  # (end_time, 序号)
+        self._next_id = 0
+        self._matcher: Optional[AhoCorasick] = None
+        for egg in self._load_eggs():
+            self._add(egg)
+
+    @property
+    def eggs(self) -> List[Dict[str, Any]]:
+        """当前有效的彩蛋列表（按添加顺序）"""
+        with self._lock:
+            return [self._eggs[egg_id] for egg_id in sorted(self._eggs)]
     
     def _load_eggs(self) -> List[Dict[str, Any]]:
         """加载彩蛋数据
@@ -216,12 +397,49 @@ class EasterEggManager:
             return []
     
     def _save_eggs(self) -> None:
-        """保存彩蛋数据到文件"""
+        """原子地保存彩蛋数据到文件（调用方持有锁）"""
+        temp_path = f'{self.eggs_file_path}.tmp'
         try:
-            with open(self.eggs_file_path, 'w', encoding='utf8') as f:
-                f.write(json.dumps(self.eggs, ensure_ascii=False, indent=2))
+            eggs = [self._eggs[egg_id] for egg_id in sorted(self._eggs)]
+            with open(temp_path, 'w', encoding='utf8') as f:
+                f.write(json.dumps(eggs, ensure_ascii=False, indent=2))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.eggs_file_path)
         except Exception as e:
             logger.error(f"保存彩蛋文件失败: {e}")
+
+    def _add(self, egg: Dict[str, Any]) -> None:
+        """登记彩蛋（调用方持有锁）"""
+        egg_id = self._next_id
+        self._next_id += 1
+        self._eggs[egg_id] = egg
+        heapq.heappush(self._expiry_heap, (egg.get('end_time', 0), egg_id))
+        self._matcher = None
+
+    def _expire(self, current_time: int) -> bool:
+        """弹出堆顶所有已过期的彩蛋（调用方持有锁）
+
+        Returns:
+            是否有彩蛋被移除
+        """
+        changed = False
+        while self._expiry_heap and self._expiry_heap[0][0] < current_time:
+            _, egg_id = heapq.heappop(self._expiry_heap)
+            # 已被触发的彩蛋在堆中延迟删除
+            if self._eggs.pop(egg_id, None) is not None:
+                changed = True
+        if changed:
+            self._matcher = None
+        return changed
+
+    def _get_matcher(self) -> AhoCorasick:
+        """获取有效彩蛋的自动机，彩蛋集合变化后重建（调用方持有锁）"""
+        if self._matcher is None:
+            self._matcher = AhoCorasick(
+                [(egg.get('egg', ''), egg_id) for egg_id, egg in self._eggs.items()]
+            ).build()
+        return self._matcher
     
     def check_easter_egg(self, message: str) -> Optional[Dict[str, Any]]:
         """检查消息是否触发彩蛋
@@ -233,22 +451,23 @@ class EasterEggManager:
             如果触发彩蛋返回彩蛋信息，否则返回None
         """
         current_time = int(time.time())
-        
-        # 清理过期的彩蛋
-        self.eggs = [egg for egg in self.eggs if egg.get('end_time', 0) >= current_time]
-        
-        # 检查是否触发彩蛋
-        for egg in self.eggs[:]:
-            if egg.get('egg', '') in message:
-                self.eggs.remove(egg)
+
+        with self._lock:
+            # 清理过期的彩蛋
+            changed = self._expire(current_time)
+
+            # 检查是否触发彩蛋，多个命中时取最早添加的
+            triggered = None
+            if self._eggs:
+                hits = [egg_id for _, _, egg_id in self._get_matcher().iter(message)]
+                if hits:
+                    triggered = self._eggs.pop(min(hits))
+                    self._matcher = None
+                    changed = True
+
+            if changed:
                 self._save_eggs()
-                return egg
-        
-        # 如果有彩蛋被清理，保存文件
-        if len([egg for egg in self.eggs if egg.get('end_time', 0) >= current_time]) != len(self.eggs):
-            self._save_eggs()
-        
-        return None
+            return triggered
     
     def add_easter_egg(self, keyword: str, value: int, duration_minutes: int = 60) -> None:
         """添加新的彩蛋
@@ -264,8 +483,9 @@ class EasterEggManager:
             'end_time': end_time,
             'value': value
         }
-        self.eggs.append(egg)
-        self._save_eggs()
+        with self._lock:
+            self._add(egg)
+            self._save_eggs()
     
     def check(self, message: str) -> Optional[Dict[str, Any]]:
         """检查消息是否触发彩蛋（check_easter_egg的别名）
@@ -307,6 +527,76 @@ class MessageSplitter:
         return result
 
 
+class StreamingLineSplitter:
+    """流式文本分行器
+
+    逐段喂入生成中的文本，按换行、句末标点和最大长度切出可以立即发送的行：
+    第一行在第一个句子结束时就切出，以尽快回复；之后的行在不超过最大长度的前提下
+    尽量多装几个完整句子，减少游戏内的发言条数。
+    """
+
+    SENTENCE_ENDINGS = '。！？!?；;…~～'
+
+    def __init__(self, chunk_size: int = 90):
+        self.chunk_size = chunk_size
+        self._buffer = ''
+        self._emitted = 0
+
+    def _last_boundary(self, text: str) -> int:
+        """text中最后一个句子结束位置（不含则返回0）"""
+        for index in range(len(text) - 1, -1, -1):
+            char = text[index]
+            if char in self.SENTENCE_ENDINGS:
+                return index + 1
+            # 英文句号后跟空白才算句末，避免切开小数和网址
+            if char == '.' and index + 1 < len(text) and text[index + 1].isspace():
+                return index + 1
+        return 0
+
+    def _emit(self, line: str, lines: List[str]) -> None:
+        line = line.strip()
+        if line:
+            lines.append(line)
+            self._emitted += 1
+
+    def feed(self, text: str) -> List[str]:
+        """喂入一段新生成的文本
+
+        Returns:
+            已经可以发送的行
+        """
+        lines = []
+        self._buffer += text
+        while True:
+            newline = self._buffer.find('\n')
+            if newline != -1 and newline <= self.chunk_size:
+                self._emit(self._buffer[:newline], lines)
+                self._buffer = self._buffer[newline + 1:]
+                continue
+            if self._emitted == 0:
+                cut = self._last_boundary(self._buffer[:self.chunk_size])
+                if cut:
+                    self._emit(self._buffer[:cut], lines)
+                    self._buffer = self._buffer[cut:]
+                    continue
+            if len(self._buffer) <= self.chunk_size:
+                break
+            # 超过最大长度：在最后一个句末切开，没有句末则硬切
+            cut = self._last_boundary(self._buffer[:self.chunk_size]) or self.chunk_size
+            self._emit(self._buffer[:cut], lines)
+            self._buffer = self._buffer[cut:]
+        return lines
+
+    def flush(self) -> List[str]:
+        """文本生成结束，切出剩余内容"""
+        lines = []
+        remaining, self._buffer = self._buffer, ''
+        for part in remaining.split('\n'):
+            for start in range(0, len(part), self.chunk_size):
+                self._emit(part[start:start + self.chunk_size], lines)
+        return lines
+
+
 class SystemUtils:
     """系统工具类"""
     
@@ -340,11 +630,8 @@ class SystemUtils:
         Returns:
             bool: 玩家是否存在
         """
-        from functions.database import db_manager, RIALogInfo
-        user = db_manager.session.query(RIALogInfo).filter_by(who_string=playername).first()
-        if user is None:
-            return False
-        return True
+        from functions.database import db_service
+        return db_service.is_known_player(playername)
 
     @staticmethod
     def check_email_valid(username:str,email: str) -> bool:
@@ -358,8 +645,13 @@ class SystemUtils:
         Returns:
             bool: 邮箱合理
         """
-        from functions.database import db_manager, RIAPlayers
-        user = db_manager.session.query(RIAPlayers).filter_by(player_name=username).first()
+        from sqlalchemy.orm import Session
+        from functions.database import engine, RIAPlayers
+        temp_session = Session(bind=engine)
+        try:
+            user = temp_session.query(RIAPlayers).filter_by(player_name=username).first()
+        finally:
+            temp_session.close()
         if user is None:
             return True
         else:
@@ -367,8 +659,406 @@ class SystemUtils:
 
 
 
+class TTLCache:
+    """带过期时间和容量上限的线程安全缓存
+
+    超过容量时淘汰最久未使用的条目，读取到过期条目时视为未命中。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()  # 键 -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """读取缓存
+
+        Args:
+            key: 键
+            default: 未命中或已过期时的返回值
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        """写入缓存"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Any) -> None:
+        """删除指定键"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class HostRateLimiter:
+    """按域名的令牌桶限流器
+
+    每个域名独立维护一个令牌桶，acquire会阻塞到拿到令牌为止，
+    多个下载线程共享同一个限流器时，整体请求速率不会超过配置值。
+    """
+
+    def __init__(self, rate: float = None, burst: int = None):
+        self.rate = rate or config.AVATAR_HOST_RATE
+        self.burst = burst or config.AVATAR_HOST_BURST
+        self._buckets: Dict[str, List[float]] = {}  # 域名 -> [令牌数, 上次补充时间]
+        self._lock = threading.Lock()
+
+    def acquire(self, host: str) -> None:
+        """获取指定域名的一个令牌，令牌不足时等待
+
+        Args:
+            host: 域名
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._buckets.setdefault(host, [float(self.burst), now])
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    return
+                wait_time = (1 - bucket[0]) / self.rate
+            time.sleep(wait_time)
+
+
+class IPBanList:
+    """内存中的IP封禁表
+
+    单个IP保存在哈希表中，CIDR网段保存在按地址位展开的前缀树中，
+    每条封禁可带过期时间，过期的封禁在查询时惰性清除。
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, Optional[datetime.datetime]] = {}  # IP -> 过期时间
+        self._tries: Dict[int, dict] = {4: {}, 6: {}}  # IP版本 -> 前缀树根节点
+        self._range_count = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse(entry: str):
+        """解析封禁条目
+
+        Args:
+            entry: IP地址或CIDR网段
+
+        Returns:
+            单个IP返回ip_address对象，网段返回ip_network对象
+
+        Raises:
+            ValueError: 格式不正确
+        """
+        entry = entry.strip()
+        if '/' in entry:
+            network = ipaddress.ip_network(entry, strict=False)
+            if network.num_addresses > 1:
+                return network
+            return network.network_address
+        return ipaddress.ip_address(entry)
+
+    @classmethod
+    def normalize(cls, entry: str) -> str:
+        """封禁条目的规范写法（如 203.0.113.7/32 -> 203.0.113.7，IPv6地址压缩为小写短格式）
+
+        Raises:
+            ValueError: 格式不正确
+        """
+        return str(cls.parse(entry))
+
+    def clear(self) -> None:
+        """清空封禁表"""
+        with self._lock:
+            self._exact.clear()
+            self._tries = {4: {}, 6: {}}
+            self._range_count = 0
+
+    def add(self, entry: str, expires_at: Optional[datetime.datetime] = None) -> None:
+        """添加封禁
+
+        Args:
+            entry: IP地址或CIDR网段
+            expires_at: 过期时间，None表示永久封禁
+        """
+        parsed = self.parse(entry)
+        with self._lock:
+            if isinstance(parsed, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+                node = self._tries[parsed.version]
+                bits = int(parsed.network_address)
+                width = parsed.max_prefixlen
+                for i in range(parsed.prefixlen):
+                    node = node.setdefault((bits >> (width - 1 - i)) & 1, {})
+                if 'ban' not in node:
+                    self._range_count += 1
+                node['ban'] = expires_at
+            else:
+                self._exact[str(parsed)] = expires_at
+
+    def remove(self, entry: str) -> bool:
+        """移除封禁
+
+        Args:
+            entry: IP地址或CIDR网段
+
+        Returns:
+            是否存在该封禁
+        """
+        parsed = self.parse(entry)
+        with self._lock:
+            if isinstance(parsed, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+                node = self._tries[parsed.version]
+                bits = int(parsed.network_address)
+                width = parsed.max_prefixlen
+                for i in range(parsed.prefixlen):
+                    node = node.get((bits >> (width - 1 - i)) & 1)
+                    if node is None:
+                        return False
+                if 'ban' not in node:
+                    return False
+                del node['ban']
+                self._range_count -= 1
+                return True
+            return self._exact.pop(str(parsed), False) is not False
+
+    def contains(self, ip: str, now: Optional[datetime.datetime] = None) -> bool:
+        """检查IP是否被封禁（包括所在网段被封禁）
+
+        Args:
+            ip: IP地址
+            now: 当前时间，用于判断过期
+
+        Returns:
+            是否被封禁
+        """
+        try:
+            address = ipaddress.ip_address(ip.strip())
+        except (ValueError, AttributeError):
+            return False
+        # IPv4映射的IPv6地址按IPv4处理
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        now = now or datetime.datetime.now()
+
+        with self._lock:
+            key = str(address)
+            if key in self._exact:
+                expires_at = self._exact[key]
+                if expires_at is None or expires_at > now:
+                    return True
+                del self._exact[key]
+
+            if not self._range_count:
+                return False
+            node = self._tries[address.version]
+            bits = int(address)
+            width = address.max_prefixlen
+            for i in range(width + 1):
+                if 'ban' in node:
+                    expires_at = node['ban']
+                    if expires_at is None or expires_at > now:
+                        return True
+                    del node['ban']
+                    self._range_count -= 1
+                if i == width:
+                    break
+                node = node.get((bits >> (width - 1 - i)) & 1)
+                if node is None:
+                    break
+            return False
+
+    def __len__(self) -> int:
+        return len(self._exact) + self._range_count
+
+
+class MessageDoorbell:
+    """跨进程消息门铃
+
+    Web进程向发送队列写入消息后，通过本机UDP数据报唤醒机器人进程的发送线程，
+    机器人进程不再需要每秒轮询数据库。同进程内的调用直接通过Event唤醒。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = None):
+        self.host = host
+        self.port = port or config.MSG_DOORBELL_PORT
+        self._event = threading.Event()
+        self._sock = None
+        self._listener = None
+
+    def ring(self) -> None:
+        """通知发送线程有新消息（发送失败时由兜底轮询补偿）"""
+        self._event.set()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b'1', (self.host, self.port))
+        except OSError as e:
+            logger.warning(f"消息门铃通知失败: {e}")
+
+    def start_listening(self) -> bool:
+        """开始监听门铃数据报
+
+        Returns:
+            是否监听成功
+        """
+        if self._listener is not None:
+            return True
+        try:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind((self.host, self.port))
+        except OSError as e:
+            logger.warning(f"消息门铃监听失败，将仅依赖兜底轮询: {e}")
+            self._sock = None
+            return False
+
+        self._listener = threading.Thread(target=self._listen_loop, name='message-doorbell', daemon=True)
+        self._listener.start()
+        logger.info(f"消息门铃已在 {self.host}:{self.port} 上监听")
+        return True
+
+    def _listen_loop(self) -> None:
+        """门铃监听线程"""
+        while self._sock is not None:
+            try:
+                self._sock.recvfrom(64)
+            except OSError:
+                break
+            self._event.set()
+
+    def wait(self, timeout: float) -> bool:
+        """等待门铃响起
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            是否被门铃唤醒（False表示超时）
+        """
+        fired = self._event.wait(timeout)
+        self._event.clear()
+        return fired
+
+    def stop(self) -> None:
+        """停止监听"""
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._listener = None
+        self._event.set()
+
+
+class ChatOutbox:
+    """游戏内聊天发件箱
+
+    所有游戏内发言经过同一个节流点，保证相邻两条之间至少间隔 CHAT_SEND_INTERVAL 秒。
+    send() 只入队立即返回，由发件线程按节奏发出；send_now() 在调用线程中等待节流后发送。
+    """
+
+    def __init__(self, interval: float = None, max_pending: int = None):
+        self.interval = interval if interval is not None else config.CHAT_SEND_INTERVAL
+        self.max_pending = max_pending or config.CHAT_OUTBOX_MAX_PENDING
+        self._sender = None
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._last_sent = 0.0
+        self._thread = None
+        self._running = False
+
+    def start(self, sender) -> None:
+        """启动发件线程
+
+        Args:
+            sender: 实际发送一条聊天的函数，如 bot.chat
+        """
+        with self._cond:
+            self._sender = sender
+            if self._running:
+                return
+            self._running = True
+            # 停止后立即重启时旧线程可能还没退出，它发现自己不再是当前线程就会退出
+            self._thread = threading.Thread(target=self._send_loop, name='chat-outbox', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """停止发件线程（未发出的消息被丢弃）"""
+        with self._cond:
+            self._running = False
+            self._thread = None
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def send(self, text: str) -> bool:
+        """把一条聊天放入发件箱，立即返回
+
+        Returns:
+            是否入队（积压超过上限时丢弃）
+        """
+        with self._cond:
+            if len(self._queue) >= self.max_pending:
+                logger.warning(f"聊天发件箱积压已满，丢弃消息: {text}")
+                return False
+            self._queue.append(text)
+            self._cond.notify()
+        return True
+
+    def send_now(self, text: str) -> None:
+        """在调用线程中等待节流后发送一条聊天（发送失败时抛出异常）"""
+        with self._send_lock:
+            delay = self._last_sent + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._sender(text)
+            finally:
+                self._last_sent = time.monotonic()
+
+    def _send_loop(self) -> None:
+        """发件线程"""
+        current = threading.current_thread()
+        while True:
+            with self._cond:
+                while self._running and self._thread is current and not self._queue:
+                    self._cond.wait()
+                if not self._running or self._thread is not current:
+                    return
+                text = self._queue.popleft()
+            try:
+                self.send_now(text)
+            except Exception as e:
+                logger.error(f"发送聊天失败: {e}")
+
+    @property
+    def pending(self) -> int:
+        """发件箱中尚未发出的消息数"""
+        return len(self._queue)
+
+
 # 创建全局实例
 email_service = EmailService()
 text_validator = TextValidator()
 easter_egg_manager = EasterEggManager()
-message_splitter = MessageSplitter()
\ No newline at end of file
+message_splitter = MessageSplitter()
+message_doorbell = MessageDoorbell()
+chat_outbox = ChatOutbox()
+avatar_index = AvatarIndex()
@@ -5,6 +5,7 @@ import random
 import re
 import socket
 import sys
+import threading
 import time
 from typing import Dict, Any
 import traceback
@@ -19,10 +20,16 @@ from functions import (
     DatabaseManager, RIAOnline, RIALogInfo, RIAMsgSend, RIALogCommon, db_service,
     GeometryUtils, SystemUtils, EasterEggManager,
     main_ai,
-    keys, keys_set,
+    knowledge_base,
     get_kook_api_instance, send_kook_message, create_tables
 )
 from functions import logger, logger_com, logger_ai
+from functions.utils import message_doorbell, chat_outbox
+from functions.ai_worker import ai_worker_pool
+from functions.conversation import conversation_store, answer_cache
+from functions.ai_resilience import ai_resilience
+from functions.map_sampler import map_sampler
+from functions.presence import presence_tracker
 
 logger.info('正在初始化...')
 
@@ -38,9 +45,9 @@ kook_api = get_kook_api_instance()
 # 常量定义
 WELCOME_MESSAGE = '向着星辰与深渊！欢迎来到冒险家协会'
 
-# AI对话缓存
+# AI对话缓存（玩家数有上限，过期会话由定时任务清理）
 ai_conversation_cache: Dict[str, Any] = {}
-caches: Dict[str, Any] = {}
+caches = conversation_store
 
 # AI访问令牌（已废弃，保持兼容性）
 ai_token = None
@@ -120,7 +127,7 @@ class TimetableManager:
         if distance < tolerance:
             return
         else:
-            bot.chat(f'/home {place2}')
+            chat_outbox.send_now(f'/home {place2}')
 
     def register_aps(self) -> None:
         """注册时间表任务到调度器"""
@@ -183,7 +190,7 @@ class GameUtils:
             tolerance = 5  # 允许的位置误差
 
             if distance >= tolerance:
-                bot.chat(f'/home {place}')
+                chat_outbox.send_now(f'/home {place}')
                 logger.info(f"位置偏离过大，传送到 {place}")
         except Exception as e:
             logger.error(f"检查传送位置失败: {e}")
@@ -216,12 +223,33 @@ class GameUtils:
         logger.error(f'程序结束，原因：{reason_str}')
         print(f'程序结束，原因：{reason_str}')
 
+        # 机器人下线后无法再观察到玩家，结束所有在线时段
+        try:
+            presence_tracker.close_all('offline')
+        except Exception as e:
+            logger.error(f"结束玩家在线时段失败: {e}")
+
+        # 刷新日志写入缓冲，确保内存中的日志全部落库
+        try:
+            db_service.close()
+            logger.info(f'日志写入缓冲已刷新：{db_service.get_ingest_stats()}')
+        except Exception as e:
+            logger.error(f"刷新日志写入缓冲失败: {e}")
+
         # 关闭数据库连接
         try:
             db_manager.close()
         except Exception as e:
             logger.error(f"关闭数据库连接失败: {e}")
 
+        # 停止消息发送线程、AI线程池和发件箱
+        try:
+            MessageManager.stop_dispatcher()
+            ai_worker_pool.stop()
+            chat_outbox.stop()
+        except Exception as e:
+            logger.error(f"停止消息发送线程失败: {e}")
+
         # 退出机器人
         try:
             bot.quit()
@@ -279,6 +307,9 @@ class GameUtils:
                 bot.look(num, 0)
                 players = bot.players.valueOf()
                 logger.info(f'当前在线玩家数量：{len(players.keys())}')
+                GameUtils.reconcile_presence(players)
+                logger.info(f'日志写入缓冲状态：{db_service.get_ingest_stats()}')
+                logger_ai.info(f'AI接口状态：{ai_resilience.get_stats()}')
 
 
             except Exception as e:
@@ -289,41 +320,47 @@ class GameUtils:
         except Exception as e:
             logger.error(f'检查在线状态失败: {e}')
             return False
+
+    @staticmethod
+    def reconcile_presence(players: Dict[str, Any] = None) -> None:
+        """用 bot.players 对账玩家在线时段，补上漏掉的加入/离开事件
+
+        Args:
+            players: bot.players.valueOf() 的结果，默认现取
+        """
+        try:
+            if players is None:
+                players = bot.players.valueOf()
+            names = [name for name in players.keys() if name != bot.username]
+            joined, left = presence_tracker.reconcile(names)
+            if joined or left:
+                logger.info(f'在线时段对账：补记加入 {joined} 人，补记离开 {left} 人')
+        except Exception as e:
+            logger.error(f"对账玩家在线时段失败: {e}")
+
     @staticmethod
     def fetch_online_player_by_map_api() -> tuple[list,bool]:
-        """通过地图API获取当前在线玩家"""
-        if not config.MAP_API:  # 如果没有配置地图API，则不进行操作
-            return [], False
-        headers = {
-            'authority': 'satellite.ria.red',
-            'sec-ch-ua': '" Not A;Brand";v="99", "Chromium";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.84 Safari/537.36 HBPC/12.1.3.310',
-            'sec-ch-ua-platform': '"Windows"',
-            'accept': '*/*',
-            'sec-fetch-site': 'same-origin',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-dest': 'empty',
-            'referer': 'https://satellite.ria.red/map/zth',
-            'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8',
-        }
-        query = requests.get(config.MAP_API+f'/{int(time.time()*1000)}', headers=headers)
-        if query.status_code != 200:
-            return [], False
-        players = query.json().get('players', [])
-        return players, True
+        """通过地图API获取当前在线玩家（新鲜度窗口内复用缓存结果）"""
+        return map_sampler.get_players()
+
+    # 上次写入的采样：(快照版本, 整点时间)
+    _last_sample_key = None
+
     @staticmethod
     def fetch_online_player_by_map():
-        """获取当前在线玩家并记录"""
-        players, success = GameUtils.fetch_online_player_by_map_api()
-        if not success:
+        """获取当前在线玩家并记录
+
+        玩家集合和位置都没有变化时跳过写入，但每个小时至少写入一次，保证小时汇总完整。
+        """
+        snapshot = map_sampler.snapshot()
+        if snapshot is None:
+            return
+        sample_key = (snapshot.version, datetime.datetime.now().replace(minute=0, second=0, microsecond=0))
+        if sample_key == GameUtils._last_sample_key:
             return
-        # 使用DatabaseService的方法记录在线玩家
-        for player_body in players:
-            player_name = player_body.get('account', '')
-            record_ = ['armor', 'x', 'y', 'z', 'health']
-            data = [player_body.get(key, '') for key in record_]
-            db_service.record_online_player(player_name, data)
+        # 一次采样写入一行紧凑记录
+        db_service.record_online_sample(snapshot.players)
+        GameUtils._last_sample_key = sample_key
 
 
 # noinspection PyUnresolvedReferences,PyTypeChecker
@@ -377,9 +414,15 @@ class BotEventHandler:
             kook_api.send_message(config.KOOK_MAIN_CHANNEL, notification)
             logger.info(notification)
 
-            # 游戏内通知和奖励
-            bot.chat(f'{username}触发了彩蛋关键词-{keyword}-！恭喜{username}获得 O锭*{value} ！')
-            bot.chat(f'/pay {username} {value}')
+            # 游戏内奖励和通知（同步发送，不经过可能丢弃消息的发件队列）
+            try:
+                chat_outbox.send_now(f'/pay {username} {value}')
+            except Exception as e:
+                failure = f'彩蛋奖励发放失败，需要手动补发: /pay {username} {value}（{e}）'
+                logger.error(failure)
+                kook_api.send_message(config.KOOK_MAIN_CHANNEL, failure)
+                return
+            chat_outbox.send_now(f'{username}触发了彩蛋关键词-{keyword}-！恭喜{username}获得 O锭*{value} ！')
 
         except Exception as e:
             logger.error(f"处理彩蛋事件失败: {e}")
@@ -408,14 +451,20 @@ class BotEventHandler:
             time.sleep(1)
             if timetable_manager is not None:
                 place = timetable_manager.place
-                bot.chat(f'/home {place}')
+                chat_outbox.send_now(f'/home {place}')
                 logger.info(f'传送指令已输入，目标位置: {place}')
             else:
                 # 如果timetable_manager未初始化，使用默认位置
                 default_place = 'main'
-                bot.chat(f'/home {default_place}')
+                chat_outbox.send_now(f'/home {default_place}')
                 logger.warning(f'时间表管理器未初始化，使用默认位置: {default_place}')
 
+            # 以当前玩家列表为准对账在线时段（重连期间的加入/离开事件会丢失）
+            GameUtils.reconcile_presence()
+
+            # 登录完成后立即处理积压的待发送消息
+            message_doorbell.ring()
+
         except Exception as e:
             logger.error(f"处理登录事件失败: {e}")
 
@@ -477,6 +526,7 @@ class BotEventHandler:
                 return
 
             logger.info(f"{username} 加入了RIA")
+            presence_tracker.player_joined(username)
 
             join_message = f"{username} 加入了RIA-零洲。"
             kook_api.send_message(config.KOOK_MAIN_CHANNEL, join_message)
@@ -499,6 +549,7 @@ class BotEventHandler:
                 return
 
             logger.info(f"{username} 离开了RIA")
+            presence_tracker.player_left(username)
 
         except Exception as e:
             logger.error(f"处理玩家离开事件失败: {e}")
@@ -526,24 +577,24 @@ class BotEventHandler:
                 place = timetable_manager.place
                 place_map_2 = timetable_manager.info.place_map_2
                 if place == 'iron':
-                    bot.chat("/m " + playername + " 你好，现在为凌晨，将延迟1s传送。")
-                    bot.chat("/home main")
+                    chat_outbox.send_now("/m " + playername + " 你好，现在为凌晨，将延迟1s传送。")
+                    chat_outbox.send_now("/home main")
                     time.sleep(1.1)
-                    bot.chat("/tpaccept")
+                    chat_outbox.send_now("/tpaccept")
                     time.sleep(0.1)
 
-                    bot.chat(
+                    chat_outbox.send_now(
                         "/m " + playername + f" 你好，我已接受传送请求。{WELCOME_MESSAGE}。这里是-->{place_map_2['main']}<--")
                     time.sleep(1.1)
-                    bot.chat("/m " + playername + " 我还有事，先走了。")
+                    chat_outbox.send_now("/m " + playername + " 我还有事，先走了。")
                     time.sleep(0.1)
-                    bot.chat('/back')
+                    chat_outbox.send_now('/back')
                     send_kook_message(config.KOOK_MAIN_CHANNEL, f'接受来自{playername}的传送请求')
                     logger.info(f'接受来自{playername}的传送请求')
                     return
-                bot.chat("/tpaccept")
+                chat_outbox.send_now("/tpaccept")
                 time.sleep(0.1)
-                bot.chat(
+                chat_outbox.send_now(
                     "/m " + playername + f" 你好，我已接受传送请求。{WELCOME_MESSAGE}。这里是-->{place_map_2[place]}<--")
                 send_kook_message(config.KOOK_MAIN_CHANNEL, f'接受来自{playername}的传送请求')
                 logger.info(f'接受来自{playername}的传送请求')
@@ -555,52 +606,132 @@ class BotEventHandler:
                 user = message.split('-> 你]')[0].replace(' ', '')[1:]
                 msg = message.split('-> 你]')[1].replace(' ', '')
                 logger.info(f'msg:{msg}')
-                # 对msg的关键词搜查，用于调用知识库来回答问题
-                keys_used_dict = dict()
-                keys_cache = []
-                for key_word in keys_set:
-                    if key_word in msg:
-                        # 需要考虑同一个关键词命中两次的问题
-                        if keys[key_word] not in keys_cache:
-                            keys_used_dict[key_word] = keys[key_word]
-                            keys_cache.append(keys[key_word])
-                del keys_cache
-                logger_ai.info(f'{user}:{msg}')
-                send_kook_message(config.KOOK_AI_CHANNEL, f'{user}:{msg}')
-                global caches
-                answer, caches = main_ai(user, msg, caches, reference=keys_used_dict)
-                if '/pay' in answer:
-                    answer = '请不要这么做。这并不好玩。'
-                ans1 = re.split('\n', answer)
-
-                def split_string(answer, chunk_size=90):
-                    # 使用列表推导式来分割字符串
-                    chunks = [answer[i:i + chunk_size] for i in range(0, len(answer), chunk_size)]
-                    return chunks
-
-                result = []
-                for i in ans1:
-                    aaa = split_string(i)
-                    if aaa != []:
-                        result.append(aaa[0])
-                for iii in result:
-                    bot.chat(f'/m {user} {iii}')
-                    time.sleep(1.1)
-                logger_ai.info(f'AI:{answer}')
-                send_kook_message(config.KOOK_AI_CHANNEL, f'AI:{answer}')
+                if user in config.AI_ADMINS and BotEventHandler._handle_admin_command(user, msg):
+                    return
+                # AI请求交给线程池处理，不阻塞事件回调线程；排队已满时回复繁忙提示
+                if not ai_worker_pool.submit(user, BotEventHandler._answer_private_message, user, msg):
+                    logger_ai.info(f'AI请求排队已满，忽略 {user}:{msg}')
+                    chat_outbox.send(f'/m {user} {config.AI_BUSY_REPLY}')
             else:
                 return
 
         except Exception as e:
             logger.error(f"处理消息字符串事件失败: {e}")
 
+    @staticmethod
+    def _handle_admin_command(user: str, msg: str) -> bool:
+        """处理管理员私聊指令
+
+        Args:
+            user: 管理员玩家名
+            msg: 私聊内容（已去掉空格）
+
+        Returns:
+            是否是管理指令
+        """
+        if msg == '#清空回答缓存':
+            count = answer_cache.purge()
+            reply = f'已清空AI回答缓存 {count} 条'
+        elif msg == '#回答缓存':
+            stats = answer_cache.get_stats()
+            reply = (f"AI回答缓存 {stats['size']} 条，命中 {stats['hits']} 次，"
+                     f"未命中 {stats['misses']} 次，命中率 {stats['hit_rate']:.1%}")
+        elif msg == '#AI状态':
+            stats = ai_resilience.get_stats()
+            latency = '，'.join(
+                f"{operation} p50={item['p50_ms']}ms p95={item['p95_ms']}ms 成功{item['outcomes'].get('ok', 0)}/{item['count']}"
+                for operation, item in stats['latency'].items()
+            ) or '暂无请求'
+            reply = f"AI熔断器 {stats['breaker']}，{latency}"
+        else:
+            return False
+        logger_ai.info(f'{user} 执行管理指令 {msg}：{reply}')
+        chat_outbox.send(f'/m {user} {reply}')
+        return True
+
+    @staticmethod
+    def _answer_private_message(user: str, msg: str) -> None:
+        """在AI线程池中回答玩家私聊（同一玩家的请求按顺序执行）
+
+        Args:
+            user: 玩家名
+            msg: 私聊内容
+        """
+        # 对msg的关键词搜查，用于调用知识库来回答问题
+        keys_used_dict = knowledge_base.lookup(msg)
+        logger_ai.info(f'{user}:{msg}')
+        send_kook_message(config.KOOK_AI_CHANNEL, f'{user}:{msg}')
+        if config.AI_STREAM:
+            BotEventHandler._answer_streaming(user, msg, keys_used_dict)
+            return
+        # caches是全局对话缓存，main_ai原地更新，不重新绑定
+        answer, _ = main_ai(user, msg, caches, reference=keys_used_dict)
+        if '/pay' in answer:
+            answer = '请不要这么做。这并不好玩。'
+        ans1 = re.split('\n', answer)
+
+        def split_string(answer, chunk_size=90):
+            # 使用列表推导式来分割字符串
+            chunks = [answer[i:i + chunk_size] for i in range(0, len(answer), chunk_size)]
+            return chunks
+
+        result = []
+        for i in ans1:
+            aaa = split_string(i)
+            if aaa != []:
+                result.append(aaa[0])
+        # 回复放入发件箱，由发件线程按节奏发出
+        for iii in result:
+            chat_outbox.send(f'/m {user} {iii}')
+        logger_ai.info(f'AI:{answer}')
+        send_kook_message(config.KOOK_AI_CHANNEL, f'AI:{answer}')
+
+    @staticmethod
+    def _answer_streaming(user: str, msg: str, reference: Dict[str, str]) -> None:
+        """流式回答玩家私聊：每生成一行就放入发件箱，KOOK在结束后同步完整回答
+
+        Args:
+            user: 玩家名
+            msg: 私聊内容
+            reference: 知识库参考内容
+        """
+        sent_text = []
+        blocked = False
+
+        def on_line(line: str) -> None:
+            nonlocal blocked
+            if blocked:
+                return
+            sent_text.append(line)
+            if '/pay' in ''.join(sent_text[-2:]):
+                blocked = True
+                chat_outbox.send(f'/m {user} 请不要这么做。这并不好玩。')
+                return
+            chat_outbox.send(f'/m {user} {line}')
+
+        answer, _ = main_ai(user, msg, caches, reference=reference, on_line=on_line)
+        if blocked:
+            answer = f'{answer}\n（回复包含/pay，已中止发送）'
+        logger_ai.info(f'AI:{answer}')
+        send_kook_message(config.KOOK_AI_CHANNEL, f'AI:{answer}')
+
+    @staticmethod
+    def sweep_conversations() -> None:
+        """清理过期的AI会话"""
+        try:
+            swept = caches.sweep()
+            if swept:
+                logger_ai.info(f'清理过期AI会话 {swept} 个，当前：{caches.get_stats()}')
+        except Exception as e:
+            logger.error(f"清理AI会话失败: {e}")
+
     @staticmethod
     def handle_spawn(this) -> None:
         """处理重生事件"""
         try:
             logger.info(f"----------{bot.username}----------重生")
             place = timetable_manager.place if timetable_manager else 'main'
-            bot.chat(f'/home {place}')
+            chat_outbox.send_now(f'/home {place}')
             logger.info(f"重生后传送到 {place}")
         except Exception as e:
             logger.error(f"处理重生事件失败: {e}")
@@ -657,6 +788,9 @@ class BotEventHandler:
             end_message = f"程序结束，参数: {args}"
             logger.info(end_message)
             print(end_message)
+
+            # 连接断开，结束所有在线时段
+            presence_tracker.close_all('disconnect')
             
             # 主动关闭调度器，确保程序能够退出
             if timetable_manager and timetable_manager.scheduler.running:
@@ -715,9 +849,9 @@ class BotEventHandler:
         """传送到刷铁塔"""
         try:
             place = 'iron'
-            bot.chat(f'/home {place}')
+            chat_outbox.send_now(f'/home {place}')
             time.sleep(1.3)
-            bot.chat('/sit')
+            chat_outbox.send_now('/sit')
 
             message = '抵达刷铁塔'
             kook_api.send_message(config.KOOK_MAIN_CHANNEL, message)
@@ -731,15 +865,15 @@ class BotEventHandler:
         """传送到主要位置并执行签到"""
         try:
             place = 'main'
-            bot.chat(f'/home {place}')
+            chat_outbox.send_now(f'/home {place}')
 
             message = '抵达-云岫郡外交公馆'
             kook_api.send_message(config.KOOK_MAIN_CHANNEL, message)
             logger.info(message)
 
             # 坐下并签到
-            bot.chat('/sit')
-            bot.chat('/signin click')
+            chat_outbox.send_now('/sit')
+            chat_outbox.send_now('/signin click')
             logger.info('签到完成')
 
             time.sleep(0.9)
@@ -754,7 +888,7 @@ class BotEventHandler:
         """传送到社区位置"""
         try:
             place = 'community'
-            bot.chat(f'/home {place}')
+            chat_outbox.send_now(f'/home {place}')
 
             message = '抵达-云岫郡外交公馆'
             kook_api.send_message(config.KOOK_MAIN_CHANNEL, message)
@@ -1033,43 +1167,83 @@ def register_event_handlers():
 
 
 class MessageManager:
-    """消息管理器"""
+    """消息管理器
+
+    由发送线程处理网页端写入的发送队列：被门铃唤醒后认领一批消息，
+    发送后批量确认；门铃丢失时由低频兜底轮询补偿。
+    """
+    _running = False
+    _thread = None
+
     @staticmethod
     def send_pending_messages() -> None:
-        """发送待发送的消息"""
+        """发送待发送的消息（认领 -> 发送 -> 批量确认）"""
         try:
             if not GameUtils.check_entity_status():
                 return
 
-            # 使用DatabaseService的方法获取待发送消息
-            pending_messages = db_service.get_pending_messages()
+            while True:
+                # 使用DatabaseService的方法认领一批待发送消息
+                pending_messages = db_service.claim_messages()
 
-            if not pending_messages:
-                return
+                if not pending_messages:
+                    return
 
-            # 发送消息
-            for message in pending_messages:
-                try:
-                    # 处理编码问题
-                    text = message.text
-                    if isinstance(text, bytes):
-                        text = text.decode('utf-8')
+                sent_ids = []
+                failed = False
+                for message in pending_messages:
+                    try:
+                        # 处理编码问题
+                        text = message['text']
+                        if isinstance(text, bytes):
+                            text = text.decode('utf-8')
 
-                    logger.info(f'发送消息: {text}')
-                    bot.chat(text)
+                        logger.info(f'发送消息: {text}')
+                        chat_outbox.send_now(text)  # 与其他游戏内发言共用节流，避免发送过快
+                        sent_ids.append(message['id'])
 
-                    # 使用DatabaseService的方法删除已发送的消息
-                    db_service.delete_message(message.id)
+                    except Exception as e:
+                        logger.error(f'发送消息失败: {e}')
+                        db_service.mark_messages_failed([message['id']], str(e))
+                        failed = True
+                        continue
 
-                    time.sleep(1)  # 避免发送过快
+                # 批量删除已发送的消息
+                db_service.ack_messages(sent_ids)
 
-                except Exception as e:
-                    logger.error(f'发送消息失败: {e}')
-                    continue
+                # 出现失败时结束本轮，失败的消息等退避时间过后由下一轮处理
+                if failed:
+                    return
 
         except Exception as e:
             logger.error(f'处理待发送消息失败: {e}')
 
+    @staticmethod
+    def _dispatch_loop() -> None:
+        """发送线程：启动时先清空积压，之后等待门铃或兜底轮询"""
+        while MessageManager._running:
+            MessageManager.send_pending_messages()
+            message_doorbell.wait(config.MSG_QUEUE_POLL_INTERVAL)
+
+    @staticmethod
+    def start_dispatcher() -> None:
+        """启动消息发送线程"""
+        if MessageManager._running:
+            return
+        MessageManager._running = True
+        message_doorbell.start_listening()
+        MessageManager._thread = threading.Thread(
+            target=MessageManager._dispatch_loop, name='message-dispatcher', daemon=True
+        )
+        MessageManager._thread.start()
+        logger.info('消息发送线程已启动')
+
+    @staticmethod
+    def stop_dispatcher() -> None:
+        """停止消息发送线程"""
+        MessageManager._running = False
+        message_doorbell.stop()
+
 
 # 初始化全局变量
 minecraft_bot = None
@@ -1118,22 +1292,27 @@ def setup_scheduled_tasks():
         )
 
 
-        timetable_manager.scheduler.add_job(
-            MessageManager.send_pending_messages,
-            'cron',
-            second='*',
-            id='send_pending_messages',
-            misfire_grace_time=1,
-            max_instances=1
-        )
+        # 游戏内发言统一经过发件箱节流；AI私聊由线程池处理
+        chat_outbox.start(lambda text: bot.chat(text))
+        ai_worker_pool.start()
+
+        # 消息发送由门铃唤醒的发送线程处理，不再每秒轮询数据库
+        MessageManager.start_dispatcher()
 
         timetable_manager.scheduler.add_job(
             GameUtils.fetch_online_player_by_map,
-            'cron',
-            hour='*',
+            'interval',
+            seconds=config.ONLINE_SAMPLE_INTERVAL,
             id='record_online_players'
         )
 
+        timetable_manager.scheduler.add_job(
+            BotEventHandler.sweep_conversations,
+            'interval',
+            seconds=60,
+            id='sweep_conversations'
+        )
+
         # 可选的传送任务（注释掉，可根据需要启用）
         # timetable_manager.scheduler.add_job(
         #     GameUtils.transport_to_iron_farm,
@@ -22,11 +22,12 @@ from functions import (
     DatabaseManager, RIALogInfo, RIALogCommon, 
     EmailService,
     RIAMsgSend, RIAPlayers, WEBBannedIPs,
-    SystemUtils, logger, logger_send, avatar_downloader,
+    SystemUtils, logger, logger_send, avatar_downloader, log_publisher, recent_log_cache, log_archiver,
     create_tables,
     config, socketio, app, db_service
 )
 from functions.square.dashboard_handle import dashboard_handler
+from functions.utils import FileUtils, TTLCache, avatar_index
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 
@@ -52,6 +53,8 @@ class WebServer:
         
         # 创建数据库表
         create_tables()
+        # 加载IP封禁表，之后的封禁检查只查内存
+        logger.info(f'IP封禁表已加载，共 {db_service.load_ip_bans()} 条')
         # 使用从functions模块导入的socketio实例（已经与app绑定）
         self.socketio = socketio
         self.login_manager = LoginManager()
@@ -60,6 +63,8 @@ class WebServer:
         # 配置登录管理器
         self.login_manager.init_app(self.app)
         self.login_manager.user_loader(self.load_user)
+        # 登录用户缓存，避免每个已认证请求都查询数据库
+        self.user_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
         
         # 验证码缓存
         self.verification_cache: Dict[str, Dict[str, Any]] = {}
@@ -67,9 +72,17 @@ class WebServer:
         # 注册路由
         self._register_routes()
         
-        # 启动头像下载器
+        # 建立头像索引并启动头像下载器
+        logger.info(f'头像索引已建立，共 {avatar_index.scan()} 个头像')
         self.avatar_downloader.start()
         
+        # 加载最近日志缓存，页面渲染和增量推送从内存读取
+        recent_log_cache.load()
+        
+        # 启动日志推送服务（服务端统一查询新日志并推送给订阅的客户端）
+        self.log_publisher = log_publisher
+        self.log_publisher.start()
+        
         # 初始化定时任务调度器
         self.scheduler = BackgroundScheduler()
         self._setup_scheduled_tasks()
@@ -159,9 +172,14 @@ class WebServer:
         try:
             if not user_id: return None
             if user_id == 'None': return None
+            user_id = int(user_id)
+            user = self.user_cache.get(user_id)
+            if user is not None:
+                return user
             logger.debug(f'尝试加载用户，用户ID: {user_id}')
-            user = self.db_manager.session.query(RIAPlayers).filter_by(id=int(user_id)).first()
+            user = db_service.get_player(user_id)
             if user:
+                self.user_cache.set(user_id, user)
                 logger.debug(f'成功加载用户: {user.player_name} (ID: {user.id})')
             else:
                 logger.warning(f'未找到用户ID: {user_id}')
@@ -181,26 +199,16 @@ class WebServer:
             日志数据列表、最大ID、最小ID
         """
         try:
-            # 查询日志数据
-            if log_type == 1:
-                logs = (self.db_manager.session.query(RIALogInfo)
-                       .order_by(desc(RIALogInfo.t))
-                       .limit(20)
-                       .all())
-            else:
-                logs = (self.db_manager.session.query(RIALogCommon)
-                       .order_by(desc(RIALogCommon.t))
-                       .limit(20)
-                       .all())
+            # 从最近日志缓存读取（按ID升序，即时间顺序）
+            buffer = recent_log_cache.chat if log_type == 1 else recent_log_cache.common
+            logs = buffer.newest(20)
             
             log_data = []
             
-            # 反向遍历以获得正确的时间顺序
-            for log in reversed(logs):
+            for log in logs:
                 if log_type == 1:
-                    # 检查头像文件
-                    avatar_path = f'./static/img/{log.who_string}.png'
-                    if not os.path.exists(avatar_path):
+                    # 检查头像索引
+                    if not FileUtils.check_player_avatar_exists(log.who_string):
                         self.avatar_downloader.add_player(log.who_string)
                         img_path = 'default.jpg'
                     else:
@@ -244,7 +252,15 @@ class WebServer:
                 name='每日仪表板数据处理',
                 replace_existing=True
             )
-            logger.info('定时任务设置完成：每日午夜12点执行仪表板数据处理')
+            # 每日凌晨3点归档超过保留期限的原始日志
+            self.scheduler.add_job(
+                func=self._daily_archive_task,
+                trigger=CronTrigger(hour=3, minute=0),
+                id='daily_archive_task',
+                name='每日日志归档',
+                replace_existing=True
+            )
+            logger.info('定时任务设置完成：每日午夜12点执行仪表板数据处理，凌晨3点归档旧日志')
         except Exception as e:
             logger.error(f'设置定时任务失败: {e}')
     
@@ -260,6 +276,15 @@ class WebServer:
         except Exception as e:
             logger.error(f'每日仪表板数据处理任务异常: {e}')
 
+    def _daily_archive_task(self):
+        """每日日志归档任务"""
+        try:
+            logger.info('开始执行每日日志归档任务')
+            results = log_archiver.run()
+            logger.info(f'每日日志归档任务完成: {results}')
+        except Exception as e:
+            logger.error(f'每日日志归档任务异常: {e}')
+
     def _register_routes(self):
         """注册所有路由"""
         # 根路由需要特殊处理：先检查IP封禁，然后处理400错误并封禁
@@ -273,6 +298,7 @@ class WebServer:
         self.app.add_url_rule('/square', 'square_page', self.check_ip_ban(login_required(self.square_page)), methods=['GET'])
         self.app.add_url_rule('/square/dashboard', 'dashboard_page', self.check_ip_ban(login_required(self.dashboard_page)), methods=['GET'])
         self.app.add_url_rule('/square/dashboard/api', 'dashboard_page_api', self.check_ip_ban(login_required(self.dashboard_page_api)), methods=['GET'])
+        self.app.add_url_rule('/square/dashboard/today', 'dashboard_today_api', self.check_ip_ban(login_required(self.dashboard_today_api)), methods=['GET'])
         self.app.add_url_rule('/register', 'register', self.check_ip_ban(self.register), methods=['GET', 'POST'])
         self.app.add_url_rule('/msg_send', 'msg_send', self.check_ip_ban(login_required(self.msg_send)), methods=['POST'])
         self.app.add_url_rule('/login_api/send', 'login_api_send', self.check_ip_ban(self.login_api_send), methods=['POST'])
@@ -307,8 +333,9 @@ class WebServer:
             # 记录日志并保存到数据库
             logger_send.info(text)
             
-            msg_obj = RIAMsgSend(text=text)
-            self.db_manager.add_and_commit(msg_obj)
+            # 写入发送队列并唤醒机器人进程
+            if db_service.enqueue_message(text) is None:
+                return jsonify({'status': 1, 'message': '发送失败'})
             
             return jsonify({'status': 0, 'message': '发送成功'})
             
@@ -401,17 +428,33 @@ class WebServer:
             return render_template('error.html', error='页面加载失败')
 
     def dashboard_page_api(self):
-        """数据分析页面API"""
+        """数据分析页面API
+        
+        不带参数时返回昨天的数据；带 range=week/month 或 start/end（YYYY-MM-DD）时
+        返回该范围内每天的数据及按周、按月的汇总。响应带ETag，支持304。
+        """
         try:
             if current_user.is_authenticated:
-                yesterday = date.today() - timedelta(days=1)
-                data = dashboard_handler.get_dashboard_data(yesterday)
+                date_range = self._parse_dashboard_range()
+                if date_range is None:
+                    return jsonify({'status': 1, 'message': '日期范围无效'})
+                
+                if date_range == 'yesterday':
+                    yesterday = date.today() - timedelta(days=1)
+                    etag, range_data = dashboard_handler.get_dashboard_range(yesterday, yesterday)
+                    data = range_data['days'][0] if range_data['days'] else None
+                else:
+                    etag, data = dashboard_handler.get_dashboard_range(*date_range)
+                
                 response = {'status': 0, 'message': '成功'}
                 if data:
                     response['data'] = data
                 else:
                     response['message'] = '无数据'
-                return jsonify(response)
+                resp = jsonify(response)
+                resp.set_etag(etag)
+                resp.headers['Cache-Control'] = 'private, no-cache'
+                return resp.make_conditional(request)
             
             return jsonify({'status': 1, 'message': '未认证'})
             
@@ -419,6 +462,48 @@ class WebServer:
             logger.error(f'加载数据分析页面API失败: {e}')
             return jsonify({'status': 1, 'message': '页面加载失败'})
 
+    def _parse_dashboard_range(self):
+        """解析仪表板API的日期范围参数
+        
+        Returns:
+            'yesterday'（未指定范围）、(开始日期, 结束日期)，参数无效时返回None
+        """
+        range_name = request.args.get('range')
+        start = request.args.get('start')
+        end = request.args.get('end')
+        yesterday = date.today() - timedelta(days=1)
+        
+        if not range_name and not start and not end:
+            return 'yesterday'
+        if range_name == 'week':
+            return yesterday - timedelta(days=6), yesterday
+        if range_name == 'month':
+            return yesterday - timedelta(days=29), yesterday
+        
+        try:
+            start_date = datetime.strptime(start, '%Y-%m-%d').date() if start else None
+            end_date = datetime.strptime(end, '%Y-%m-%d').date() if end else yesterday
+        except ValueError:
+            return None
+        if start_date is None or start_date > end_date:
+            return None
+        if (end_date - start_date).days >= config.DASHBOARD_RANGE_MAX_DAYS:
+            return None
+        return start_date, end_date
+
+    def dashboard_today_api(self):
+        """今日实时统计API（读取小时汇总表）"""
+        try:
+            if current_user.is_authenticated:
+                data = dashboard_handler.get_today_so_far()
+                return jsonify({'status': 0, 'message': '成功', 'data': data})
+            
+            return jsonify({'status': 1, 'message': '未认证'})
+            
+        except Exception as e:
+            logger.error(f'加载今日实时统计API失败: {e}')
+            return jsonify({'status': 1, 'message': '页面加载失败'})
+
     def login_api_send(self):
         """发送登录验证码"""
         try:
@@ -494,13 +579,9 @@ class WebServer:
                 return jsonify({'msg': '验证码错误', 'status': 1})
             
             # 验证码正确，查找或创建用户
-            user = (self.db_manager.session.query(RIAPlayers)
-                   .filter_by(player_name=username, email=email)
-                   .first())
-            
-            if user is None:
-                user = RIAPlayers(player_name=username, email=email)
-                self.db_manager.add_and_commit(user)
+            user = db_service.get_or_create_player(username, email)
+            # 用户信息可能已变化，刷新缓存
+            self.user_cache.set(user.id, user)
             
             # 登录用户
             login_user(user, remember=True)
@@ -584,6 +665,10 @@ class WebServer:
             if self.avatar_downloader:
                 self.avatar_downloader.stop()
             
+            # 停止日志推送服务
+            if self.log_publisher:
+                self.log_publisher.stop()
+            
             # 关闭数据库连接
             if self.db_manager:
                 self.db_manager.close()
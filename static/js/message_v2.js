@@ -114,14 +114,12 @@ document.addEventListener("DOMContentLoaded", function () {
             targetDiv.appendChild(newDiv);
         });
     });
-      // 定义一个发送心跳的函数
-    function sendHeartbeat() {
+      // 订阅服务端推送，并补齐连接（或断线重连）期间错过的日志
+    function subscribeAndCatchUp() {
+        socket.emit('subscribe', 'chat');
         socket.emit('data_get', max_log_id);
     }
 
-    // 设置心跳间隔
-    const HEARTBEAT_INTERVAL = 1000; // 每 1 秒发送一次心跳
-
-    // 初始化心跳定时器
-    setInterval(sendHeartbeat, HEARTBEAT_INTERVAL);
+    // 每次连接成功（包括自动重连）时执行一次，新日志由服务端主动推送
+    socket.on('connect', subscribeAndCatchUp);
 });
\ No newline at end of file